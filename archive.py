@@ -0,0 +1,156 @@
+# This file contains a local Parquet archive of the processed master dataframe.
+# Every cycle's new zone watt and kWh rows are appended to a dataset that is
+# partitioned by date, so months of 5 minute data can be read back by time
+# range and column without touching the gateways or the database.
+
+
+# Import the required libraries
+import logging
+import os
+import threading
+import time
+
+
+# Class: Archive
+# ---------------------
+# A Parquet dataset under directory with one date=YYYY-MM-DD folder per local
+# day. append only writes rows newer than the last archived time, so the
+# same master dataframe can be appended every cycle. Each append adds a small
+# part file, and once a day is over its parts are compacted into one file.
+#
+# Parameters:
+#   directory - where the dataset is kept
+# ---------------------
+class Archive:
+    def __init__(self, directory):
+        self.directory = directory
+        self._last_time = None
+        self._lock = threading.Lock()
+
+    def _partitions(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return sorted(name for name in names if name.startswith("date="))
+
+    # Function: last_time
+    # ---------------------
+    # Returns the newest archived time, or None if the archive is empty.
+    # ---------------------
+    def last_time(self):
+        import pandas as pd
+
+        if self._last_time is None:
+            partitions = self._partitions()
+            if partitions:
+                latest = pd.read_parquet(
+                    os.path.join(self.directory, partitions[-1]), columns=["Time"]
+                )
+                self._last_time = latest["Time"].max()
+        return self._last_time
+
+    # Function: append
+    # ---------------------
+    # Appends the rows of master_df newer than the last archived time.
+    # Returns the number of rows written.
+    # ---------------------
+    def append(self, master_df):
+        with self._lock:
+            last_time = self.last_time()
+            if last_time is not None:
+                master_df = master_df[master_df["Time"] > last_time]
+            if master_df.empty:
+                return 0
+
+            days = master_df["Time"].dt.strftime("%Y-%m-%d")
+            stamp = str(time.time_ns())
+            for day, rows in master_df.groupby(days, sort=True):
+                folder = os.path.join(self.directory, "date=" + day)
+                os.makedirs(folder, exist_ok=True)
+                tmp_path = os.path.join(folder, "part-" + stamp + ".parquet.tmp")
+                rows.to_parquet(tmp_path, index=False)
+                os.replace(tmp_path, tmp_path[: -len(".tmp")])
+
+            self._last_time = master_df["Time"].max()
+            # Days before the newest one are complete, merge their part files
+            for partition in self._partitions()[:-1]:
+                self.compact(partition)
+            return len(master_df)
+
+    # Function: compact
+    # ---------------------
+    # Merges the part files of one date partition into a single file.
+    # ---------------------
+    def compact(self, partition):
+        import pandas as pd
+
+        folder = os.path.join(self.directory, partition)
+        parts = sorted(name for name in os.listdir(folder) if name.endswith(".parquet"))
+        if len(parts) < 2:
+            return
+        df = pd.concat(
+            [pd.read_parquet(os.path.join(folder, name)) for name in parts],
+            ignore_index=True,
+        )
+        tmp_path = os.path.join(folder, "compacted.parquet.tmp")
+        df.sort_values("Time").to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, os.path.join(folder, "part-" + str(time.time_ns()) + ".parquet"))
+        for name in parts:
+            os.remove(os.path.join(folder, name))
+        logging.info("Compacted " + str(len(parts)) + " files in " + folder)
+
+    # Function: read
+    # ---------------------
+    # Reads archived rows with start <= Time < end. Only the date partitions in
+    # range are opened, the time filter is pushed down into the Parquet scan,
+    # and only the requested columns are loaded.
+    #
+    # Parameters:
+    #   start - the first time to include, or None for the beginning
+    #   end - the first time to exclude, or None for the end
+    #   columns - the columns to load besides Time, or None for all
+    # Returns:
+    #   a dataframe sorted by Time
+    # ---------------------
+    def read(self, start=None, end=None, columns=None):
+        import pandas as pd
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+
+        if not self._partitions():
+            return pd.DataFrame()
+
+        dataset = ds.dataset(
+            self.directory,
+            format="parquet",
+            partitioning=ds.partitioning(pa.schema([("date", pa.string())]), flavor="hive"),
+        )
+        time_type = dataset.schema.field("Time").type
+        tz = getattr(time_type, "tz", None)
+
+        condition = None
+        for bound, op in ((start, "ge"), (end, "lt")):
+            if bound is None:
+                continue
+            bound = pd.Timestamp(bound)
+            if tz is not None and bound.tzinfo is None:
+                bound = bound.tz_localize(tz)
+            # The date partitions are pruned before any file is opened
+            day = bound.tz_convert(tz).strftime("%Y-%m-%d") if tz else bound.strftime("%Y-%m-%d")
+            if op == "ge":
+                clause = (ds.field("date") >= day) & (
+                    ds.field("Time") >= pa.scalar(bound, type=time_type)
+                )
+            else:
+                clause = (ds.field("date") <= day) & (
+                    ds.field("Time") < pa.scalar(bound, type=time_type)
+                )
+            condition = clause if condition is None else condition & clause
+
+        if columns is not None:
+            columns = ["Time"] + [column for column in columns if column != "Time"]
+        else:
+            columns = [name for name in dataset.schema.names if name != "date"]
+        table = dataset.to_table(columns=columns, filter=condition)
+        return table.to_pandas().sort_values("Time", ignore_index=True)
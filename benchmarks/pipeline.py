@@ -0,0 +1,540 @@
+# End-to-end pipeline benchmark against synthetic gateways and local stand-ins.
+#
+# Each scenario generates trend files for some number of gateways, serves them
+# through LocalSFTP (with delays that model the network), runs the pipeline
+# stages pullData, cleanData, CheckResData, processData and uploadData against a
+# SQLite stand-in, and reports the time, rows per second and peak Python memory
+# of every stage. Every scenario runs twice, once for timing and once under
+# tracemalloc for memory, so the tracing overhead does not skew the times.
+#
+# Usage:
+#   python benchmarks/pipeline.py                          # run every scenario
+#   python benchmarks/pipeline.py --scenario backfill-60   # run one scenario
+#   python benchmarks/pipeline.py --json results.json      # save the results
+#   python benchmarks/pipeline.py --compare results.json   # fail on regressions
+
+
+# Import the required libraries
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from io import BytesIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Keep the benchmark away from the real state and the local caches
+os.environ["TREND_CACHE_DIR"] = ""
+os.environ["ARCHIVE_DIR"] = ""
+os.environ["ROLLUP_DIR"] = ""
+os.environ["SFTP_KEEPALIVE"] = "0"
+os.environ["INCREMENTAL_FETCH"] = "0"
+
+import pandas as pd
+import pytz
+
+import datapross
+import ed_db_updatetool
+import standins
+import synthetic
+import transform
+from scheduler import Scheduler
+from trendcache import TrendCache
+
+ZONES = ["1st_Floor", "2nd_Floor", "3rd_Floor", "4th_Floor", "Utilities"]
+TABLE = "energy"
+
+
+# Class: Recorder
+# ---------------------
+# Runs pipeline stages and records their time or peak memory.
+# ---------------------
+class Recorder:
+    def __init__(self, trace):
+        self.trace = trace
+        self.stages = {}
+
+    def __call__(self, name, fn, *args, **kwargs):
+        if self.trace:
+            tracemalloc.reset_peak()
+            start_mem = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        seconds = time.perf_counter() - start
+
+        stage = self.stages.setdefault(name, {"seconds": 0.0, "rows": 0, "peak_mb": 0.0})
+        if self.trace:
+            peak = (tracemalloc.get_traced_memory()[1] - start_mem) / 2**20
+            stage["peak_mb"] = max(stage["peak_mb"], peak)
+        else:
+            stage["seconds"] += seconds
+            stage["rows"] += count_rows(result)
+        return result
+
+
+def count_rows(result):
+    if isinstance(result, pd.DataFrame):
+        return len(result)
+    if isinstance(result, int) and not isinstance(result, bool):
+        return result
+    if isinstance(result, dict):
+        return sum(count_rows(value) for value in result.values())
+    if isinstance(result, (list, tuple)):
+        return sum(count_rows(value) for value in result)
+    return 0
+
+
+# Function: zones_for
+# ---------------------
+# Writes a zone config that spreads every gateway's meters over the standard
+# zones, so processData and uploadData work for any number of gateways.
+# ---------------------
+def zones_for(path, gateways, meters):
+    zones = {zone: [] for zone in ZONES}
+    for gateway in range(1, gateways + 1):
+        for meter in range(1, meters + 1):
+            zone = ZONES[(gateway + meter) % len(ZONES)]
+            zones[zone].append([gateway, "Meter_%02d_Watt(avg)" % meter])
+    with open(path, "w") as f:
+        json.dump({"interval_minutes": 5, "total": "Total", "zones": zones}, f)
+    datapross._zones_cache.pop(path, None)
+    return datapross.load_zones(path)
+
+
+# Function: setup
+# ---------------------
+# Creates the gateways and the database for one scenario run.
+# ---------------------
+def setup(workdir, gateways, days, partial_rows, options):
+    for num in range(1, gateways + 1):
+        synthetic.write_gateway(
+            os.path.join(workdir, "gw" + str(num)),
+            days,
+            partial_rows=partial_rows,
+            seed=num,
+            meters=options.meters,
+            duplicates=options.duplicates,
+            missing=options.missing,
+        )
+    standins.install_gateways(workdir, options.connect_delay, options.file_delay)
+    standins.install_database(os.path.join(workdir, "db.sqlite"), TABLE)
+    os.environ["CHECKPOINT_DIR"] = os.path.join(workdir, "state")
+    datapross._checkpoints = None
+    return [
+        {"num": num, "host": "gw" + str(num), "user": "bench", "password": "bench"}
+        for num in range(1, gateways + 1)
+    ]
+
+
+# Function: process_and_upload
+# ---------------------
+# Runs the stages after the download on a dict of server number -> frame.
+# ---------------------
+def process_and_upload(record, raw, zones):
+    frames = [record("cleanData", datapross.cleanData, raw[num]) for num in sorted(raw)]
+    checked = record("CheckResData", datapross.CheckResData, *frames)
+    if checked is False:
+        raise RuntimeError("Data checks failed")
+    if checked is not True:
+        frames = list(checked)
+    master_df = record("processData", datapross.processData, *frames, zones=zones)
+    record("uploadData", datapross.uploadData, master_df, TABLE)
+
+
+def today():
+    now = datetime.now(pytz.timezone("US/Pacific"))
+    return datetime(now.year, now.month, now.day)
+
+
+# Function: cycle
+# ---------------------
+# One collection cycle: every gateway has today's file with partial_rows rows.
+# ---------------------
+def cycle(record, workdir, options, gateways):
+    servers = setup(workdir, gateways, [today()], options.partial_rows, options)
+    zones = zones_for(os.path.join(workdir, "zones.json"), gateways, options.meters)
+    results, errors = record("pullData", datapross.pullAll, servers)
+    if errors:
+        raise RuntimeError("Downloads failed: " + str(errors))
+    process_and_upload(record, results, zones)
+
+
+# Function: backfill
+# ---------------------
+# A backfill of the given number of past days for every gateway.
+# ---------------------
+def backfill(record, workdir, options, gateways, count):
+    end = today() - timedelta(days=1)
+    start = end - timedelta(days=count - 1)
+    servers = setup(workdir, gateways, synthetic.day_range(end, count), None, options)
+    zones = zones_for(os.path.join(workdir, "zones.json"), gateways, options.meters)
+    raw = {}
+    for server in servers:
+        raw[server["num"]] = record(
+            "pullData",
+            datapross.get_data_from_range,
+            server["host"],
+            server["user"],
+            server["password"],
+            start.strftime("%Y-%m-%d"),
+            end.strftime("%Y-%m-%d"),
+        )
+    process_and_upload(record, raw, zones)
+
+
+# Function: buildings
+# ---------------------
+# One collection cycle for several buildings of 3 gateways each, run by the
+# scheduler on 1 worker and on --workers workers. The workers are forked, so
+# they inherit the stand-ins, and starting them is part of the time.
+# ---------------------
+def buildings(record, workdir, options):
+    registry = []
+    for b in range(options.buildings):
+        folder = os.path.join(workdir, "building" + str(b))
+        servers = setup(folder, 3, [today()], options.partial_rows, options)
+        zones_for(os.path.join(folder, "zones.json"), 3, options.meters)
+        registry.append(
+            {
+                "name": "building" + str(b),
+                "table": "energy" + str(b),
+                "zones": os.path.join(folder, "zones.json"),
+                "columns": None,
+                "gateways": [
+                    dict(server, host=os.path.join("building" + str(b), server["host"]))
+                    for server in servers
+                ],
+            }
+        )
+    standins.install_gateways(workdir, options.connect_delay, options.file_delay)
+    tables = [building["table"] for building in registry]
+
+    for workers in sorted({1, options.workers}):
+        standins.install_database(os.path.join(workdir, "db" + str(workers) + ".sqlite"), *tables)
+        os.environ["CHECKPOINT_DIR"] = os.path.join(workdir, "state" + str(workers))
+        datapross._checkpoints = None
+        with Scheduler(workers) as scheduler:
+            record("%d worker(s)" % workers, lambda: sum(scheduler.run(registry).values()))
+
+
+# Function: degraded
+# ---------------------
+# One collection cycle of a building with three gateways when one refuses
+# connections and one hangs for --hang seconds, with a fetch deadline of
+# --deadline seconds. With PARTIAL_RESULTS=1 the zones of the healthy gateway
+# are still uploaded.
+# ---------------------
+def degraded(record, workdir, options):
+    servers = setup(workdir, 3, [today()], options.partial_rows, options)
+    standins.install_gateways(
+        workdir, options.connect_delay, options.file_delay, {"gw2": "refuse", "gw3": options.hang}
+    )
+    # Every zone has meters on each gateway, give the first zone gateway 1 only
+    path = os.path.join(workdir, "zones.json")
+    zones_for(path, 3, options.meters)
+    with open(path) as f:
+        config = json.load(f)
+    config["zones"][ZONES[0]] = [m for m in config["zones"][ZONES[0]] if m[0] == 1]
+    with open(path, "w") as f:
+        json.dump(config, f)
+    datapross._zones_cache.pop(path, None)
+    building = {
+        "name": "degraded",
+        "table": TABLE,
+        "zones": path,
+        "columns": None,
+        "gateways": servers,
+    }
+    os.environ["FETCH_DEADLINE"] = str(options.deadline)
+    os.environ["FETCH_BACKOFF"] = "0.1"
+    os.environ["PARTIAL_RESULTS"] = "1"
+    datapross._breakers.clear()
+    try:
+        record("runBuilding", datapross.runBuilding, building)
+    finally:
+        for name in ("FETCH_DEADLINE", "FETCH_BACKOFF", "PARTIAL_RESULTS"):
+            os.environ.pop(name)
+
+
+# Function: reprocess
+# ---------------------
+# Reprocesses --reprocess-days days of one gateway with get_data_from_range +
+# cleanData and with transformRange, first over SFTP and then from the trend
+# cache.
+# ---------------------
+def reprocess(record, workdir, options):
+    end = today() - timedelta(days=1)
+    start = end - timedelta(days=options.reprocess_days - 1)
+    setup(workdir, 1, synthetic.day_range(end, options.reprocess_days), None, options)
+    dates = start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")
+
+    def serial():
+        return datapross.cleanData(datapross.get_data_from_range("gw1", "bench", "bench", *dates))
+
+    def parallel():
+        return transform.transformRange("gw1", "bench", "bench", *dates, workers=options.workers)
+
+    # Each path fills its own cache on the first run and reads it on the second
+    for name, fn in (("serial", serial), ("parallel", parallel)):
+        datapross._trend_cache = TrendCache(os.path.join(workdir, name + "-cache"))
+        record(name + " (sftp)", fn)
+        record(name + " (cache)", fn)
+    datapross._trend_cache = None
+
+
+# Function: merge
+# ---------------------
+# Applies --merge-rows corrected intervals to a table that has the first two
+# thirds of them: the last third is new and every tenth stored row changed.
+# mergeData stages them and merges them in one statement, "row by row" sends
+# one UPDATE or INSERT per row, as correcting rows one at a time would. Both
+# must leave the same rows behind.
+# ---------------------
+def merge(record, workdir, options):
+    import numpy as np
+
+    columns = list(datapross.UPLOAD_COLUMNS)[1:]
+    times = pd.date_range(end=today(), periods=options.merge_rows, freq="5min", tz="US/Pacific")
+    rng = np.random.default_rng(1)
+    stored = pd.DataFrame(rng.random((len(times), len(columns))), columns=columns)
+    stored.insert(0, "Time", times)
+    kept = len(times) * 2 // 3
+    corrected = stored.copy()
+    corrected.loc[: kept - 1 : 10, "Total"] += 1
+    expected = {
+        "inserted": len(times) - kept,
+        "updated": len(range(0, kept, 10)),
+        "unchanged": kept - len(range(0, kept, 10)),
+    }
+
+    def row_by_row():
+        rows = corrected.assign(Time=datapross.localTimes(corrected["Time"]))
+        names = list(datapross.UPLOAD_COLUMNS.values())
+        with datapross.get_conn() as conn:
+            cursor = conn.cursor()
+            for row in rows.itertuples(index=False):
+                values = [row[0].to_pydatetime()] + [float(value) for value in row[1:]]
+                cursor.execute(
+                    "UPDATE " + TABLE + " SET "
+                    + ", ".join(name + " = ?" for name in names[1:])
+                    + " WHERE dateTime = ?",
+                    values[1:] + values[:1],
+                )
+                if cursor.rowcount == 0:
+                    cursor.execute(
+                        "INSERT INTO " + TABLE + " (" + ", ".join(names) + ") VALUES ("
+                        + ", ".join("?" * len(names)) + ")",
+                        values,
+                    )
+        return len(rows)
+
+    results = {}
+    for name, fn in (("mergeData", lambda: datapross.mergeData(corrected, TABLE)), ("row by row", row_by_row)):
+        standins.install_database(os.path.join(workdir, name + ".sqlite"), TABLE)
+        datapross.backfillData(stored.iloc[:kept], TABLE)
+        counts = record(name, fn)
+        if name == "mergeData" and counts != expected:
+            raise RuntimeError("mergeData counted " + str(counts) + ", expected " + str(expected))
+        with datapross.get_conn() as conn:
+            results[name] = pd.read_sql_query("SELECT * FROM " + TABLE + " ORDER BY dateTime", conn)
+        datapross.get_pool().close()
+    if not results["mergeData"].drop(columns="id").equals(results["row by row"].drop(columns="id")):
+        raise RuntimeError("mergeData and the row by row updates left different rows")
+
+
+# Function: stream
+# ---------------------
+# Reloads --stream-days past days of 3 gateways into an empty table, first as
+# one frame for the whole range and then one --chunk-days chunk at a time with
+# ed_db_updatetool.runBackfill, which processes each chunk with processChunk.
+# "first chunk" is how long until the first rows are in the database.
+# ---------------------
+def stream(record, workdir, options):
+    end = today() - timedelta(days=1)
+    start = end - timedelta(days=options.stream_days - 1)
+    servers = setup(workdir, 3, synthetic.day_range(end, options.stream_days), None, options)
+    building = {
+        "name": "stream",
+        "table": TABLE,
+        "zones": os.path.join(workdir, "zones.json"),
+        "columns": None,
+        "gateways": servers,
+    }
+    zones = zones_for(building["zones"], 3, options.meters)
+    dates = start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")
+
+    def whole_range():
+        frames = [
+            transform.transformRange(gw["host"], "bench", "bench", *dates, workers=1)
+            for gw in servers
+        ]
+        checked = datapross.CheckResData(*frames)
+        frames = frames if checked is True else list(checked)
+        master_df = datapross.processData(*frames, zones=zones)
+        return datapross.backfillData(master_df, TABLE)
+
+    record("whole range", whole_range)
+
+    standins.install_database(os.path.join(workdir, "chunked.sqlite"), TABLE)
+    chunks = ed_db_updatetool.chunkRange(*dates, options.chunk_days)
+
+    def chunked(start, end):
+        written, failed = ed_db_updatetool.runBackfill(
+            building, start, end, chunk_days=options.chunk_days, checkpoint=False
+        )
+        if failed:
+            raise RuntimeError("Chunk " + start + " to " + end + " failed")
+        return written
+
+    record("first chunk", chunked, *chunks[0])
+    for chunk in chunks[1:]:
+        record("chunked", chunked, *chunk)
+
+
+# Function: reader
+# ---------------------
+# Parses 60 days of one gateway's files with the old read_csv + to_datetime
+# path and with readTrend.
+# ---------------------
+def reader(record, workdir, options):
+    days = synthetic.day_range(today() - timedelta(days=1), 60)
+    files = synthetic.write_gateway(os.path.join(workdir, "gw1"), days, meters=options.meters)
+
+    def legacy():
+        frames = []
+        for path in files:
+            with open(path, "rb") as f, BytesIO() as fl:
+                fl.write(f.read())
+                fl.seek(0)
+                df = pd.read_csv(fl, header=0)
+            df["Time"] = pd.to_datetime(df["Date"] + " " + df["Time"])
+            frames.append(df)
+        return pd.concat(frames)
+
+    def read_trend():
+        frames = []
+        for path in files:
+            with open(path, "rb") as f:
+                frames.append(datapross.readTrend(f))
+        return pd.concat(frames)
+
+    record("read_csv (old)", legacy)
+    record("readTrend", read_trend)
+
+
+SCENARIOS = {
+    "cycle": lambda record, workdir, options: cycle(record, workdir, options, 3),
+    "backfill-7": lambda record, workdir, options: backfill(record, workdir, options, 3, 7),
+    "backfill-30": lambda record, workdir, options: backfill(record, workdir, options, 3, 30),
+    "backfill-60": lambda record, workdir, options: backfill(record, workdir, options, 3, 60),
+    "scale-out": lambda record, workdir, options: cycle(record, workdir, options, options.many),
+    "buildings": buildings,
+    "degraded": degraded,
+    "reprocess": reprocess,
+    "merge": merge,
+    "stream": stream,
+    "reader": reader,
+}
+
+
+# Function: run_scenario
+# ---------------------
+# Runs a scenario once for timing and once for memory, each in a fresh
+# directory, and merges the two recordings.
+# ---------------------
+def run_scenario(name, options):
+    stages = None
+    for trace in (False, True):
+        workdir = tempfile.mkdtemp(prefix="emd-bench-")
+        record = Recorder(trace)
+        if trace:
+            tracemalloc.start()
+        try:
+            SCENARIOS[name](record, workdir, options)
+        finally:
+            if trace:
+                tracemalloc.stop()
+            datapross.get_pool().close()
+            shutil.rmtree(workdir, ignore_errors=True)
+        if stages is None:
+            stages = record.stages
+        else:
+            for stage, values in record.stages.items():
+                stages[stage]["peak_mb"] = values["peak_mb"]
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS))
+    parser.add_argument("--meters", type=int, default=13, help="meters per gateway")
+    parser.add_argument("--many", type=int, default=24, help="gateways in scale-out")
+    parser.add_argument("--buildings", type=int, default=8, help="buildings in the buildings scenario")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="scheduler worker processes")
+    parser.add_argument("--hang", type=float, default=5, help="seconds the hung gateway in degraded blocks")
+    parser.add_argument("--deadline", type=float, default=2, help="fetch deadline in degraded")
+    parser.add_argument("--reprocess-days", type=int, default=60, help="days in the reprocess scenario")
+    parser.add_argument("--merge-rows", type=int, default=6000, help="intervals in the merge scenario")
+    parser.add_argument("--stream-days", type=int, default=60, help="days in the stream scenario")
+    parser.add_argument("--chunk-days", type=int, default=7, help="days per chunk in the stream scenario")
+    parser.add_argument("--partial-rows", type=int, default=200, help="rows in today's file")
+    parser.add_argument("--duplicates", type=float, default=0.02, help="fraction of duplicate rows")
+    parser.add_argument("--missing", type=float, default=0.01, help="fraction of missing rows")
+    parser.add_argument("--connect-delay", type=float, default=0.05, help="seconds per SFTP connect")
+    parser.add_argument("--file-delay", type=float, default=0.02, help="seconds per file download")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="fail if slower than the results in this file")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed slowdown, 0.5 = 50%%")
+    options = parser.parse_args()
+
+    # The pipeline prints progress for every file, keep the report readable
+    stdout = sys.stdout
+    results = {}
+    for name in options.scenario or list(SCENARIOS):
+        sys.stdout = open(os.devnull, "w")
+        try:
+            results[name] = run_scenario(name, options)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    print("%-12s %-16s %10s %10s %12s %10s" % ("scenario", "stage", "seconds", "rows", "rows/s", "peak MB"))
+    for name, stages in results.items():
+        for stage, values in stages.items():
+            rate = values["rows"] / values["seconds"] if values["seconds"] else 0
+            print(
+                "%-12s %-16s %10.4f %10d %12.0f %10.2f"
+                % (name, stage, values["seconds"], values["rows"], rate, values["peak_mb"])
+            )
+
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(results, f, indent=4)
+
+    failed = False
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        for name, stages in results.items():
+            for stage, values in stages.items():
+                before = baseline.get(name, {}).get(stage)
+                # Stages this short are mostly noise
+                if not before or before["seconds"] < 0.005:
+                    continue
+                if values["seconds"] > before["seconds"] * (1 + options.tolerance):
+                    print(
+                        "REGRESSION %s %s: %.4fs, was %.4fs"
+                        % (name, stage, values["seconds"], before["seconds"])
+                    )
+                    failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
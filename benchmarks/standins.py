@@ -0,0 +1,135 @@
+# Local stand-ins for the gateways and the database used by the benchmarks.
+#
+# LocalSFTP serves a directory through the subset of the pysftp Connection API
+# the pipeline uses, with optional per-connection and per-file delays to model
+# the network. sqlite_connect opens a SQLite database with the same table
+# layout as the Azure SQL table uploadData writes to.
+
+
+# Import the required libraries
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import datapross
+
+
+# Class: LocalSFTP
+# ---------------------
+# A pysftp-like connection over a local directory.
+#
+# Parameters:
+#   root - the directory that acts as the gateway's home directory
+#   connect_delay - seconds added when the connection is opened (the SSH handshake)
+#   file_delay - seconds added for every file opened or fetched
+# ---------------------
+class LocalSFTP:
+    bytes_read = 0
+    _lock = threading.Lock()
+
+    def __init__(self, root, connect_delay=0.0, file_delay=0.0):
+        self.cwd = root
+        self.file_delay = file_delay
+        time.sleep(connect_delay)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def chdir(self, path):
+        self.cwd = os.path.join(self.cwd, path)
+
+    def stat(self, name):
+        return os.stat(os.path.join(self.cwd, name))
+
+    def open(self, name, mode="r"):
+        time.sleep(self.file_delay)
+        path = os.path.join(self.cwd, name)
+        with LocalSFTP._lock:
+            LocalSFTP.bytes_read += os.path.getsize(path)
+        return open(path, mode)
+
+    def getfo(self, name, fl):
+        with self.open(name, "rb") as f:
+            data = f.read()
+        fl.write(data)
+        return len(data)
+
+
+# Function: install_gateways
+# ---------------------
+# Points datapross at local gateway directories instead of real gateways. The
+# FTP_HOST of each gateway is used as the name of its directory under root.
+#
+# Parameters:
+#   root - the folder holding one directory per gateway
+#   connect_delay - seconds per connection
+#   file_delay - seconds per file
+#   faults - a dict of FTP_HOST -> "refuse" to refuse every connection, or the
+#            seconds a connection hangs before it fails (optional)
+# Returns:
+#   None
+# ---------------------
+def install_gateways(root, connect_delay=0.0, file_delay=0.0, faults=None):
+    faults = faults or {}
+
+    def connect(host, user, password):
+        fault = faults.get(host)
+        if fault == "refuse":
+            raise ConnectionRefusedError(host + " refused the connection")
+        if fault is not None:
+            time.sleep(fault)
+            raise TimeoutError(host + " timed out")
+        return LocalSFTP(os.path.join(root, host), connect_delay, file_delay)
+
+    datapross.connect_sftp = connect
+
+
+# Function: sqlite_connect
+# ---------------------
+# Opens a SQLite database and creates the energy tables in it if needed.
+#
+# Parameters:
+#   path - the database file
+#   tables - the table names
+# Returns:
+#   a sqlite3 connection
+# ---------------------
+def sqlite_connect(path, *tables):
+    sqlite3.register_adapter(datetime, lambda value: value.isoformat(" "))
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    columns = ", ".join(
+        column + " REAL" for column in list(datapross.UPLOAD_COLUMNS.values())[1:]
+    )
+    for table in tables:
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} "
+            f"(id INTEGER PRIMARY KEY, dateTime TIMESTAMP UNIQUE, {columns})"
+        )
+    conn.commit()
+    return conn
+
+
+# Function: install_database
+# ---------------------
+# Points datapross's connection pool at a SQLite database and sets
+# SQL_DIALECT so mergeRows writes SQLite statements.
+#
+# Parameters:
+#   path - the database file
+#   tables - the table names
+# Returns:
+#   None
+# ---------------------
+def install_database(path, *tables):
+    # Pools made later, e.g. in the scheduler's worker processes, use it too
+    datapross.connect_db = lambda: sqlite_connect(path, *tables)
+    datapross._pool = datapross.ConnectionPool(datapross.connect_db)
+    os.environ["SQL_DIALECT"] = "sqlite"
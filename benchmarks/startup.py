@@ -0,0 +1,148 @@
+# Start-up benchmark for the pipeline entry points.
+#
+# Each entry point is started in a fresh interpreter under `python -X importtime`
+# with datapross.connect_sftp replaced by a marker. The marker records how long
+# it took from launching the process to the first SFTP download and which heavy
+# modules were already imported, then exits. The median over several runs is
+# compared with startup_baseline.json and the script exits with status 1 if an
+# entry point got slower than the allowed tolerance or loaded a module that
+# should stay lazy.
+#
+# Usage:
+#   python benchmarks/startup.py              # check against the baseline
+#   python benchmarks/startup.py --update     # record a new baseline
+
+
+# Import the required libraries
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "startup_baseline.json")
+
+# Modules that must not be imported before the first download starts
+LAZY_MODULES = ["pandas", "numpy", "pyodbc", "azure.identity"]
+
+# Entry points and the keyboard input that gets each one to its first download
+yesterday = (date.today() - timedelta(days=1)).isoformat()
+ENTRY_POINTS = {
+    "main.py": "",
+    "function_app.py": "",
+    "ed_db_updatetool.py": "1\n" + yesterday + "\n" + yesterday + "\n",
+}
+
+BOOTSTRAP = """
+import os, runpy, sys, time
+start = float(sys.argv[1])
+import datapross
+def first_download(*args):
+    loaded = [name for name in %r if name in sys.modules]
+    # One write on a line of its own, other download threads may be printing
+    sys.stdout.write("\\nFIRST_DOWNLOAD %%f %%s\\n" %% (time.time() - start, ",".join(loaded)))
+    sys.stdout.flush()
+    os._exit(0)
+datapross.connect_sftp = first_download
+sys.argv = [sys.argv[2]]
+runpy.run_path(sys.argv[0], run_name="__main__")
+print("NO_DOWNLOAD", flush=True)
+""" % (LAZY_MODULES,)
+
+
+# Function: run_once
+# ---------------------
+# Starts one entry point and waits for it to reach its first download.
+#
+# Parameters:
+#   entry - the entry point script
+#   stdin - the input to feed it
+# Returns:
+#   seconds - the time from launch to the first download
+#   loaded - the LAZY_MODULES that were already imported
+#   imports - a list of (cumulative microseconds, module) for top-level imports
+# ---------------------
+def run_once(entry, stdin):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = ROOT
+    env["SFTP_KEEPALIVE"] = "0"
+    env["INCREMENTAL_FETCH"] = "0"
+    for num in (1, 2, 3):
+        env["FTP_HOST_" + str(num)] = "gateway" + str(num)
+        env["FTP_USER_" + str(num)] = "user"
+        env["FTP_PASS_" + str(num)] = "pass"
+
+    start = time.time()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", BOOTSTRAP, str(start), entry],
+        cwd=ROOT,
+        env=env,
+        input=stdin,
+        capture_output=True,
+        text=True,
+        timeout=120,
+    )
+    marker = [line for line in result.stdout.splitlines() if line.startswith("FIRST_DOWNLOAD")]
+    if not marker:
+        raise RuntimeError(entry + " never reached a download:\n" + result.stderr[-2000:])
+    parts = marker[0].split(" ")
+    seconds = float(parts[1])
+    loaded = [name for name in (parts[2] if len(parts) > 2 else "").split(",") if name]
+
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        if not name.startswith("  "):
+            imports.append((int(cumulative), name.strip()))
+    return seconds, loaded, sorted(imports, reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5, help="runs per entry point")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed slowdown, 0.5 = 50%%")
+    parser.add_argument("--update", action="store_true", help="write a new baseline")
+    args = parser.parse_args()
+
+    try:
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+    except OSError:
+        baseline = {}
+
+    failed = False
+    results = {}
+    for entry, stdin in ENTRY_POINTS.items():
+        runs = [run_once(entry, stdin) for _ in range(args.repeat)]
+        seconds = statistics.median(run[0] for run in runs)
+        loaded, imports = runs[-1][1], runs[-1][2]
+        results[entry] = round(seconds, 4)
+
+        print("%-22s time to first download %.3fs" % (entry, seconds))
+        for cumulative, name in imports[:5]:
+            print("    %8.1f ms  %s" % (cumulative / 1000, name))
+        if loaded:
+            print("    FAIL: imported before the first download: " + ", ".join(loaded))
+            failed = True
+        limit = baseline.get(entry)
+        if limit is not None and seconds > limit * (1 + args.tolerance):
+            print("    FAIL: slower than baseline %.3fs + %d%%" % (limit, args.tolerance * 100))
+            failed = True
+
+    if args.update:
+        with open(BASELINE, "w") as f:
+            json.dump(results, f, indent=4)
+            f.write("\n")
+        print("Baseline written to " + BASELINE)
+        return 0
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,81 @@
+# Synthetic Eaton Power Xpert trend files for the benchmarks.
+#
+# Writes Trend_Virtual_Meter_Watt_YYYYMMDD.csv files with the same layout as the
+# real gateways: Date and Time columns followed by Meter_XX_Watt(avg) columns
+# (and a few non-watt columns readTrend has to skip), one row every 5 minutes.
+# Duplicate timestamps, missing rows and negative readings can be mixed in to
+# exercise the cleaning stages.
+
+
+# Import the required libraries
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+
+# Function: trend_frame
+# ---------------------
+# Builds one day of trend rows.
+#
+# Parameters:
+#   day - the date to generate
+#   meters - how many Meter_XX_Watt(avg) columns
+#   rows - how many 5 minute rows, from midnight (288 is a full day)
+#   duplicates - the fraction of rows written twice
+#   missing - the fraction of rows left out
+#   seed - the random seed
+# Returns:
+#   df - a dataframe laid out like a gateway trend file
+# ---------------------
+def trend_frame(day, meters=13, rows=288, duplicates=0.0, missing=0.0, seed=0):
+    rng = np.random.default_rng(seed)
+    times = pd.date_range(datetime(day.year, day.month, day.day), periods=rows, freq="5min")
+    df = pd.DataFrame({"Date": times.strftime("%m/%d/%Y"), "Time": times.strftime("%H:%M:%S")})
+    for meter in range(1, meters + 1):
+        # Mostly positive loads with the odd negative reading from a reversed CT
+        df["Meter_%02d_Watt(avg)" % meter] = rng.normal(2000, 600, rows).round(3)
+        df["Meter_%02d_Volt(avg)" % meter] = rng.normal(277, 2, rows).round(3)
+    watts = [column for column in df.columns if column.endswith("Watt(avg)")]
+    flips = rng.random((rows, len(watts))) < 0.01
+    df[watts] = df[watts].where(~flips, -df[watts])
+
+    if missing:
+        df = df[rng.random(len(df)) >= missing]
+    if duplicates:
+        df = pd.concat([df, df[rng.random(len(df)) < duplicates]]).sort_index(kind="stable")
+    return df
+
+
+# Function: write_gateway
+# ---------------------
+# Writes a gateway's trend directory with one file per day.
+#
+# Parameters:
+#   root - the gateway's home directory, the files go in root/trend
+#   days - the dates to write
+#   partial_rows - if set, the last day only gets this many rows (a day in progress)
+#   kwargs - passed on to trend_frame
+# Returns:
+#   the list of files written
+# ---------------------
+def write_gateway(root, days, partial_rows=None, seed=0, **kwargs):
+    folder = os.path.join(root, "trend")
+    os.makedirs(folder, exist_ok=True)
+    written = []
+    for i, day in enumerate(days):
+        rows = partial_rows if partial_rows and i == len(days) - 1 else 288
+        df = trend_frame(day, rows=rows, seed=seed * 100000 + i, **kwargs)
+        path = os.path.join(folder, "Trend_Virtual_Meter_Watt_" + day.strftime("%Y%m%d") + ".csv")
+        df.to_csv(path, index=False)
+        written.append(path)
+    return written
+
+
+# Function: day_range
+# ---------------------
+# Returns the dates from end - count + 1 through end.
+# ---------------------
+def day_range(end, count):
+    return [end - timedelta(days=count - 1 - i) for i in range(count)]
@@ -0,0 +1,142 @@
+# This file contains a small on-disk store for the upload high-water mark of
+# each database table. uploadData reads the last uploaded time from here
+# instead of querying the database every cycle, and only reconciles against
+# the database every so often or after an upload fails.
+
+
+# Import the required libraries
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+
+# Function: write_json_atomic
+# ---------------------
+# This function writes data as JSON to a temporary file next to path and then
+# renames it over path, so readers never see a half-written file.
+#
+# Parameters:
+#   path - the file to write
+#   data - the JSON-serialisable data
+# Returns:
+#   None
+# ---------------------
+def write_json_atomic(path, data):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+# Function: read_json
+# ---------------------
+# This function reads a JSON file, returning default if it does not exist or
+# cannot be parsed.
+#
+# Parameters:
+#   path - the file to read
+#   default - the value returned when the file is missing or corrupt
+# Returns:
+#   the parsed data or default
+# ---------------------
+def read_json(path, default=None):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+# Class: CheckpointStore
+# ---------------------
+# Keeps one JSON file per table in directory holding the last uploaded time
+# and when it was last reconciled with the database. A table needs to be
+# reconciled when it has no checkpoint yet, when reconcile_seconds have passed
+# since the last reconcile, or after invalidate was called.
+#
+# Parameters:
+#   directory - where the checkpoint files are kept
+#   reconcile_seconds - how often to check the checkpoint against the database
+# ---------------------
+class CheckpointStore:
+    def __init__(self, directory, reconcile_seconds=3600):
+        self.directory = directory
+        self.reconcile_seconds = reconcile_seconds
+        self._lock = threading.Lock()
+
+    def _path(self, table):
+        return os.path.join(self.directory, table + ".json")
+
+    def _read(self, table):
+        return read_json(self._path(table))
+
+    # Function: get
+    # ---------------------
+    # Returns the last uploaded time for table, or None if nothing is recorded.
+    # ---------------------
+    def get(self, table):
+        state = self._read(table)
+        if not state or state.get("last_time") is None:
+            return None
+        return datetime.fromisoformat(state["last_time"])
+
+    # Function: set
+    # ---------------------
+    # Records last_time as the last uploaded time for table. Pass
+    # reconciled=True when the value was just read from the database.
+    # ---------------------
+    def set(self, table, last_time, reconciled=False):
+        with self._lock:
+            state = self._read(table) or {}
+            state["last_time"] = None if last_time is None else last_time.isoformat()
+            if reconciled:
+                state["reconciled"] = time.time()
+            state.pop("stale", None)
+            write_json_atomic(self._path(table), state)
+
+    # Function: needs_reconcile
+    # ---------------------
+    # Returns True if the checkpoint for table should be checked against the
+    # database before it is trusted.
+    # ---------------------
+    def needs_reconcile(self, table):
+        state = self._read(table)
+        if not state or state.get("stale") or "reconciled" not in state:
+            return True
+        return time.time() - state["reconciled"] > self.reconcile_seconds
+
+    # Function: tables
+    # ---------------------
+    # Returns the tables that have a checkpoint, sorted.
+    # ---------------------
+    def tables(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return sorted(
+            name[: -len(".json")]
+            for name in names
+            if name.endswith(".json") and os.path.isfile(os.path.join(self.directory, name))
+        )
+
+    # Function: invalidate
+    # ---------------------
+    # Marks the checkpoint for table as stale so the next read reconciles.
+    # ---------------------
+    def invalidate(self, table):
+        with self._lock:
+            state = self._read(table) or {}
+            state["stale"] = True
+            write_json_atomic(self._path(table), state)
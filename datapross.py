@@ -10,84 +10,150 @@ import datetime
 import logging
 import os
 import sys
+import threading
 import time
 import json
+import csv
+import re
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 from datetime import datetime
 from datetime import timedelta
-import pandas as pd
-import pyodbc, struct
-from azure.identity import DefaultAzureCredential
-import pysftp
+import importlib
+import importlib.util
 from io import BytesIO
+from queue import Empty, Queue
 from dotenv import load_dotenv
 import pytz
+from checkpoint import CheckpointStore
+from dbpool import ConnectionPool
+from metrics import get_metrics, timed
+from resilience import CircuitBreaker, CircuitOpenError, backoff, callWithRetry, isTransient
+
+
+# Class: LazyModule
+# ---------------------
+# Stands in for a module and imports it the first time one of its attributes is
+# used. pandas, numpy, pysftp and pyodbc take most of the start-up time, so they
+# are only loaded by the code paths that need them instead of on import. The
+# trend cache, archive, rollups, ring buffer and outbox modules are imported
+# by their getters for the same reason.
+#
+# Parameters:
+#   name - the module to import
+# ---------------------
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+np = LazyModule("numpy")
+pd = LazyModule("pandas")
+pysftp = LazyModule("pysftp")
+pyodbc = LazyModule("pyodbc")
 
 # *****************************************************************************
 # The following functions are used to process energy data from the servers
 # *****************************************************************************
 
 
+# Function: load_zones
+# ---------------------
+# This function loads the meter-to-zone mapping from a JSON config file and
+# compiles it into a weight matrix. Each zone lists the [server number, meter
+# column] pairs that are added together, optionally with a third weight entry.
+# The matrix has one row per distinct meter and one column per output column
+# (every zone, the total, and the kWh version of each), so processData can
+# build all of them with a single matrix multiply. Compiled mappings are
+# cached per file.
+#
+# Parameters:
+#   path - the config file (defaults to ZONES_FILE or zones.json)
+# Returns:
+#   zones - a dict with the meter list, output column names and weight matrix
+# ---------------------
+_zones_cache = {}
+
+
+def load_zones(path=None):
+    if path is None:
+        path = os.getenv(
+            "ZONES_FILE", os.path.join(os.path.dirname(__file__), "zones.json")
+        )
+    if path in _zones_cache:
+        return _zones_cache[path]
+
+    with open(path) as f:
+        config = json.load(f)
+
+    zone_names = list(config["zones"])
+    meters = []
+    for members in config["zones"].values():
+        for member in members:
+            if (member[0], member[1]) not in meters:
+                meters.append((member[0], member[1]))
+
+    # Watts for every zone, then the total of all zones
+    watts = np.zeros((len(meters), len(zone_names) + 1))
+    for z, members in enumerate(config["zones"].values()):
+        for member in members:
+            weight = member[2] if len(member) > 2 else 1.0
+            watts[meters.index((member[0], member[1])), z] += weight
+    watts[:, -1] = watts[:, :-1].sum(axis=1)
+
+    # Each reading is the average over one interval, so kWh = W * minutes / 60 / 1000
+    kwh_factor = config.get("interval_minutes", 5) / 60 / 1000
+    names = zone_names + [config.get("total", "Total")]
+    zones = {
+        "meters": meters,
+        "columns": names + [name + "_Kwh" for name in names],
+        "weights": np.hstack([watts, watts * kwh_factor]),
+    }
+    _zones_cache[path] = zones
+    return zones
+
+
 # Function: processData
 # ---------------------
 # Parameters:
-#   3 dataframes - df_server1, df_server2, df_server3
+#   dataframes - one dataframe per server, in server number order
+#   zones - a compiled zone mapping (defaults to load_zones())
 # Returns:
 #   master_df - a dataframe that contains the total energy consumption for the entire
 #   building as well as the energy consumption for each floor and the utilities
 # ---------------------
-def processData(df_server1, df_server2, df_server3):
-    # Create the master dataframe
-    master_df = pd.DataFrame()
-
-    # Copy the 'Time' column from the first server's dataframe
-    master_df["Time"] = df_server1["Time"]
+@timed("processData")
+def processData(*frames, zones=None):
+    if zones is None:
+        zones = load_zones()
 
-    # Create submeters by combining values from different meters
-    master_df["1st_Floor"] = (
-        df_server1["Meter_01_Watt(avg)"] + df_server3["Meter_01_Watt(avg)"]
-    )
-    master_df["2nd_Floor"] = (
-        df_server1["Meter_03_Watt(avg)"]
-        + df_server1["Meter_05_Watt(avg)"]
-        + df_server1["Meter_10_Watt(avg)"]
-        + df_server3["Meter_02_Watt(avg)"]
-    )
-    master_df["3rd_Floor"] = (
-        df_server1["Meter_04_Watt(avg)"]
-        + df_server1["Meter_07_Watt(avg)"]
-        + df_server1["Meter_09_Watt(avg)"]
-        + df_server3["Meter_04_Watt(avg)"]
-    )
-    master_df["4th_Floor"] = (
-        df_server1["Meter_06_Watt(avg)"]
-        + df_server1["Meter_08_Watt(avg)"]
-        + df_server1["Meter_13_Watt(avg)"]
-        + df_server3["Meter_03_Watt(avg)"]
-    )
-    master_df["Utilities"] = (
-        df_server1["Meter_11_Watt(avg)"]
-        + df_server1["Meter_12_Watt(avg)"]
-        + df_server2["Meter_02_Watt(avg)"]
-        + df_server2["Meter_03_Watt(avg)"]
-        + df_server2["Meter_05_Watt(avg)"]
-        + df_server3["Meter_05_Watt(avg)"]
-        + df_server3["Meter_06_Watt(avg)"]
+    # Stack the meters every zone needs into one (rows x meters) array
+    readings = np.column_stack(
+        [
+            frames[server - 1][meter].to_numpy(dtype="float64")
+            for server, meter in zones["meters"]
+        ]
     )
 
-    master_df["Total"] = (
-        master_df["1st_Floor"]
-        + master_df["2nd_Floor"]
-        + master_df["3rd_Floor"]
-        + master_df["4th_Floor"]
-        + master_df["Utilities"]
-    )
+    # A missing reading only empties the zones that use that meter
+    weights = zones["weights"]
+    missing = np.isnan(readings)
+    if missing.any():
+        values = np.where(missing, 0.0, readings) @ weights
+        values[missing @ (weights != 0)] = np.nan
+    else:
+        values = readings @ weights
 
-    master_df["1st_Floor_Kwh"] = master_df["1st_Floor"] * 5 / 60 / 1000
-    master_df["2nd_Floor_Kwh"] = master_df["2nd_Floor"] * 5 / 60 / 1000
-    master_df["3rd_Floor_Kwh"] = master_df["3rd_Floor"] * 5 / 60 / 1000
-    master_df["4th_Floor_Kwh"] = master_df["4th_Floor"] * 5 / 60 / 1000
-    master_df["Utilities_Kwh"] = master_df["Utilities"] * 5 / 60 / 1000
-    master_df["Total_Kwh"] = master_df["Total"] * 5 / 60 / 1000
+    # Create the master dataframe, taking the 'Time' column from the first server's index
+    master_df = pd.DataFrame(values, columns=zones["columns"])
+    master_df.insert(0, "Time", frames[0].index)
 
     # Print the master dataframe
     logging.info(master_df)
@@ -97,102 +163,211 @@ def processData(df_server1, df_server2, df_server3):
 # Function: cleanData
 # ---------------------
 # This function cleans the data by removing any columns that have no data,
-# correcting duplicate time stamps, converting all negative values to positive,
-# and rounding all values to 2 decimal places.
+# snapping the readings onto the 5 minute trend grid (see regularize),
+# converting all negative values to positive, and rounding all values to
+# 2 decimal places.
 #
 # Parameters:
 #   df - a dataframe
+#   rule - how duplicate readings for one interval are combined (see regularize)
 # Returns:
-#   df - a cleaned dataframe
+#   df - a cleaned dataframe indexed by interval
 # ---------------------
-def cleanData(df):
-    # Delete any columns that have no data
+@timed("cleanData")
+def cleanData(df, rule=None):
+    # Frames read without readTrend still have the raw Date and Time columns
+    if "Date" in df.columns:
+        df = df.set_index(parseTrendTimes(df["Date"], df["Time"]))
+        df = df.drop(columns=["Date", "Time"])
+
+    # Delete any columns and rows that have no data
     df = df.dropna(axis=1, how="all")
     df = df.dropna(axis=0, how="all")
 
-    # Correct duplicate time stamps
-    df["Time"] = pd.to_datetime(df["Date"] + " " + df["Time"])
-    df = df.sort_values("Time")
+    df = regularize(df, rule=rule)
+
+    # Convert all negative values to positive and round to 2 decimal places
+    readings = df.columns.drop("Missing")
+    df[readings] = df[readings].abs().round(2)
+
+    return df
 
-    # Check if there are any duplicate time stamps
-    duplicates = df[df.duplicated(["Time"], keep=False)]
 
-    # If there are duplicates, correct them
-    if not duplicates.empty:
-        logging.warning("Duplicate time stamps found, correcting...")
-        # Get the unique time stamps
-        unique_times = df["Time"].unique()
+# Function: regularize
+# ---------------------
+# This function snaps readings onto the gateways' trend interval grid in one
+# pass. Each timestamp is rounded to the nearest interval, readings that land
+# on the same interval are combined with rule, and every interval between the
+# first and last reading is present in the result. Intervals with no reading
+# are NaN and flagged in the Missing column. Rounding happens in UTC so the
+# repeated hour at the end of daylight saving time stays distinct. Readings
+# without a time (NaT) are dropped with a warning.
+#
+# Parameters:
+#   df - a dataframe of readings indexed by time
+#   rule - "last", "mean" or "max" (defaults to DUPLICATE_RULE or "last")
+#   freq - the trend interval
+# Returns:
+#   df - a dataframe indexed by interval with a boolean Missing column
+# ---------------------
+def regularize(df, rule=None, freq="5min"):
+    if rule is None:
+        rule = os.getenv("DUPLICATE_RULE", "last")
+    if rule not in ("last", "mean", "max"):
+        raise ValueError("Unknown duplicate rule: " + str(rule))
 
-        # Create a new dataframe with the unique time stamps
-        new_df = pd.DataFrame(index=unique_times)
+    if df.index.hasnans:
+        logging.warning(
+            "Dropping " + str(df.index.isna().sum()) + " readings without a valid time"
+        )
+        df = df[df.index.notna()]
 
-        # Merge the new dataframe with the old one, this will correct the duplicate time stamps
-        df = new_df.merge(df, left_index=True, right_on="Time", how="left")
+    index = df.index
+    tz = index.tz
+    if tz is not None:
+        index = index.tz_convert("UTC")
+    slots = index.round(freq)
 
-    # Convert all negative values to positive
-    df = df.abs()
+    if slots.has_duplicates:
+        logging.warning(
+            "Duplicate time stamps found, combining "
+            + str(slots.duplicated().sum())
+            + " readings using "
+            + rule
+        )
+        df = df.groupby(slots, sort=True).agg(rule)
+    else:
+        df = df.set_axis(slots).sort_index()
 
-    # Round all values to 2 decimal places
-    df = df.round(2)
+    grid = pd.date_range(df.index[0], df.index[-1], freq=freq) if len(df) else slots
+    missing = ~grid.isin(df.index)
+    df = df.reindex(grid)
+    df["Missing"] = missing
+    if missing.any():
+        logging.warning(str(missing.sum()) + " missing intervals found")
 
+    if tz is not None:
+        df.index = df.index.tz_convert(tz)
+    df.index.name = "Time"
     return df
 
 
 # Function: CheckResData
 # ---------------------
-# This function checks if the dataframes are the same length and have the same time stamps.
-# If they are not the same length, the function will attempt to fix the issue by trimming the
-# dataframes to the latest common time. If the dataframes are still not the same length, the
-# function will return False.
+# This function lines up the cleaned dataframes of any number of servers on their
+# time stamps (see alignFrames) and reports how many intervals each server is
+# missing. Only the intervals every server has are kept, except that gaps of up
+# to fill_limit intervals are filled with the server's previous reading.
 #
 # Parameters:
-#   3 dataframes - df_server1, df_server2, df_server3
+#   dataframes - one cleaned dataframe per server, in server number order
+#   fill_limit - the longest gap to fill (defaults to ALIGN_FILL_LIMIT or 0)
 # Returns:
-#   True if the dataframes are the same length and have the same time stamps, False otherwise
+#   True if the dataframes already have the same time stamps and no gaps,
+#   the aligned dataframes if they had to be corrected, or False if they have
+#   no time stamps in common
 # ---------------------
-def CheckResData(df_server1, df_server2, df_server3):
-    # test 1 - check if all dataframes are the same length
-    if len(df_server1) != len(df_server2) or len(df_server1) != len(df_server3):
-        print("Dataframes are not the same length attempting to fix...")
-        logging.warning("Dataframes are not the same length attempting to fix...")
-        # Get the latest time that is common to all three dataframes
-        latest_common_time = min(
-            df_server1.index.max(), df_server2.index.max(), df_server3.index.max()
-        )
+@timed("CheckResData")
+def CheckResData(*frames, fill_limit=None):
+    if fill_limit is None:
+        fill_limit = int(os.getenv("ALIGN_FILL_LIMIT", "0"))
 
-        # trim the dataframes to the latest common time
-        df_server1 = df_server1[df_server1.index <= latest_common_time]
-        df_server2 = df_server2[df_server2.index <= latest_common_time]
-        df_server3 = df_server3[df_server3.index <= latest_common_time]
-
-        # Check if the dataframes are the same length now
-        if len(df_server1) != len(df_server2) or len(df_server1) != len(df_server3):
-            print("Dataframes are still not the same length, exiting...")
-            logging.error("Dataframes are still not the same length, exiting...")
-            logging.error("Length of df_server1: " + str(len(df_server1)))
-            logging.error("Length of df_server2: " + str(len(df_server2)))
-            logging.error("Length of df_server3: " + str(len(df_server3)))
-            return False
-        else:
-            logging.warning("Fixed! Dataframes are now the same length")
-            print("Fixed! Dataframes are now the same length")
-            return df_server1, df_server2, df_server3
-
-    # test 2 - check if all dataframes have the same time stamps
-    if not df_server1.index.equals(df_server2.index) or not df_server1.index.equals(
-        df_server3.index
-    ):
-        logging.warning("Dataframes do not have the same time stamps")
+    aligned, gaps = alignFrames(frames, fill_limit)
+    for num, gap in enumerate(gaps, start=1):
+        if gap:
+            logging.warning("Server " + str(num) + " is missing " + str(gap) + " intervals")
+
+    if len(aligned[0]) == 0:
+        print("Dataframes have no time stamps in common, exiting...")
+        logging.error("Dataframes have no time stamps in common, exiting...")
         return False
-    print("All dataframes have length " + str(len(df_server1)))
-    logging.info("All dataframes have length " + str(len(df_server1)))
+
+    print("All dataframes have length " + str(len(aligned[0])))
+    logging.info("All dataframes have length " + str(len(aligned[0])))
     print(
         "All dataframes start at "
-        + str(df_server1.index[0])
+        + str(aligned[0].index[0])
         + " and end at "
-        + str(df_server1.index[-1])
+        + str(aligned[0].index[-1])
     )
-    return True
+    if not any(gaps) and all(frame.index.equals(frames[0].index) for frame in frames):
+        return True
+    logging.warning("Fixed! Dataframes are now aligned")
+    return tuple(aligned)
+
+
+# Function: alignFrames
+# ---------------------
+# This function joins the dataframes of several servers on their time index in
+# one pass. An interval is a gap for a server when the server has no row for it
+# or its Missing flag is set. Gaps of at most fill_limit intervals in a row are
+# filled forward from the server's previous reading and flagged Missing. Longer
+# gaps are not filled at all, and any interval still missing for some server is
+# dropped from all of them.
+#
+# Parameters:
+#   frames - a list of dataframes indexed by time
+#   fill_limit - the longest gap to fill, 0 to keep only the common intervals
+# Returns:
+#   aligned - a list of dataframes that all share the same index
+#   gaps - the number of gap intervals for each server
+# ---------------------
+def alignFrames(frames, fill_limit=0):
+    keys = list(range(len(frames)))
+    readings = pd.concat(
+        [frame.drop(columns="Missing", errors="ignore") for frame in frames],
+        axis=1,
+        keys=keys,
+    ).sort_index()
+    present = pd.concat(
+        [
+            ~frame["Missing"] if "Missing" in frame else pd.Series(True, frame.index)
+            for frame in frames
+        ],
+        axis=1,
+        keys=keys,
+    ).reindex(readings.index, fill_value=False)
+    present = present.fillna(False).astype(bool)
+
+    gaps = [int((~present[k]).sum()) for k in keys]
+    if fill_limit:
+        # A gap can only be filled from a reading before it
+        short = shortGaps(present, fill_limit) & present.where(present).ffill().notna()
+        filled = present | short
+    else:
+        filled = present
+    keep = filled.all(axis=1)
+
+    aligned = []
+    for k in keys:
+        frame = readings[k]
+        if fill_limit:
+            frame = frame.where(~short[k], frame.where(present[k], axis=0).ffill(), axis=0)
+        frame = frame.loc[keep].copy()
+        frame["Missing"] = ~present[k].loc[keep]
+        aligned.append(frame)
+    return aligned, gaps
+
+
+# Function: shortGaps
+# ---------------------
+# This function finds the intervals that belong to a gap of at most limit
+# intervals in a row.
+#
+# Parameters:
+#   present - a dataframe of booleans, one column per server, True where the
+#             server has a reading
+#   limit - the longest gap
+# Returns:
+#   a dataframe like present, True in the intervals of the short gaps
+# ---------------------
+def shortGaps(present, limit):
+    short = {}
+    for k in present:
+        column = present[k]
+        runs = column.ne(column.shift()).cumsum()
+        short[k] = ~column & (column.groupby(runs).transform("size") <= limit)
+    return pd.DataFrame(short, index=present.index)
 
 
 # *****************************************************************************
@@ -201,6 +376,173 @@ def CheckResData(df_server1, df_server2, df_server3):
 # *****************************************************************************
 
 
+# Function: readTrend
+# ---------------------
+# This function parses a gateway trend CSV straight from an open file handle.
+# Only the Date, Time and Meter_XX_Watt(avg) columns are read, the meters as
+# float64, and Date + Time are parsed with TREND_TIME_FORMAT into a tz-aware
+# US/Pacific index named Time. Set TREND_CSV_ENGINE=pyarrow to parse with the
+# pyarrow engine when it is installed.
+#
+# Parameters:
+#   fh - a binary file handle positioned at the start of the file, or at the
+#        start of the data rows when header is given
+#   header - the file's column names, if they have already been read
+#   engine - the pandas CSV engine (defaults to TREND_CSV_ENGINE or "c")
+#   previous - the time of the row before the first one read, when reading
+#              the rest of a file (see parseTrendTimes)
+# Returns:
+#   df - a dataframe of meter readings indexed by time
+# ---------------------
+METER_COLUMN = re.compile(r"^Meter_\d+_Watt\(avg\)$")
+
+
+def readTrend(fh, header=None, engine=None, previous=None):
+    if header is None:
+        header = parseTrendHeader(fh.readline())
+    # Select the wanted columns by position, which both engines support
+    wanted = [
+        i
+        for i, column in enumerate(header)
+        if column in ("Date", "Time") or METER_COLUMN.match(column)
+    ]
+    names = [header[i] for i in wanted]
+    engine = engine or trendEngine()
+    # pyarrow would turn Time into time objects unless it is asked for strings
+    text = str if engine == "pyarrow" else object
+    dtypes = {column: np.float64 for column in names}
+    dtypes.update(Date=text, Time=text)
+
+    df = pd.read_csv(
+        fh,
+        header=None,
+        names=names,
+        usecols=wanted,
+        dtype=dtypes,
+        engine=engine,
+    )
+    df.index = parseTrendTimes(df.pop("Date"), df.pop("Time"), previous)
+    return df
+
+
+# Function: openTrend
+# ---------------------
+# This function opens a trend file on an SFTP connection for reading. Read-ahead
+# is switched on so the file streams into the parser without a BytesIO copy.
+#
+# Parameters:
+#   sftp - an open SFTP connection in the trend directory
+#   filename - the trend file to open
+# Returns:
+#   fh - a binary file handle
+# ---------------------
+def openTrend(sftp, filename):
+    fh = sftp.open(filename, "rb")
+    if hasattr(fh, "prefetch"):
+        fh.prefetch()
+    return fh
+
+
+# Function: parseTrendHeader
+# ---------------------
+# This function splits a trend file's header line into its column names.
+#
+# Parameters:
+#   line - the header line as bytes or str
+# Returns:
+#   a list of column names
+# ---------------------
+def parseTrendHeader(line):
+    if isinstance(line, bytes):
+        line = line.decode("utf-8-sig")
+    return next(csv.reader([line.strip()]))
+
+
+# Function: parseTrendTimes
+# ---------------------
+# This function joins the Date and Time columns of a trend file and parses them
+# with TREND_TIME_FORMAT into a tz-aware US/Pacific index. If the format does not
+# match, the times are parsed without one. During the autumn DST change the
+# repeated hour is resolved from the order of the rows. When the rows are the
+# rest of a file, e.g. an incremental tail that holds only the second pass of
+# the repeated hour, previous (the time of the row before them) says which
+# pass they are in.
+#
+# Parameters:
+#   dates - the Date column
+#   times - the Time column
+#   previous - the tz-aware time of the row before the first one (optional)
+# Returns:
+#   a DatetimeIndex named Time
+# ---------------------
+def parseTrendTimes(dates, times, previous=None):
+    stamps = dates + " " + times
+    try:
+        parsed = pd.to_datetime(
+            stamps, format=os.getenv("TREND_TIME_FORMAT", "%m/%d/%Y %H:%M:%S")
+        )
+    except ValueError:
+        logging.warning("Trend times do not match TREND_TIME_FORMAT, inferring")
+        parsed = pd.to_datetime(stamps)
+
+    index = pd.DatetimeIndex(parsed, name="Time")
+    try:
+        return index.tz_localize(
+            "US/Pacific", ambiguous="infer", nonexistent="shift_forward"
+        )
+    except Exception:
+        return resolveAmbiguous(index, previous)
+
+
+# Function: resolveAmbiguous
+# ---------------------
+# This function localizes trend times to US/Pacific when pandas cannot infer
+# the repeated hour, e.g. when only one pass of it is present. Each repeated
+# wall-clock time is taken as daylight time unless that would put it before
+# the row ahead of it (or previous, for the first row), in which case the
+# clock has gone back and it is standard time.
+#
+# Parameters:
+#   index - naive local times, in file order
+#   previous - the tz-aware time of the row before the first one (optional)
+# Returns:
+#   a tz-aware DatetimeIndex named Time
+# ---------------------
+def resolveAmbiguous(index, previous=None):
+    flags = np.ones(len(index), dtype=bool)
+    dst = index.tz_localize("US/Pacific", ambiguous=flags, nonexistent="shift_forward")
+    std = index.tz_localize("US/Pacific", ambiguous=~flags, nonexistent="shift_forward")
+    use_dst = flags.copy()
+    for i in np.flatnonzero(dst != std):
+        if i > 0:
+            last = dst[i - 1] if use_dst[i - 1] else std[i - 1]
+        else:
+            last = previous
+        use_dst[i] = last is None or pd.isna(last) or dst[i] >= last
+    return dst.where(use_dst, std).rename("Time")
+
+
+# Function: trendEngine
+# ---------------------
+# This function returns the CSV engine to parse trend files with. pyarrow is only
+# used when TREND_CSV_ENGINE asks for it and it is installed.
+#
+# Parameters:
+#   None
+# Returns:
+#   "pyarrow" or "c"
+# ---------------------
+def trendEngine():
+    if os.getenv("TREND_CSV_ENGINE", "c") != "pyarrow":
+        return "c"
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        logging.warning("pyarrow is not installed, using the c CSV engine")
+        return "c"
+    return "pyarrow"
+
+
 # Function: pullData
 # ---------------------
 # This function connects to the Eaton Power Xpert Gateway servers and downloads the
@@ -231,174 +573,1694 @@ def pullData(FTP_HOST, FTP_USER, FTP_PASS, SERVER_NUM):
         + str(now)
     )
 
-    cnopts = pysftp.CnOpts()
-    cnopts.hostkeys = None
-
-    with pysftp.Connection(
-        host=FTP_HOST, username=FTP_USER, password=FTP_PASS, cnopts=cnopts, port=2222
-    ) as sftp:
-        sftp.chdir("trend")
-        with BytesIO() as fl:
-            sftp.getfo("Trend_Virtual_Meter_Watt_" + Fdate + ".csv", fl)
-            fl.seek(0)
-            df = pd.read_csv(
-                fl,
-                header=0,
-            )
+    with sftp_session(FTP_HOST, FTP_USER, FTP_PASS) as sftp:
+        with openTrend(sftp, "Trend_Virtual_Meter_Watt_" + Fdate + ".csv") as fh:
+            df = readTrend(fh)
             print("[DOWNLOAD_INFO]  Download successful")
             logging.info("[DOWNLOAD_INFO]  Download successful")
+            countDownload(FTP_HOST, fh.tell(), len(df))
 
     return df
 
 
-# Function: get_data_from_range
+# Function: pullDataIncremental
 # ---------------------
-# This function connects to the Eaton Power Xpert Gateway servers and downloads the
-# energy data for the given range. The function then returns the data as a dataframe.
+# This function works like pullData but only downloads the bytes that were
+# appended to the CURRENT DAY trend file since the last call for the same server.
+# The byte offset, header and rows already read are kept in _tail_state. The
+# file is stat'ed first and nothing is downloaded when its size and mtime have
+# not changed. Only complete lines are consumed, a partially written last row is
+# picked up on the next call. The state resets when the date changes or the file
+# shrinks. Each call works on its own copy of the state and stores it when it
+# is done, unless pullAll gave up on the call in the meantime (see
+# dropTailState), so a late download never changes what the next cycle reads.
 #
 # Parameters:
 #   FTP_HOST - the IP address of the server
 #   FTP_USER - the username
 #   FTP_PASS - the password
 #   SERVER_NUM - the server number (1, 2, or 3)
-#   start - the start date in the format "YYYY-MM-DD"
-#   end - the end date in the format "YYYY-MM-DD"
+# Returns:
+#   df - a dataframe containing all of the day's energy data read so far
+# ---------------------
+_tail_state = {}
+_tail_generation = {}
+_tail_lock = threading.Lock()
 
 
-def get_data_from_range(FTP_HOST, FTP_USER, FTP_PASS, start, end):
+def pullDataIncremental(FTP_HOST, FTP_USER, FTP_PASS, SERVER_NUM):
     my_tz = pytz.timezone("US/Pacific")
     now = datetime.now(my_tz)
     Fdate = now.strftime("%Y%m%d")
-    start_date = datetime.strptime(start, "%Y-%m-%d")
-    end_date = datetime.strptime(end, "%Y-%m-%d")
-    days_between = (end_date - start_date).days
+    filename = "Trend_Virtual_Meter_Watt_" + Fdate + ".csv"
+
+    with _tail_lock:
+        generation = _tail_generation.get(FTP_HOST, 0)
+        state = _tail_state.get(FTP_HOST)
+    if state is not None:
+        state = dict(state)
+    if state is None or state["date"] != Fdate:
+        state = {
+            "date": Fdate,
+            "offset": 0,
+            "header": None,
+            "size": None,
+            "mtime": None,
+            "df": None,
+        }
+
+    with sftp_session(FTP_HOST, FTP_USER, FTP_PASS) as sftp:
+        attrs = sftp.stat(filename)
+        if attrs.st_size == state["size"] and attrs.st_mtime == state["mtime"]:
+            print("[DOWNLOAD_INFO]  server:" + str(SERVER_NUM) + " unchanged")
+            return state["df"]
+
+        if attrs.st_size < state["offset"]:
+            logging.warning(
+                "[DOWNLOAD_INFO]  server:" + str(SERVER_NUM) + " file shrank, rereading"
+            )
+            state.update(offset=0, header=None, df=None)
+
+        with sftp.open(filename, "rb") as fh:
+            fh.seek(state["offset"])
+            data = fh.read(attrs.st_size - state["offset"])
+
+    # Only consume up to the last complete line
+    data = data[: data.rfind(b"\n") + 1]
+    consumed = len(data)
+    if state["header"] is None:
+        if consumed == 0:
+            raise ValueError(filename + " has no header yet")
+        header_line, _, data = data.partition(b"\n")
+        state["header"] = parseTrendHeader(header_line)
+
+    # A tail that starts inside the repeated DST hour needs the last time read
+    previous = None
+    if state["df"] is not None and len(state["df"]):
+        previous = state["df"].index[-1]
+    new_rows = readTrend(BytesIO(data), header=state["header"], previous=previous)
+    if state["df"] is None:
+        state["df"] = new_rows
+    elif not new_rows.empty:
+        state["df"] = pd.concat([state["df"], new_rows])
+
+    countDownload(FTP_HOST, consumed, len(new_rows))
+    state["offset"] += consumed
+    state["size"] = attrs.st_size
+    state["mtime"] = attrs.st_mtime
+    with _tail_lock:
+        if _tail_generation.get(FTP_HOST, 0) == generation:
+            _tail_state[FTP_HOST] = state
+    print(
+        "[DOWNLOAD_INFO]  server:"
+        + str(SERVER_NUM)
+        + " read "
+        + str(consumed)
+        + " new bytes, "
+        + str(len(new_rows))
+        + " new rows"
+    )
+    return state["df"]
+
+
+# Function: dropTailState
+# ---------------------
+# This function forgets the incremental download state of a server whose
+# download was abandoned. The abandoned call does not store its state when it
+# finishes, and the next call reads the day's file from the start.
+#
+# Parameters:
+#   FTP_HOST - the IP address of the server
+# Returns:
+#   None
+# ---------------------
+def dropTailState(FTP_HOST):
+    with _tail_lock:
+        _tail_state.pop(FTP_HOST, None)
+        _tail_generation[FTP_HOST] = _tail_generation.get(FTP_HOST, 0) + 1
+
+
+# Function: countDownload
+# ---------------------
+# This function adds a downloaded trend file (or part of one) to the byte and
+# row counters of its gateway.
+#
+# Parameters:
+#   FTP_HOST - the IP address of the server
+#   size - the number of bytes read
+#   rows - the number of rows parsed
+# Returns:
+#   None
+# ---------------------
+def countDownload(FTP_HOST, size, rows):
+    metrics = get_metrics()
+    metrics.inc("emd_gateway_bytes_total", size, gateway=FTP_HOST)
+    metrics.inc("emd_gateway_rows_total", rows, gateway=FTP_HOST)
 
-    if days_between < 0:
-        logging.error("Start date is after end date")
-        return None
-    elif Fdate < start:
-        logging.error("Start date is in the future")
-        return None
-    elif Fdate < end:
-        logging.error("End date is in the future")
-        return None
-    elif days_between > 60:
-        logging.error("Date range is too large")
-        return None
 
+# Function: connect_sftp
+# ---------------------
+# This function opens an SFTP connection to an Eaton Power Xpert Gateway.
+# Opening the connection gives up after SFTP_CONNECT_TIMEOUT seconds at each
+# step (TCP connect, SSH banner, key exchange and login), and any read on the open connection
+# raises socket.timeout after waiting SFTP_TRANSFER_TIMEOUT seconds for data,
+# so an unreachable or stalled gateway cannot hang a cycle. 0 turns a timeout
+# off.
+#
+# Parameters:
+#   FTP_HOST - the IP address of the server
+#   FTP_USER - the username
+#   FTP_PASS - the password
+# Returns:
+#   sftp - an open pysftp connection, usable as a context manager
+# ---------------------
+def connect_sftp(FTP_HOST, FTP_USER, FTP_PASS):
     cnopts = pysftp.CnOpts()
     cnopts.hostkeys = None
-    master_df = pd.DataFrame()
-    with pysftp.Connection(
-        host=FTP_HOST, username=FTP_USER, password=FTP_PASS, cnopts=cnopts, port=2222
-    ) as sftp:
-        sftp.chdir("trend")
-        print("Attempting to download data from range:" + start + " to " + end)
-        for i in range(days_between + 1):
-            date = start_date + timedelta(days=i)
-            Fdate = date.strftime("%Y%m%d")
-            with BytesIO() as fl:
-                print("Downloading file for:" + Fdate)
-                sftp.getfo("Trend_Virtual_Meter_Watt_" + Fdate + ".csv", fl)
-                fl.seek(0)
-                df = pd.read_csv(
-                    fl,
-                    header=0,
-                )
-                master_df = pd.concat([master_df, df])
-        print("Successfully downloaded data from range")
-        print("there are:" + str(len(master_df)) + " rows")
-    return master_df
+    connect_timeout = float(os.getenv("SFTP_CONNECT_TIMEOUT", "10")) or None
+    transfer_timeout = float(os.getenv("SFTP_TRANSFER_TIMEOUT", "60")) or None
+    sftp = timeoutConnection()(
+        host=FTP_HOST,
+        username=FTP_USER,
+        password=FTP_PASS,
+        cnopts=cnopts,
+        port=2222,
+        connect_timeout=connect_timeout,
+    )
+    try:
+        sftp.sftp_client.get_channel().settimeout(transfer_timeout)
+    except Exception:
+        sftp.close()
+        raise
+    return sftp
 
 
-# *****************************************************************************
-# The following functions are used to connect to the SQL database
-# *****************************************************************************
+# Function: timeoutConnection
+# ---------------------
+# This function returns a pysftp Connection class that takes a connect_timeout.
+# pysftp opens its socket without one, so the subclass opens the socket itself
+# and hands it to paramiko, and closes the transport if the login fails. The
+# class is made on first use so pysftp and paramiko are only imported then.
+#
+# Parameters:
+#   None
+# Returns:
+#   the TimeoutConnection class
+# ---------------------
+_timeout_connection = None
 
-# Function: uploadData
+
+def timeoutConnection():
+    global _timeout_connection
+    if _timeout_connection is None:
+        import socket
+
+        import paramiko
+
+        class TimeoutConnection(pysftp.Connection):
+            def __init__(self, *args, connect_timeout=None, **kwargs):
+                self._connect_timeout = connect_timeout
+                try:
+                    super().__init__(*args, **kwargs)
+                except Exception:
+                    if getattr(self, "_transport", None) is not None:
+                        self._transport.close()
+                        self._transport = None
+                    raise
+
+            def _start_transport(self, host, port):
+                try:
+                    sock = socket.create_connection((host, port), timeout=self._connect_timeout)
+                except socket.gaierror:
+                    raise pysftp.ConnectionException(host, port)
+                self._transport = paramiko.Transport(sock)
+                if self._connect_timeout is not None:
+                    self._transport.banner_timeout = self._connect_timeout
+                    self._transport.handshake_timeout = self._connect_timeout
+                    self._transport.auth_timeout = self._connect_timeout
+                if self._cnopts.ciphers is not None:
+                    self._transport.get_security_options().ciphers = self._cnopts.ciphers
+
+        _timeout_connection = TimeoutConnection
+    return _timeout_connection
+
+
+# Function: sftp_session
 # ---------------------
-# This function uploads the master dataframe to the SQL database.
+# This function gives a connection to a gateway that is already in the trend
+# directory. With SFTP_KEEPALIVE=1 the connection is kept open after the block
+# and reused by the next call for the same gateway, as long as its transport is
+# still active. A connection that raised inside the block is closed so the next
+# call reconnects. Otherwise a new connection is opened and closed every time.
 #
 # Parameters:
-#   master_df - a dataframe containing the energy data
+#   FTP_HOST - the IP address of the server
+#   FTP_USER - the username
+#   FTP_PASS - the password
 # Returns:
-#   None
+#   sftp - an open connection in the trend directory
 # ---------------------
+_sftp_sessions = {}
+_sftp_lock = threading.Lock()
 
 
-def uploadData(master_df, table):
-    DB_Last_time = get_last_time()
-    Server_Last_time = master_df["Time"].iloc[-1]
-    load_dotenv()
-    row = master_df.iloc[-1]
-    print("DB_Last: " + str(DB_Last_time))
-    print("Server_Last: " + str(Server_Last_time))
+@contextmanager
+def sftp_session(FTP_HOST, FTP_USER, FTP_PASS):
+    if os.getenv("SFTP_KEEPALIVE", "0") != "1":
+        with connect_sftp(FTP_HOST, FTP_USER, FTP_PASS) as sftp:
+            sftp.chdir("trend")
+            yield sftp
+        return
 
-    if DB_Last_time == None or DB_Last_time < Server_Last_time:
-        print("Uploading new data to DB")
-        with get_conn() as conn:
-            cursor = conn.cursor()
-            try:
-                cursor.execute(
-                    f"INSERT INTO {table} (dateTime, First_Floor, Second_Floor, Third_Floor, Fourth_Floor, Utilities, TOTAL, First_Floor_Kwh, Second_Floor_Kwh, Third_Floor_Kwh, Fourth_Floor_Kwh, Utilities_Kwh, TOTAL_Kwh) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                    row["Time"],
-                    row["1st_Floor"],
-                    row["2nd_Floor"],
-                    row["3rd_Floor"],
-                    row["4th_Floor"],
-                    row["Utilities"],
-                    row["Total"],
-                    row["1st_Floor_Kwh"],
-                    row["2nd_Floor_Kwh"],
-                    row["3rd_Floor_Kwh"],
-                    row["4th_Floor_Kwh"],
-                    row["Utilities_Kwh"],
-                    row["Total_Kwh"],
-                )
-            except Exception as e:
-                print("Error executing SQL statement: {}".format(e))
-    elif DB_Last_time == Server_Last_time:
-        print("No new data to upload")
+    with _sftp_lock:
+        sftp = _sftp_sessions.pop(FTP_HOST, None)
+    if sftp is not None and not sftp_alive(sftp):
+        sftp.close()
+        sftp = None
+    fresh = sftp is None
+    if fresh:
+        sftp = connect_sftp(FTP_HOST, FTP_USER, FTP_PASS)
 
-    else:
-        print("Server data is older than DB data, exiting...")
+    try:
+        if fresh:
+            sftp.chdir("trend")
+        yield sftp
+    except Exception:
+        sftp.close()
+        raise
+    with _sftp_lock:
+        _sftp_sessions[FTP_HOST] = sftp
 
 
-# Function: get_last_time
+# Function: sftp_alive
 # ---------------------
-# This function gets the last time from the SQL database.
+# This function checks whether a kept-open SFTP connection can still be used.
+#
+# Parameters:
+#   sftp - an SFTP connection
+# Returns:
+#   True if the connection's transport is still active
+# ---------------------
+def sftp_alive(sftp):
+    try:
+        return sftp.sftp_client.get_channel().get_transport().is_active()
+    except AttributeError:
+        return True
+    except Exception:
+        return False
+
+
+# Function: close_sftp_sessions
+# ---------------------
+# This function closes every kept-open SFTP connection.
 #
 # Parameters:
 #   None
 # Returns:
-#   The last time from the SQL database
-def get_last_time():
-    with get_conn() as conn:
-        cursor = conn.cursor()
-        load_dotenv()
-        table = os.getenv("SQL_TABLE")
-        logging.info("Getting last time from DB")
-        print("Getting last time from DB")
-        cursor.execute(f"SELECT TOP 1 * FROM {table} ORDER BY dateTime DESC")
-        rows = cursor.fetchall()
-        if len(rows) == 0:
-            logging.warning("database is empty")
-            return None
-        return rows[0][1]
+#   None
+# ---------------------
+def close_sftp_sessions():
+    with _sftp_lock:
+        sessions = list(_sftp_sessions.values())
+        _sftp_sessions.clear()
+    for sftp in sessions:
+        try:
+            sftp.close()
+        except Exception:
+            pass
 
 
-# Function: get_conn
+# Function: load_gateways
 # ---------------------
-# This function connects to the SQL database.
+# This function reads the gateway connection settings from the environment.
+# Gateways are numbered FTP_HOST_1, FTP_HOST_2, ... and the list stops at the
+# first number that has no FTP_HOST set.
 #
 # Parameters:
 #   None
 # Returns:
-#   A connection to the SQL database
+#   gateways - a list of dicts with the keys num, host, user and password
 # ---------------------
-def get_conn():
-    print("Getting connection to database")
+def load_gateways():
     load_dotenv()
+    gateways = []
+    num = 1
+    while os.getenv("FTP_HOST_" + str(num)):
+        gateways.append(
+            {
+                "num": num,
+                "host": os.getenv("FTP_HOST_" + str(num)),
+                "user": os.getenv("FTP_USER_" + str(num)),
+                "password": os.getenv("FTP_PASS_" + str(num)),
+            }
+        )
+        num += 1
+    return gateways
+
+
+# Function: pullAll
+# ---------------------
+# This function downloads the CURRENT DAY trend file from every gateway at the
+# same time, using a thread pool so a run takes about as long as the slowest
+# gateway instead of the sum of all of them. A failing gateway does not stop
+# the others, its exception is reported back instead.
+#
+# Downloads that fail with a network error are retried up to FETCH_RETRIES
+# times after a random backoff (see resilience.backoff). A gateway still
+# running after FETCH_DEADLINE seconds is given up on and reported as timed
+# out, so the cycle carries on with the others. Gateways that failed
+# BREAKER_FAILURES cycles in a row are skipped without being contacted until
+# their BREAKER_COOLDOWN is over (see get_breaker).
+#
+# Parameters:
+#   gateways - a list of gateways as returned by load_gateways
+#   max_workers - the most gateways to download from at once
+#                 (defaults to FETCH_WORKERS or the number of gateways)
+#   fetch - the function used to download one gateway (defaults to pullData,
+#           or pullDataIncremental when INCREMENTAL_FETCH=1)
+#   deadline - the most seconds to wait for the downloads
+#              (defaults to FETCH_DEADLINE or 120, 0 waits for ever)
+# Returns:
+#   results - a dict of server number -> dataframe for the gateways that succeeded
+#   errors - a dict of server number -> exception for the gateways that failed
+# ---------------------
+@timed("pullData")
+def pullAll(gateways, max_workers=None, fetch=None, deadline=None):
+    if fetch is None:
+        if os.getenv("INCREMENTAL_FETCH", "0") == "1":
+            fetch = pullDataIncremental
+        else:
+            fetch = pullData
+    if max_workers is None:
+        max_workers = int(os.getenv("FETCH_WORKERS", "0")) or len(gateways)
+    max_workers = max(1, min(max_workers, len(gateways)))
+    if deadline is None:
+        deadline = float(os.getenv("FETCH_DEADLINE", "120"))
+    retries = int(os.getenv("FETCH_RETRIES", "2"))
+    base = float(os.getenv("FETCH_BACKOFF", "1"))
+    cap = float(os.getenv("FETCH_BACKOFF_MAX", "30"))
+
+    metrics = get_metrics()
+    start = time.perf_counter()
+    stop_at = time.monotonic() + deadline if deadline else None
+
+    def fetch_one(gw):
+        with metrics.timer("emd_gateway_download_seconds", gateway=gw["host"]):
+            return callWithRetry(
+                lambda: fetch(gw["host"], gw["user"], gw["password"], gw["num"]),
+                retries=retries,
+                deadline=stop_at,
+                base=base,
+                cap=cap,
+                name="[DOWNLOAD_ERROR] server:" + str(gw["num"]),
+                on_retry=lambda e: metrics.inc("emd_gateway_retries_total", gateway=gw["host"]),
+            )
+
+    def failed(gw, e):
+        errors[gw["num"]] = e
+        metrics.inc("emd_gateway_errors_total", gateway=gw["host"])
+        print("[DOWNLOAD_ERROR] server:" + str(gw["num"]) + " failed: " + str(e))
+        logging.error("[DOWNLOAD_ERROR] server:" + str(gw["num"]) + " failed: " + str(e))
+
+    results = {}
+    errors = {}
+    futures = {}
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    for gw in gateways:
+        breaker = get_breaker(gw["host"])
+        if breaker.allow():
+            futures[pool.submit(fetch_one, gw)] = gw
+        else:
+            errors[gw["num"]] = CircuitOpenError(gw["host"] + " is in its cool-down")
+            print("[DOWNLOAD_INFO]  server:" + str(gw["num"]) + " skipped, circuit open")
+            logging.warning("[DOWNLOAD_INFO]  server:" + str(gw["num"]) + " skipped, circuit open")
+
+    pending = set(futures)
+    try:
+        timeout = max(0, stop_at - time.monotonic()) if stop_at is not None else None
+        for future in as_completed(futures, timeout=timeout):
+            pending.discard(future)
+            gw = futures[future]
+            try:
+                results[gw["num"]] = future.result()
+                get_breaker(gw["host"]).success()
+                logging.info(
+                    "[DOWNLOAD_INFO]  server:"
+                    + str(gw["num"])
+                    + " succeeded after "
+                    + "%.2fs" % (time.perf_counter() - start)
+                )
+            except Exception as e:
+                get_breaker(gw["host"]).failure()
+                failed(gw, e)
+    except FuturesTimeoutError:
+        # Leave the stuck downloads to their transfer timeout, their results are dropped
+        for future in pending:
+            future.cancel()
+            # The download may still finish, its tail state must not be used
+            dropTailState(futures[future]["host"])
+            get_breaker(futures[future]["host"]).failure()
+            failed(futures[future], TimeoutError("no data after " + "%gs" % deadline))
+    finally:
+        pool.shutdown(wait=False)
+
+    for gw in gateways:
+        metrics.set(
+            "emd_gateway_breaker_open", int(get_breaker(gw["host"]).is_open()), gateway=gw["host"]
+        )
+    print(
+        "[DOWNLOAD_INFO]  "
+        + str(len(results))
+        + "/"
+        + str(len(gateways))
+        + " gateways downloaded in "
+        + "%.2fs" % (time.perf_counter() - start)
+    )
+    return results, errors
+
+
+# Function: get_breaker
+# ---------------------
+# This function returns the circuit breaker of a gateway, made on first use.
+# It opens after BREAKER_FAILURES failed cycles in a row (default 3) and skips
+# the gateway for BREAKER_COOLDOWN seconds (default 300), doubling up to an
+# hour while the gateway stays down.
+#
+# Parameters:
+#   FTP_HOST - the IP address of the server
+# Returns:
+#   the gateway's CircuitBreaker
+# ---------------------
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(FTP_HOST):
+    with _breakers_lock:
+        breaker = _breakers.get(FTP_HOST)
+        if breaker is None:
+            breaker = _breakers[FTP_HOST] = CircuitBreaker(
+                threshold=int(os.getenv("BREAKER_FAILURES", "3")),
+                cooldown=float(os.getenv("BREAKER_COOLDOWN", "300")),
+            )
+        return breaker
+
+
+# Function: runBuilding
+# ---------------------
+# This function runs one collection cycle for a building: it downloads every
+# gateway's current trend file, cleans and checks the data, builds the zone
+# totals, archives them and uploads the new rows to the building's table.
+#
+# When a gateway fails the cycle is skipped, unless PARTIAL_RESULTS=1. Then the
+# gateways that succeeded are processed as usual and every zone (and the
+# total) that needs a meter from a failed gateway is left empty, which is
+# written as NULL, and logged.
+#
+# Parameters:
+#   building - a building as returned by registry.load_registry
+# Returns:
+#   the number of rows written, or None if a download or the data checks failed
+# ---------------------
+def runBuilding(building):
+    name = building["name"]
+    results, errors = pullAll(building["gateways"])
+    if errors:
+        logging.error(
+            "[" + name + "] Download failed for servers: " + str(sorted(errors))
+        )
+        if not results or os.getenv("PARTIAL_RESULTS", "0") != "1":
+            return None
+
+    nums = [gw["num"] for gw in building["gateways"] if gw["num"] in results]
+    frames = [cleanData(results[num]) for num in nums]
+    dataval = CheckResData(*frames)
+
+    if dataval is True:
+        logging.info("[" + name + "] Data checkes passed")
+    elif dataval is False:
+        logging.error("[" + name + "] Data checks failed")
+        return None
+    else:
+        frames = list(dataval)
+        logging.warning("[" + name + "] Data checks passed after correction")
+
+    zones = load_zones(building["zones"]) if building["zones"] else load_zones()
+    # processData finds a server's frame by its number, which need not be 1..n
+    frames = missingFrames(dict(zip(nums, frames)), building["gateways"], zones)
+    master_df = processData(*frames, zones=zones)
+
+    if errors:
+        partial = [
+            column
+            for column in zones["columns"]
+            if not column.endswith("_Kwh") and master_df[column].isna().all()
+        ]
+        get_metrics().set("emd_partial_zones", len(partial), table=building["table"])
+        if len(partial) == len(zones["columns"]) // 2:
+            logging.error("[" + name + "] Every zone needs a failed gateway, nothing to upload")
+            return None
+        print("[" + name + "] Uploading without " + ", ".join(partial))
+        logging.warning("[" + name + "] Zones missing a gateway, left empty: " + str(partial))
+    else:
+        get_metrics().set("emd_partial_zones", 0, table=building["table"])
+
+    bufferData(master_df, building["table"])
+    archiveData(master_df, building["table"])
+    rollupData(master_df, building["table"])
+    return uploadData(master_df, building["table"], columns=building["columns"])
+
+
+# Function: missingFrames
+# ---------------------
+# This function lays the frames out the way processData looks them up, one per
+# server number from 1 to the highest. The gateways that failed, and numbers
+# no gateway has, get empty readings on the same intervals as the others, so
+# processData leaves every zone that needs one of their meters empty.
+#
+# Parameters:
+#   frames - a dict of server number -> aligned dataframe for the gateways
+#            that succeeded
+#   gateways - the building's gateways
+#   zones - the compiled zone mapping
+# Returns:
+#   a list with one dataframe per server, in server number order
+# ---------------------
+def missingFrames(frames, gateways, zones):
+    index = next(iter(frames.values())).index
+    filled = []
+    for num in range(1, max(gw["num"] for gw in gateways) + 1):
+        if num in frames:
+            filled.append(frames[num])
+        else:
+            meters = [meter for server, meter in zones["meters"] if server == num]
+            filled.append(pd.DataFrame(np.nan, index=index, columns=meters))
+    return filled
+
+
+# Function: get_data_from_range
+# ---------------------
+# This function connects to the Eaton Power Xpert Gateway servers and downloads the
+# energy data for the given range. The function then returns the data as a dataframe.
+# The days are shared out over a small pool of SFTP sessions, each file is parsed as
+# soon as it arrives and all days are concatenated once at the end.
+#
+# Parameters:
+#   FTP_HOST - the IP address of the server
+#   FTP_USER - the username
+#   FTP_PASS - the password
+#   SERVER_NUM - the server number (1, 2, or 3)
+#   start - the start date in the format "YYYY-MM-DD"
+#   end - the end date in the format "YYYY-MM-DD"
+#   sessions - how many SFTP sessions download days at the same time
+#              (defaults to BACKFILL_SESSIONS or 3)
+# Returns:
+#   master_df - a dataframe with every day's rows in date order
+# ---------------------
+
+
+@timed("backfill")
+def get_data_from_range(FTP_HOST, FTP_USER, FTP_PASS, start, end, sessions=None):
+    my_tz = pytz.timezone("US/Pacific")
+    today = datetime.now(my_tz).date()
+    start_date = datetime.strptime(start, "%Y-%m-%d")
+    end_date = datetime.strptime(end, "%Y-%m-%d")
+    days_between = (end_date - start_date).days
+
+    if days_between < 0:
+        logging.error("Start date is after end date")
+        return None
+    elif start_date.date() > today:
+        logging.error("Start date is in the future")
+        return None
+    elif end_date.date() > today:
+        logging.error("End date is in the future")
+        return None
+
+    # Past days that were downloaded before come from the local cache
+    cache = get_trend_cache()
+    frames = [None] * (days_between + 1)
+    days = []
+    for i in range(days_between + 1):
+        if cache is not None:
+            frames[i] = cache.get(FTP_HOST, start_date + timedelta(days=i))
+        if frames[i] is None:
+            days.append(start_date + timedelta(days=i))
+    if not days:
+        print("All days for " + start + " to " + end + " found in the cache")
+        return pd.concat(frames)
+
+    def parse(day, fh):
+        i = (day - start_date).days
+        frames[i] = readTrend(fh)
+        countDownload(FTP_HOST, fh.tell(), len(frames[i]))
+        if cache is not None:
+            cache.put(FTP_HOST, day, frames[i])
+
+    print("Attempting to download data from range:" + start + " to " + end)
+    downloadDays(FTP_HOST, FTP_USER, FTP_PASS, days, parse, sessions)
+
+    if cache is not None:
+        cache.evict()
+
+    # Combine the days once, in date order
+    master_df = pd.concat(frames)
+    print("Successfully downloaded data from range")
+    print("there are:" + str(len(master_df)) + " rows")
+    return master_df
+
+
+# Function: downloadDays
+# ---------------------
+# This function downloads the trend files for a list of days over a small pool
+# of SFTP sessions. Each session takes the next day off a shared queue until
+# none are left, and hands the open file to handle as soon as it arrives.
+# A session that loses its connection puts its day back, reconnects after a
+# backoff and carries on, up to FETCH_RETRIES times in a row.
+#
+# Parameters:
+#   FTP_HOST - the IP address of the server
+#   FTP_USER - the username
+#   FTP_PASS - the password
+#   days - the dates to download
+#   handle - a function called with (day, file handle) for every day, from the
+#            session threads
+#   sessions - how many SFTP sessions download days at the same time
+#              (defaults to BACKFILL_SESSIONS or 3)
+# Returns:
+#   None
+# ---------------------
+def downloadDays(FTP_HOST, FTP_USER, FTP_PASS, days, handle, sessions=None):
+    queue = Queue()
+    for day in days:
+        queue.put(day)
+    if sessions is None:
+        sessions = int(os.getenv("BACKFILL_SESSIONS", "3"))
+    sessions = max(1, min(sessions, queue.qsize()))
+
+    retries = int(os.getenv("FETCH_RETRIES", "2"))
+    base = float(os.getenv("FETCH_BACKOFF", "1"))
+    cap = float(os.getenv("FETCH_BACKOFF_MAX", "30"))
+
+    def download_days():
+        attempt = 0
+        while not queue.empty():
+            try:
+                with connect_sftp(FTP_HOST, FTP_USER, FTP_PASS) as sftp:
+                    sftp.chdir("trend")
+                    while True:
+                        try:
+                            day = queue.get_nowait()
+                        except Empty:
+                            return
+                        Fdate = day.strftime("%Y%m%d")
+                        print("Downloading file for:" + Fdate)
+                        try:
+                            with openTrend(sftp, "Trend_Virtual_Meter_Watt_" + Fdate + ".csv") as fh:
+                                handle(day, fh)
+                        except Exception:
+                            queue.put(day)
+                            raise
+                        attempt = 0
+            except Exception as e:
+                # Reconnect and carry on with the same day after a network error
+                if attempt >= retries or not isTransient(e):
+                    raise
+                delay = backoff(attempt, base, cap)
+                logging.warning(FTP_HOST + " failed (" + str(e) + "), reconnecting in " + "%.1fs" % delay)
+                time.sleep(delay)
+                attempt += 1
+
+    with ThreadPoolExecutor(max_workers=sessions) as pool:
+        futures = [pool.submit(download_days) for _ in range(sessions)]
+        for future in futures:
+            future.result()
+
+
+# Function: get_trend_cache
+# ---------------------
+# This function returns the process-wide cache of past days' trend files, or
+# None when it is switched off with TREND_CACHE_DIR="" or pyarrow is not
+# installed. Its size and age limits come from TREND_CACHE_MAX_MB and
+# TREND_CACHE_MAX_AGE_DAYS.
+#
+# Parameters:
+#   None
+# Returns:
+#   The shared TrendCache or None
+# ---------------------
+_trend_cache = None
+_trend_cache_lock = threading.Lock()
+
+
+def get_trend_cache():
+    global _trend_cache
+    with _trend_cache_lock:
+        if _trend_cache is None:
+            load_dotenv()
+            directory = os.getenv("TREND_CACHE_DIR", os.path.join("state", "trend_cache"))
+            if not directory:
+                _trend_cache = False
+            elif importlib.util.find_spec("pyarrow") is None:
+                logging.warning("pyarrow is not installed, trend cache disabled")
+                _trend_cache = False
+            else:
+                from trendcache import TrendCache
+
+                _trend_cache = TrendCache(
+                    directory,
+                    max_bytes=int(os.getenv("TREND_CACHE_MAX_MB", "500")) * 2**20,
+                    max_age_days=int(os.getenv("TREND_CACHE_MAX_AGE_DAYS", "365")),
+                )
+    return _trend_cache or None
+
+
+# Function: archiveData
+# ---------------------
+# This function appends the new rows of the master dataframe to the table's
+# local Parquet archive. The archive is a convenience copy, so a failure is
+# logged and does not stop the upload.
+#
+# Parameters:
+#   master_df - a dataframe containing the processed energy data
+#   table - the table the data is uploaded to
+# Returns:
+#   the number of rows archived
+# ---------------------
+@timed("archiveData")
+def archiveData(master_df, table):
+    archive = get_archive(table)
+    if archive is None:
+        return 0
+    try:
+        written = archive.append(master_df)
+    except Exception as e:
+        logging.error("Archiving failed: " + str(e))
+        return 0
+    logging.info("Archived " + str(written) + " rows")
+    return written
+
+
+# Function: get_archive
+# ---------------------
+# This function returns the local Parquet archive of processed data for a
+# table, kept under ARCHIVE_DIR/<table>. It returns None when the archive is
+# switched off with ARCHIVE_DIR="" or pyarrow is not installed.
+#
+# Parameters:
+#   table - the table the processed data is uploaded to
+# Returns:
+#   The table's Archive or None
+# ---------------------
+_archives = {}
+
+
+def get_archive(table):
+    load_dotenv()
+    directory = os.getenv("ARCHIVE_DIR", os.path.join("state", "archive"))
+    if not directory or importlib.util.find_spec("pyarrow") is None:
+        return None
+    from archive import Archive
+
+    with _trend_cache_lock:
+        if table not in _archives:
+            _archives[table] = Archive(os.path.join(directory, table))
+    return _archives[table]
+
+
+# Function: rollupData
+# ---------------------
+# This function adds the master dataframe to the table's hourly, daily and
+# monthly kWh rollups. Only intervals that are new or changed are written and
+# only their buckets are summed again. Like the archive, the rollups are a
+# local convenience copy, so a failure is logged and does not stop the upload.
+#
+# Parameters:
+#   master_df - a dataframe containing the processed energy data
+#   table - the table the data is uploaded to
+# Returns:
+#   the number of intervals written
+# ---------------------
+@timed("rollupData")
+def rollupData(master_df, table):
+    rollups = get_rollups(table)
+    if rollups is None:
+        return 0
+    try:
+        written = rollups.update(master_df)
+    except Exception as e:
+        logging.error("Updating rollups failed: " + str(e))
+        return 0
+    logging.info("Rolled up " + str(written) + " intervals")
+    return written
+
+
+# Function: get_rollups
+# ---------------------
+# This function returns the kWh rollups for a table, kept in
+# ROLLUP_DIR/<table>.sqlite. It returns None when the rollups are switched off
+# with ROLLUP_DIR="".
+#
+# Parameters:
+#   table - the table the processed data is uploaded to
+# Returns:
+#   The table's Rollups or None
+# ---------------------
+_rollups = {}
+
+
+def get_rollups(table):
+    load_dotenv()
+    directory = os.getenv("ROLLUP_DIR", os.path.join("state", "rollups"))
+    if not directory:
+        return None
+    from rollups import Rollups
+
+    with _trend_cache_lock:
+        if table not in _rollups:
+            _rollups[table] = Rollups(os.path.join(directory, str(table) + ".sqlite"))
+    return _rollups[table]
+
+
+# Function: bufferData
+# ---------------------
+# This function adds the intervals of the master dataframe that are newer than
+# the ones held to the table's in-memory ring buffer, which the read API
+# serves. The rows added are also kept until drainReadings is called, so a
+# worker process can hand them to the process that runs the API.
+#
+# Parameters:
+#   master_df - a dataframe containing the processed energy data
+#   table - the table the data is uploaded to
+# Returns:
+#   the number of intervals added
+# ---------------------
+@timed("bufferData")
+def bufferData(master_df, table):
+    ring = get_ring(table, master_df.columns)
+    if ring is None or master_df.empty:
+        return 0
+    times, values = frameArrays(master_df, ring.columns)
+    added = ring.append(times, values)
+    if added.any():
+        with _rings_lock:
+            _ring_pending.setdefault(table, []).append((times[added], values[added]))
+    return int(added.sum())
+
+
+# Function: frameArrays
+# ---------------------
+# This function turns a master dataframe into the arrays a RingBuffer holds.
+#
+# Parameters:
+#   master_df - a dataframe with a Time column
+#   columns - the value columns, in order, missing ones are NaN
+# Returns:
+#   times - the times as UTC nanoseconds
+#   values - a float64 array with one column per column
+# ---------------------
+def frameArrays(master_df, columns):
+    times = pd.DatetimeIndex(master_df["Time"])
+    if times.tz is None:
+        times = times.tz_localize("US/Pacific", ambiguous="infer")
+    times = times.tz_convert("UTC").as_unit("ns").asi8
+    values = master_df.reindex(columns=columns).to_numpy(dtype="float64")
+    return times, values
+
+
+# Function: get_ring
+# ---------------------
+# This function returns the ring buffer of the last READINGS_DAYS days
+# (default 7) of a table's processed intervals. The buffer is made the first
+# time the table's data is added, with the given columns, and filled from the
+# local archive so the read API has the whole window straight after a
+# restart. It returns None when READINGS_DAYS is 0, or when the table has no
+# buffer yet and no columns are given.
+#
+# Parameters:
+#   table - the table the processed data is uploaded to
+#   columns - the master dataframe columns, used to make the buffer
+# Returns:
+#   The table's RingBuffer or None
+# ---------------------
+_rings = {}
+_ring_pending = {}
+_rings_lock = threading.Lock()
+
+
+def get_ring(table, columns=None):
+    with _rings_lock:
+        ring = _rings.get(table)
+    if ring is not None or columns is None:
+        return ring
+    load_dotenv()
+    days = float(os.getenv("READINGS_DAYS", "7"))
+    if days <= 0:
+        return None
+
+    from ringbuffer import RingBuffer
+
+    ring = RingBuffer([column for column in columns if column != "Time"], int(days * 288))
+    archive = get_archive(table)
+    if archive is not None:
+        try:
+            recent = archive.read(start=pd.Timestamp.now(tz="UTC") - pd.Timedelta(days=days))
+            if not recent.empty:
+                ring.append(*frameArrays(recent, ring.columns))
+        except Exception as e:
+            logging.error("Filling the ring buffer from the archive failed: " + str(e))
+    with _rings_lock:
+        return _rings.setdefault(table, ring)
+
+
+# Function: get_rings
+# ---------------------
+# This function returns the ring buffers made so far.
+#
+# Parameters:
+#   None
+# Returns:
+#   a dict of table -> RingBuffer
+# ---------------------
+def get_rings():
+    with _rings_lock:
+        return dict(_rings)
+
+
+# Function: drainReadings
+# ---------------------
+# This function returns the intervals added to the ring buffers since the last
+# call and forgets them. Worker processes send these to the parent, which adds
+# them with mergeReadings.
+#
+# Parameters:
+#   None
+# Returns:
+#   a dict of table -> (columns, times, values)
+# ---------------------
+def drainReadings():
+    with _rings_lock:
+        pending = dict(_ring_pending)
+        _ring_pending.clear()
+        columns = {table: _rings[table].columns for table in pending}
+    return {
+        table: (
+            columns[table],
+            np.concatenate([times for times, _ in parts]),
+            np.concatenate([values for _, values in parts]),
+        )
+        for table, parts in pending.items()
+    }
+
+
+# Function: mergeReadings
+# ---------------------
+# This function adds intervals returned by another process's drainReadings to
+# this process's ring buffers.
+#
+# Parameters:
+#   readings - a dict of table -> (columns, times, values)
+# Returns:
+#   None
+# ---------------------
+def mergeReadings(readings):
+    for table, (columns, times, values) in readings.items():
+        ring = get_ring(table, columns)
+        if ring is None:
+            continue
+        if ring.columns != columns:
+            values = pd.DataFrame(values, columns=columns).reindex(columns=ring.columns)
+            values = values.to_numpy(dtype="float64")
+        ring.append(times, values)
+
+
+# *****************************************************************************
+# The following functions are used to connect to the SQL database
+# *****************************************************************************
+
+# Columns of the master dataframe and the database columns they are written to
+UPLOAD_COLUMNS = {
+    "Time": "dateTime",
+    "1st_Floor": "First_Floor",
+    "2nd_Floor": "Second_Floor",
+    "3rd_Floor": "Third_Floor",
+    "4th_Floor": "Fourth_Floor",
+    "Utilities": "Utilities",
+    "Total": "TOTAL",
+    "1st_Floor_Kwh": "First_Floor_Kwh",
+    "2nd_Floor_Kwh": "Second_Floor_Kwh",
+    "3rd_Floor_Kwh": "Third_Floor_Kwh",
+    "4th_Floor_Kwh": "Fourth_Floor_Kwh",
+    "Utilities_Kwh": "Utilities_Kwh",
+    "Total_Kwh": "TOTAL_Kwh",
+}
+
+
+# Function: uploadData
+# ---------------------
+# This function uploads every row of the master dataframe that is newer than the
+# last time in the SQL database, so intervals from missed runs are caught up too.
+# The rows are written in one batch with a single commit. With the outbox on
+# (see get_outbox) the rows newer than the last uploaded or queued time are
+# added to the outbox instead, and the drainer writes them to the database.
+#
+# Parameters:
+#   master_df - a dataframe containing the energy data
+#   table - the table to upload to
+#   columns - the master dataframe columns and the database columns they are
+#             written to (defaults to UPLOAD_COLUMNS)
+# Returns:
+#   the number of rows written
+# ---------------------
+
+
+@timed("uploadData")
+def uploadData(master_df, table, columns=None):
+    # The database stores local wall-clock times
+    master_df = master_df.assign(Time=localTimes(master_df["Time"]))
+    outbox = get_outbox()
+    if outbox is None:
+        DB_Last_time = Uploaded_time = get_high_water_mark(table)
+    else:
+        DB_Last_time = queuedHighWaterMark(table, outbox)
+        Uploaded_time = get_checkpoints().get(table)
+    Server_Last_time = master_df["Time"].iloc[-1]
+    print("DB_Last: " + str(DB_Last_time))
+    print("Server_Last: " + str(Server_Last_time))
+    if Uploaded_time is not None:
+        get_metrics().set(
+            "emd_upload_lag_seconds",
+            (Server_Last_time - Uploaded_time).total_seconds(),
+            table=table,
+        )
+
+    if DB_Last_time is None:
+        new_rows = master_df
+    else:
+        new_rows = master_df[master_df["Time"] > DB_Last_time]
+
+    if new_rows.empty:
+        if DB_Last_time == Server_Last_time:
+            print("No new data to upload")
+        else:
+            print("Server data is older than DB data, exiting...")
+        return 0
+
+    if columns is None:
+        columns = UPLOAD_COLUMNS
+    if outbox is not None:
+        queued = outbox.put(table, new_rows[list(columns)].rename(columns=columns))
+        print("Queued " + str(queued) + " new rows for the DB")
+        logging.info("Queued " + str(queued) + " new rows for the DB")
+        return queued
+
+    print("Uploading " + str(len(new_rows)) + " new rows to DB")
+    with get_conn() as conn:
+        try:
+            written = insertRows(conn, table, new_rows, columns)
+        except Exception as e:
+            print("Error executing SQL statement: {}".format(e))
+            conn.rollback()
+            # The checkpoint may have drifted from the database, check it next time
+            get_checkpoints().invalidate(table)
+            return 0
+    get_checkpoints().set(table, new_rows["Time"].max())
+    get_metrics().inc("emd_rows_uploaded_total", written, table=table)
+    print("Uploaded " + str(written) + " rows to DB")
+    logging.info("Uploaded " + str(written) + " rows to DB")
+    return written
+
+
+# Function: localTimes
+# ---------------------
+# This function converts tz-aware times to naive US/Pacific wall-clock times,
+# which is how the database stores them. Naive times are returned unchanged.
+#
+# Parameters:
+#   times - a Series of times
+# Returns:
+#   a Series of naive times
+# ---------------------
+def localTimes(times):
+    if times.dt.tz is None:
+        return times
+    return times.dt.tz_convert("US/Pacific").dt.tz_localize(None)
+
+
+# Function: insertRows
+# ---------------------
+# This function writes the rows of a master dataframe to a table with one
+# executemany call and commits once. pyodbc's fast_executemany is switched on
+# when the driver supports it so the batch is sent in a single round trip.
+#
+# Parameters:
+#   conn - an open database connection
+#   table - the table to insert into
+#   rows - a dataframe with the columns being written
+#   columns - the dataframe columns and the database columns they are written
+#             to, Time first (defaults to UPLOAD_COLUMNS)
+# Returns:
+#   the number of rows written
+# ---------------------
+def insertRows(conn, table, rows, columns=None):
+    if rows.empty:
+        return 0
+    if columns is None:
+        columns = UPLOAD_COLUMNS
+    executeRows(conn.cursor(), table, rows, columns)
+    conn.commit()
+    return len(rows)
+
+
+# Function: executeRows
+# ---------------------
+# This function inserts the rows of a master dataframe into a table with one
+# executemany call, without committing.
+#
+# Parameters:
+#   cursor - a cursor of an open database connection
+#   table - the table to insert into
+#   rows - a dataframe with the columns being written
+#   columns - the dataframe columns and the database columns they are written
+#             to, Time first
+#   sizes - the parameter types passed to cursor.setinputsizes, one per
+#           column, or None to let the driver work them out
+# Returns:
+#   None
+# ---------------------
+def executeRows(cursor, table, rows, columns, sizes=None):
+    placeholders = ", ".join("?" * len(columns))
+    # pyodbc needs plain datetimes and None for missing values
+    values = [rows["Time"].dt.to_pydatetime()]
+    for column in list(columns)[1:]:
+        values.append(rows[column].astype(object).where(rows[column].notna(), None))
+    names = ", ".join(columns.values())
+
+    if hasattr(cursor, "fast_executemany"):
+        cursor.fast_executemany = True
+    if sizes is not None:
+        cursor.setinputsizes(sizes)
+    cursor.executemany(
+        f"INSERT INTO {table} ({names}) VALUES ({placeholders})",
+        list(zip(*values)),
+    )
+
+
+# Function: backfillData
+# ---------------------
+# This function uploads the rows of the master dataframe that are not in the
+# table yet, whatever their time, for reloading past days. uploadData only
+# writes rows newer than the last time in the table, so it cannot fill in
+# history. The checkpoint is invalidated so the next cycle reads the new last
+# time from the database.
+#
+# Parameters:
+#   master_df - a dataframe containing the energy data
+#   table - the table to upload to
+#   columns - the master dataframe columns and the database columns they are
+#             written to (defaults to UPLOAD_COLUMNS)
+# Returns:
+#   the number of rows written
+# ---------------------
+@timed("backfillData")
+def backfillData(master_df, table, columns=None):
+    if master_df.empty:
+        return 0
+    master_df = master_df.assign(Time=localTimes(master_df["Time"]))
+    first, last = master_df["Time"].min(), master_df["Time"].max()
+    with get_conn() as conn:
+        try:
+            written = insertMissing(conn, table, master_df, columns)
+        except Exception:
+            conn.rollback()
+            raise
+    if not written:
+        print("No new rows between " + str(first) + " and " + str(last))
+        return 0
+    get_checkpoints().invalidate(table)
+    get_metrics().inc("emd_rows_uploaded_total", written, table=table)
+    print("Uploaded " + str(written) + " rows between " + str(first) + " and " + str(last))
+    logging.info("Uploaded " + str(written) + " rows between " + str(first) + " and " + str(last))
+    return written
+
+
+# Function: insertMissing
+# ---------------------
+# This function inserts the rows of a master dataframe whose times are not in
+# the table yet and commits once.
+#
+# Parameters:
+#   conn - an open database connection
+#   table - the table to insert into
+#   rows - a dataframe with the columns being written, local times
+#   columns - the dataframe columns and the database columns they are written
+#             to, Time first (defaults to UPLOAD_COLUMNS)
+# Returns:
+#   the number of rows written
+# ---------------------
+def insertMissing(conn, table, rows, columns=None):
+    if columns is None:
+        columns = UPLOAD_COLUMNS
+    key = list(columns.values())[0]
+    cursor = conn.cursor()
+    cursor.execute(
+        f"SELECT {key} FROM {table} WHERE {key} >= ? AND {key} <= ?",
+        (rows["Time"].min().to_pydatetime(), rows["Time"].max().to_pydatetime()),
+    )
+    existing = pd.to_datetime([row[0] for row in cursor.fetchall()])
+    return insertRows(conn, table, rows[~rows["Time"].isin(existing)], columns)
+
+
+# Function: get_outbox
+# ---------------------
+# This function returns the process-wide outbox when OUTBOX_ENABLED is set (it
+# is in daemon mode). The file is OUTBOX_PATH, state/outbox.sqlite by default.
+#
+# Parameters:
+#   None
+# Returns:
+#   The shared Outbox, or None when the outbox is off
+# ---------------------
+_outbox = None
+
+
+def get_outbox():
+    global _outbox
+    load_dotenv()
+    if os.getenv("OUTBOX_ENABLED", "0") in ("0", ""):
+        return None
+    from outbox import Outbox
+
+    with _pool_lock:
+        if _outbox is None:
+            _outbox = Outbox(os.getenv("OUTBOX_PATH", os.path.join("state", "outbox.sqlite")))
+    return _outbox
+
+
+# Function: queuedHighWaterMark
+# ---------------------
+# This function returns the last time uploaded or waiting in the outbox for a
+# table from the checkpoint and the outbox only. The database is never asked,
+# so a slow or unreachable database does not hold up the cycle: the drainer
+# reconciles the checkpoints instead (see reconcileCheckpoints). With neither
+# it returns None and the whole frame is queued, the drainer skips the rows
+# the table already has.
+#
+# Parameters:
+#   table - the table to check
+#   outbox - the Outbox
+# Returns:
+#   The last uploaded or queued time, or None
+# ---------------------
+def queuedHighWaterMark(table, outbox):
+    known = [last for last in (get_checkpoints().get(table), outbox.last_time(table)) if last is not None]
+    return max(known) if known else None
+
+
+# Function: reconcileCheckpoints
+# ---------------------
+# This function checks the checkpoints that are stale or due for their
+# periodic reconcile against the database, for the outbox drainer, which
+# calls it after every drain. The last time read from the database replaces
+# the checkpoint. Raises if the database cannot be reached, so the drainer
+# backs off before it tries again.
+#
+# Parameters:
+#   None
+# Returns:
+#   the tables that were reconciled
+# ---------------------
+def reconcileCheckpoints():
+    store = get_checkpoints()
+    reconciled = []
+    for table in store.tables():
+        if store.needs_reconcile(table):
+            get_high_water_mark(table)
+            reconciled.append(table)
+    return reconciled
+
+
+# Function: flushOutbox
+# ---------------------
+# This function writes a batch of outbox rows to the database, skipping the
+# ones the table already has, and moves the checkpoint forward. It is the
+# drainer's flush function.
+#
+# Parameters:
+#   table - the table to write to
+#   rows - a batch from Outbox.peek
+# Returns:
+#   the number of rows written
+# ---------------------
+@timed("flushOutbox")
+def flushOutbox(table, rows):
+    names = list(rows.columns)
+    columns = {"Time": names[0], **{name: name for name in names[1:]}}
+    rows = rows.rename(columns={names[0]: "Time"})
+    with get_conn() as conn:
+        try:
+            written = insertMissing(conn, table, rows, columns)
+        except Exception:
+            conn.rollback()
+            raise
+    store = get_checkpoints()
+    last_time = rows["Time"].max().to_pydatetime()
+    if store.get(table) is None or store.get(table) < last_time:
+        store.set(table, last_time)
+    get_metrics().inc("emd_rows_uploaded_total", written, table=table)
+    logging.info("Flushed " + str(written) + " rows from the outbox to " + table)
+    return written
+
+
+# Function: startDrainer
+# ---------------------
+# This function starts the thread that writes the outbox to the database,
+# OUTBOX_BATCH rows at a time (default 5000), when the outbox is on.
+#
+# Parameters:
+#   None
+# Returns:
+#   The running Drainer, or None when the outbox is off
+# ---------------------
+def startDrainer():
+    outbox = get_outbox()
+    if outbox is None:
+        return None
+    from outbox import Drainer
+
+    return Drainer(
+        outbox,
+        flushOutbox,
+        reconcile=reconcileCheckpoints,
+        batch=int(os.getenv("OUTBOX_BATCH", "5000")),
+        cap=float(os.getenv("OUTBOX_BACKOFF_MAX", "60")),
+    ).start()
+
+
+# Function: mergeData
+# ---------------------
+# This function writes every row of the master dataframe to the table, adding
+# the missing ones and replacing the ones whose values changed, for applying
+# corrected or reprocessed intervals. uploadData and backfillData never change
+# a row that is already in the table. The rollups are not touched, call
+# rollupData as well.
+#
+# Parameters:
+#   master_df - a dataframe containing the energy data
+#   table - the table to upload to
+#   columns - the master dataframe columns and the database columns they are
+#             written to (defaults to UPLOAD_COLUMNS)
+# Returns:
+#   a dict with the number of rows inserted, updated and unchanged
+# ---------------------
+@timed("mergeData")
+def mergeData(master_df, table, columns=None):
+    if master_df.empty:
+        return {"inserted": 0, "updated": 0, "unchanged": 0}
+    master_df = master_df.assign(Time=localTimes(master_df["Time"]))
+    first, last = master_df["Time"].min(), master_df["Time"].max()
+    with get_conn() as conn:
+        try:
+            counts = mergeRows(conn, table, master_df, columns)
+        except Exception:
+            conn.rollback()
+            raise
+    get_checkpoints().invalidate(table)
+    get_metrics().inc(
+        "emd_rows_uploaded_total", counts["inserted"] + counts["updated"], table=table
+    )
+    message = (
+        "Merged rows between " + str(first) + " and " + str(last) + ": "
+        + str(counts["inserted"]) + " inserted, "
+        + str(counts["updated"]) + " updated, "
+        + str(counts["unchanged"]) + " unchanged"
+    )
+    print(message)
+    logging.info(message)
+    return counts
+
+
+# Function: mergeRows
+# ---------------------
+# This function upserts the rows of a master dataframe by dateTime. The rows
+# are loaded into a temporary staging table with one executemany call and
+# applied with the set-based statements from mergeStatements. Rows whose
+# values all match the table are left alone. When a time appears more than
+# once, e.g. in the repeated hour at the end of daylight saving time, the last
+# row is used. Commits once.
+#
+# Parameters:
+#   conn - an open database connection
+#   table - the table to write to
+#   rows - a dataframe with the columns being written, local times
+#   columns - the dataframe columns and the database columns they are written
+#             to, Time first (defaults to UPLOAD_COLUMNS)
+#   dialect - "mssql" or "sqlite" (defaults to SQL_DIALECT, then "mssql")
+# Returns:
+#   a dict with the number of rows inserted, updated and unchanged
+# ---------------------
+def mergeRows(conn, table, rows, columns=None, dialect=None):
+    if rows.empty:
+        return {"inserted": 0, "updated": 0, "unchanged": 0}
+    if columns is None:
+        columns = UPLOAD_COLUMNS
+    if dialect is None:
+        dialect = os.getenv("SQL_DIALECT", "mssql")
+    rows = rows.drop_duplicates(subset="Time", keep="last")
+    stage, prepare, apply, cleanup = mergeStatements(table, list(columns.values()), dialect)
+
+    cursor = conn.cursor()
+    for statement in prepare:
+        cursor.execute(statement)
+    # pyodbc cannot look up the column types of a SQL Server temporary table
+    sizes = stageSizes(len(columns)) if dialect == "mssql" else None
+    executeRows(cursor, stage, rows, columns, sizes=sizes)
+    # The first statement returns the counts, before the rows are changed
+    cursor.execute(apply[0])
+    inserted, updated = cursor.fetchone()
+    for statement in apply[1:] + cleanup:
+        cursor.execute(statement)
+    conn.commit()
+    return {
+        "inserted": int(inserted),
+        "updated": int(updated),
+        "unchanged": len(rows) - int(inserted) - int(updated),
+    }
+
+
+# Function: mergeStatements
+# ---------------------
+# This function builds the statements mergeRows runs for a database dialect.
+# "mssql" is the production Azure SQL database: one MERGE that reports its
+# counts through OUTPUT $action. "sqlite" is the stand-in the tests and
+# benchmarks use: a counting SELECT, an UPDATE ... FROM and an INSERT. Only the
+# SQLite statements are executed by tests/test_merge.py; the MERGE is checked
+# as text there and has to be tried against SQL Server when it changes.
+#
+# Parameters:
+#   table - the table to write to
+#   names - the database columns, the dateTime key first
+#   dialect - "mssql" or "sqlite"
+# Returns:
+#   stage - the staging table the rows are loaded into
+#   prepare - the statements that create the staging table
+#   apply - the statements that write the staged rows, the first one
+#           returning (inserted, updated)
+#   cleanup - the statements that drop the staging table
+# ---------------------
+def mergeStatements(table, names, dialect):
+    key, fields = names[0], names[1:]
+    listed = ", ".join(names)
+    # EXCEPT compares NULLs as equal, unlike =
+    changed = (
+        "EXISTS (SELECT " + ", ".join("s." + field for field in fields)
+        + " EXCEPT SELECT " + ", ".join("t." + field for field in fields) + ")"
+    )
+    assignments = ", ".join(field + " = s." + field for field in fields)
+
+    if dialect == "sqlite":
+        return (
+            "temp.stage",
+            [
+                "DROP TABLE IF EXISTS temp.stage",
+                f"CREATE TEMP TABLE stage AS SELECT {listed} FROM {table} LIMIT 0",
+            ],
+            [
+                f"SELECT COUNT(*) - COUNT(t.{key}), "
+                f"COALESCE(SUM(t.{key} IS NOT NULL AND {changed}), 0) "
+                f"FROM temp.stage s LEFT JOIN {table} t ON t.{key} = s.{key}",
+                f"UPDATE {table} AS t SET {assignments} FROM temp.stage s "
+                f"WHERE t.{key} = s.{key} AND {changed}",
+                f"INSERT INTO {table} ({listed}) SELECT {listed} FROM temp.stage s "
+                f"WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE t.{key} = s.{key})",
+            ],
+            ["DROP TABLE temp.stage"],
+        )
+    if dialect == "mssql":
+        # Not run by the tests, there is no SQL Server stand-in
+        return (
+            "#stage",
+            [
+                "IF OBJECT_ID('tempdb..#stage') IS NOT NULL DROP TABLE #stage",
+                f"SELECT TOP 0 {listed} INTO #stage FROM {table}",
+            ],
+            [
+                "SET NOCOUNT ON; "
+                "DECLARE @actions TABLE (action NVARCHAR(10)); "
+                f"MERGE {table} WITH (HOLDLOCK) AS t USING #stage AS s ON t.{key} = s.{key} "
+                f"WHEN MATCHED AND {changed} THEN UPDATE SET {assignments} "
+                f"WHEN NOT MATCHED BY TARGET THEN INSERT ({listed}) "
+                "VALUES (" + ", ".join("s." + name for name in names) + ") "
+                "OUTPUT $action INTO @actions; "
+                "SELECT COUNT(CASE WHEN action = 'INSERT' THEN 1 END), "
+                "COUNT(CASE WHEN action = 'UPDATE' THEN 1 END) FROM @actions;"
+            ],
+            ["DROP TABLE #stage"],
+        )
+    raise ValueError("Unknown SQL_DIALECT: " + dialect)
+
+
+# Function: stageSizes
+# ---------------------
+# This function returns the parameter types for loading the SQL Server staging
+# table. With fast_executemany, pyodbc asks the server for the types of the
+# columns it inserts into, which fails with "Invalid object name '#stage'"
+# for a local temporary table, so the types are given up front: the dateTime
+# key as a datetime and the readings as floats. Setting UseFMTONLY=Yes in
+# SQL_CONNECTION_STRING works around the same problem.
+#
+# Parameters:
+#   count - the number of columns, the dateTime key first
+# Returns:
+#   a list of (SQL type, size, decimal digits) for cursor.setinputsizes
+# ---------------------
+def stageSizes(count):
+    return [(pyodbc.SQL_TYPE_TIMESTAMP, 23, 3)] + [(pyodbc.SQL_DOUBLE, 0, 0)] * (count - 1)
+
+
+# Function: get_high_water_mark
+# ---------------------
+# This function returns the last uploaded time for a table from the local
+# checkpoint store. The database is only queried when the checkpoint is
+# missing, stale or due for its periodic reconcile.
+#
+# Parameters:
+#   table - the table to check
+# Returns:
+#   The last uploaded time, or None if the table is empty
+# ---------------------
+def get_high_water_mark(table):
+    store = get_checkpoints()
+    if store.needs_reconcile(table):
+        last_time = get_last_time(table)
+        store.set(table, last_time, reconciled=True)
+        return last_time
+    return store.get(table)
+
+
+# Function: get_checkpoints
+# ---------------------
+# This function returns the process-wide checkpoint store. The files are kept
+# in CHECKPOINT_DIR and reconciled with the database every
+# CHECKPOINT_RECONCILE_SECONDS.
+#
+# Parameters:
+#   None
+# Returns:
+#   The shared CheckpointStore
+# ---------------------
+_checkpoints = None
+
+
+def get_checkpoints():
+    global _checkpoints
+    if _checkpoints is None:
+        load_dotenv()
+        _checkpoints = CheckpointStore(
+            os.getenv("CHECKPOINT_DIR", "state"),
+            reconcile_seconds=int(os.getenv("CHECKPOINT_RECONCILE_SECONDS", "3600")),
+        )
+    return _checkpoints
+
+
+# Function: get_last_time
+# ---------------------
+# This function gets the last time from the SQL database.
+#
+# Parameters:
+#   table - the table to check (defaults to SQL_TABLE)
+# Returns:
+#   The last time from the SQL database
+def get_last_time(table=None):
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        if table is None:
+            load_dotenv()
+            table = os.getenv("SQL_TABLE")
+        logging.info("Getting last time from DB")
+        print("Getting last time from DB")
+        cursor.execute(f"SELECT MAX(dateTime) FROM {table}")
+        last_time = cursor.fetchone()[0]
+        if last_time is None:
+            logging.warning("database is empty")
+            return None
+        # Drivers without a native datetime type return it as text
+        if isinstance(last_time, str):
+            last_time = datetime.fromisoformat(last_time)
+        return last_time
+
+
+# Function: get_conn
+# ---------------------
+# This function checks out a connection to the SQL database from the shared
+# connection pool. Use it in a with block, the connection is committed and
+# handed back to the pool when the block ends.
+#
+# Parameters:
+#   None
+# Returns:
+#   A pooled connection to the SQL database
+# ---------------------
+def get_conn():
+    return get_pool().connection()
+
+
+# Function: get_pool
+# ---------------------
+# This function returns the process-wide database connection pool, creating it
+# on first use. The pool size comes from SQL_POOL_SIZE.
+#
+# Parameters:
+#   None
+# Returns:
+#   The shared ConnectionPool
+# ---------------------
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            load_dotenv()
+            _pool = ConnectionPool(
+                connect_db, size=int(os.getenv("SQL_POOL_SIZE", "2"))
+            )
+    return _pool
+
+
+# Function: connect_db
+# ---------------------
+# This function opens a new connection to the SQL database.
+#
+# Parameters:
+#   None
+# Returns:
+#   A connection to the SQL database
+# ---------------------
+def connect_db():
+    print("Getting connection to database")
     connection_string = os.getenv("SQL_CONNECTION_STRING")
     # credential = DefaultAzureCredential()
 
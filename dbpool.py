@@ -0,0 +1,176 @@
+# This file contains a small pool of reusable database connections.
+# Connections are opened on demand up to a fixed limit and handed back to the
+# pool after each use, so one pipeline cycle or backfill pays the ODBC/TLS
+# handshake to Azure SQL once instead of on every query.
+
+
+# Import the required libraries
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from queue import Empty, LifoQueue
+
+
+# Class: ConnectionPool
+# ---------------------
+# A bounded pool of database connections. A connection that has been idle for
+# longer than health_idle seconds is checked with health_query before it is
+# handed out and is replaced with a new one if the check fails. A connection
+# that raised while it was checked out is closed instead of being reused.
+#
+# Parameters:
+#   connect - a function that opens a new connection
+#   size - the most connections open at once
+#   timeout - how long to wait for a free connection before giving up
+#   health_query - the statement used to check an idle connection
+#   health_idle - how many idle seconds before a connection is checked
+# ---------------------
+class ConnectionPool:
+    def __init__(
+        self, connect, size=2, timeout=30, health_query="SELECT 1", health_idle=30
+    ):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.health_query = health_query
+        self.health_idle = health_idle
+        self._idle = LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._stats = {
+            "checkouts": 0,
+            "connects": 0,
+            "reconnects": 0,
+            "failed_checks": 0,
+            "checkout_seconds": 0.0,
+            "max_checkout_seconds": 0.0,
+        }
+
+    # Function: connection
+    # ---------------------
+    # Checks out a connection for the length of a with block. The work is
+    # committed when the block finishes and rolled back if it raises.
+    # ---------------------
+    @contextmanager
+    def connection(self):
+        conn = self.checkout()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            self.checkin(conn, broken=not self._rollback(conn))
+            raise
+        self.checkin(conn)
+
+    # Function: checkout
+    # ---------------------
+    # Returns a healthy connection, reusing an idle one when possible.
+    # ---------------------
+    def checkout(self):
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError(
+                "No database connection free after " + str(self.timeout) + "s"
+            )
+        try:
+            conn = self._reuse()
+            if conn is None:
+                conn = self._open("connects")
+        except Exception:
+            self._slots.release()
+            raise
+
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._stats["checkouts"] += 1
+            self._stats["checkout_seconds"] += elapsed
+            self._stats["max_checkout_seconds"] = max(
+                self._stats["max_checkout_seconds"], elapsed
+            )
+        return conn
+
+    # Function: checkin
+    # ---------------------
+    # Returns a connection to the pool, or closes it if it is broken.
+    # ---------------------
+    def checkin(self, conn, broken=False):
+        try:
+            if broken:
+                self._close(conn)
+            else:
+                self._idle.put((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    # Function: stats
+    # ---------------------
+    # Returns a copy of the pool counters, including the average checkout time.
+    # ---------------------
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        if stats["checkouts"]:
+            stats["avg_checkout_seconds"] = (
+                stats["checkout_seconds"] / stats["checkouts"]
+            )
+        else:
+            stats["avg_checkout_seconds"] = 0.0
+        return stats
+
+    # Function: close
+    # ---------------------
+    # Closes every idle connection.
+    # ---------------------
+    def close(self):
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except Empty:
+                return
+            self._close(conn)
+
+    def _reuse(self):
+        while True:
+            try:
+                conn, idle_since = self._idle.get_nowait()
+            except Empty:
+                return None
+            if time.monotonic() - idle_since < self.health_idle:
+                return conn
+            if self._healthy(conn):
+                return conn
+            logging.warning("Database connection failed health check, reconnecting")
+            with self._lock:
+                self._stats["failed_checks"] += 1
+            self._close(conn)
+            return self._open("reconnects")
+
+    def _open(self, counter):
+        conn = self.connect()
+        with self._lock:
+            self._stats[counter] += 1
+        logging.info("Opened new database connection")
+        return conn
+
+    def _healthy(self, conn):
+        try:
+            cursor = conn.cursor()
+            cursor.execute(self.health_query)
+            cursor.fetchall()
+            return True
+        except Exception:
+            return False
+
+    def _rollback(self, conn):
+        try:
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
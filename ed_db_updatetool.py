@@ -6,15 +6,26 @@
 # The program will then update the database with the new data.
 # The program will then display a message to the user indicating that the update was successful.
 # The program will then terminate.
+#
+# It can also be run without prompts, to reload long ranges unattended:
+#   python ed_db_updatetool.py backfill 2025-01-01 2025-12-31 --workers 4
+# Add --update to also correct the rows the table already has.
+# Run it with backfill --help for the options.
 
 
 # import required libraries
 # from dotenv import load_dotenv
 # import all functions from datapross.py file
 from datapross import *
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from checkpoint import read_json, write_json_atomic
+from registry import load_registry
 import os
 import logging
 import sys
+import time
 import argparse
 
 
@@ -38,6 +49,7 @@ def main():
             break
         elif choice == "2":
             # Update existing data in the database
+            update_existing_data()
             break
         elif choice == "3":
             # Create a new table for the data
@@ -48,51 +60,413 @@ def main():
             print("Invalid choice. Please try again.")
 
 
+# Function: add_new_data
+# ---------------------
+# This function asks for a building and a date range and reloads it with
+# runBackfill, one chunk at a time.
+#
+# Parameters:
+#   None
+# Returns:
+#   None
+# ---------------------
 def add_new_data():
+    building = choose_building()
+
     # Get the time period of the data to be updated
     start_date = input("Enter the start date (YYYY-MM-DD): ")
     end_date = input("Enter the end date (YYYY-MM-DD): ")
 
-    # Get the data from the servers
-    df_server1 = get_data_from_range(
-        os.getenv("FTP_HOST_1"),
-        os.getenv("FTP_USER_1"),
-        os.getenv("FTP_PASS_1"),
-        start_date,
-        end_date,
-    )
+    written, failed = runBackfill(building, start_date, end_date, checkpoint=False)
+    if failed:
+        print("Update incomplete, " + str(written) + " rows uploaded, failed: " + str(failed))
+    else:
+        print("Update successful, " + str(written) + " rows uploaded")
 
-    df_server2 = get_data_from_range(
-        os.getenv("FTP_HOST_2"),
-        os.getenv("FTP_USER_2"),
-        os.getenv("FTP_PASS_2"),
-        start_date,
-        end_date,
-    )
-    df_server3 = get_data_from_range(
-        os.getenv("FTP_HOST_3"),
-        os.getenv("FTP_USER_3"),
-        os.getenv("FTP_PASS_3"),
-        start_date,
-        end_date,
-    )
-    df_server1 = cleanData(df_server1)
-    df_server2 = cleanData(df_server2)
-    df_server3 = cleanData(df_server3)
-    dataval = CheckResData(df_server1, df_server2, df_server3)
+
+# Function: update_existing_data
+# ---------------------
+# This function asks for a building and a date range and reprocesses it with
+# runBackfill, replacing the rows whose values changed and adding the missing
+# ones.
+#
+# Parameters:
+#   None
+# Returns:
+#   None
+# ---------------------
+def update_existing_data():
+    building = choose_building()
+
+    # Get the time period of the data to be updated
+    start_date = input("Enter the start date (YYYY-MM-DD): ")
+    end_date = input("Enter the end date (YYYY-MM-DD): ")
+
+    written, failed = runBackfill(building, start_date, end_date, checkpoint=False, update=True)
+    if failed:
+        print("Update incomplete, " + str(written) + " rows written, failed: " + str(failed))
+    else:
+        print("Update successful, " + str(written) + " rows written")
+
+
+# Function: runBackfill
+# ---------------------
+# This function reloads a date range for a building one chunk at a time. Each
+# chunk of chunk_days days is downloaded, cleaned, aligned and processed (see
+# processChunk) and then uploaded before more chunks are loaded, so memory use
+# does not grow with the length of the range and the first rows reach the
+# database as soon as the first chunk is done. With more than one worker, that
+# many chunks are processed at the same time in worker processes while this
+# process uploads the finished ones.
+#
+# Finished chunks are recorded in the checkpoint file, and chunks already in it
+# are skipped, so an interrupted run picks up where it stopped when it is
+# started again. A chunk that fails is logged and left out of the checkpoint,
+# and the rest still run.
+#
+# Parameters:
+#   building - a building from the registry
+#   start - the first day in the format "YYYY-MM-DD"
+#   end - the last day in the format "YYYY-MM-DD"
+#   table - the table to upload to (defaults to the building's table)
+#   workers - how many chunks are processed at the same time
+#   chunk_days - the most days in a chunk (defaults to BACKFILL_CHUNK_DAYS or 7)
+#   checkpoint - the checkpoint file (defaults to state/backfill/<table>.json,
+#                <table>.update.json for an update, or <csv>.checkpoint.json
+#                for a dry run), False for none
+#   dry_run - a CSV file the rows are written to instead of the database
+#   restart - True to ignore the checkpoint and reload every chunk
+#   update - True to also replace the rows the table already has when their
+#            values changed (see mergeData)
+# Returns:
+#   written - the number of rows written
+#   failed - the (start, end) of every chunk that failed
+# ---------------------
+def runBackfill(
+    building,
+    start,
+    end,
+    table=None,
+    workers=1,
+    chunk_days=None,
+    checkpoint=None,
+    dry_run=None,
+    restart=False,
+    update=False,
+):
+    if table is None:
+        table = building["table"]
+    if chunk_days is None:
+        chunk_days = int(os.getenv("BACKFILL_CHUNK_DAYS", "7"))
+    if checkpoint is None:
+        if dry_run:
+            checkpoint = dry_run + ".checkpoint.json"
+        else:
+            name = table + (".update.json" if update else ".json")
+            checkpoint = os.path.join(os.getenv("CHECKPOINT_DIR", "state"), "backfill", name)
+    target = dry_run or table
+
+    # Chunks finished by an earlier run for the same building and target
+    done = []
+    if checkpoint and not restart:
+        saved = read_json(checkpoint, {})
+        if saved.get("building") == building["name"] and saved.get("target") == target:
+            done = [tuple(chunk) for chunk in saved.get("done", [])]
+    if dry_run and not done and os.path.exists(dry_run):
+        os.remove(dry_run)
+
+    chunks = chunkRange(start, end, chunk_days)
+    pending = deque(chunk for chunk in chunks if chunk not in done)
+    if len(pending) < len(chunks):
+        print(
+            "Skipping "
+            + str(len(chunks) - len(pending))
+            + " chunks already done (see "
+            + checkpoint
+            + ")"
+        )
+
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        from scheduler import initWorker
+
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=initWorker)
+        transform_workers = 1
+    else:
+        executor = ThreadPoolExecutor(max_workers=1)
+        transform_workers = None
+
+    written = 0
+    failed = []
+    running = {}
+    try:
+        while pending or running:
+            while pending and len(running) < max(1, workers):
+                chunk = pending.popleft()
+                future = executor.submit(processChunk, building, *chunk, workers=transform_workers)
+                running[future] = chunk
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                chunk = running.pop(future)
+                try:
+                    master_df = future.result()
+                    if master_df is None:
+                        raise ValueError("the data checks failed")
+                    if dry_run:
+                        written += writeCsv(master_df, dry_run, building["columns"])
+                    else:
+                        rollupData(master_df, table)
+                        if update:
+                            counts = mergeData(master_df, table, columns=building["columns"])
+                            written += counts["inserted"] + counts["updated"]
+                        else:
+                            written += backfillData(master_df, table, columns=building["columns"])
+                except Exception as e:
+                    logging.error("Chunk " + chunk[0] + " to " + chunk[1] + " failed: " + str(e))
+                    print("Chunk " + chunk[0] + " to " + chunk[1] + " failed: " + str(e))
+                    failed.append(chunk)
+                    continue
+                done.append(chunk)
+                if checkpoint:
+                    write_json_atomic(
+                        checkpoint,
+                        {"building": building["name"], "target": target, "done": done},
+                    )
+                print("Chunk " + chunk[0] + " to " + chunk[1] + " done")
+    except KeyboardInterrupt:
+        print("Interrupted, run the same command again to resume")
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+    return written, sorted(failed)
+
+
+# Function: writeCsv
+# ---------------------
+# This function appends the rows of a master dataframe to a CSV file the way
+# they would be written to the database: local times and the database column
+# names.
+#
+# Parameters:
+#   master_df - a dataframe containing the energy data
+#   path - the CSV file
+#   columns - the master dataframe columns and the database columns they are
+#             written to (defaults to UPLOAD_COLUMNS)
+# Returns:
+#   the number of rows written
+# ---------------------
+def writeCsv(master_df, path, columns=None):
+    if columns is None:
+        columns = UPLOAD_COLUMNS
+    rows = master_df.assign(Time=localTimes(master_df["Time"]))
+    rows = rows[list(columns)].rename(columns=columns)
+    header = not os.path.exists(path)
+    rows.to_csv(path, mode="a", header=header, index=False)
+    return len(rows)
+
+
+# Function: chunkRange
+# ---------------------
+# This function splits a date range into runs of chunk_days days.
+#
+# Parameters:
+#   start - the start date in the format "YYYY-MM-DD"
+#   end - the end date in the format "YYYY-MM-DD", included
+#   chunk_days - the most days in a chunk
+# Returns:
+#   a list of (start, end) date strings
+# ---------------------
+def chunkRange(start, end, chunk_days):
+    start_date = datetime.strptime(start, "%Y-%m-%d")
+    end_date = datetime.strptime(end, "%Y-%m-%d")
+    chunks = []
+    while start_date <= end_date:
+        last = min(start_date + timedelta(days=chunk_days - 1), end_date)
+        chunks.append((start_date.strftime("%Y-%m-%d"), last.strftime("%Y-%m-%d")))
+        start_date = last + timedelta(days=1)
+    return chunks
+
+
+# Function: processChunk
+# ---------------------
+# This function downloads one chunk of days from all of a building's gateways
+# at the same time, parses and cleans them with transformRange, aligns them
+# and builds the zones.
+#
+# Parameters:
+#   building - a building from the registry
+#   start - the first day in the format "YYYY-MM-DD"
+#   end - the last day in the format "YYYY-MM-DD"
+#   workers - worker processes for transformRange (see transformRange)
+# Returns:
+#   master_df - the processed chunk, or None if the data checks failed
+# ---------------------
+def processChunk(building, start, end, workers=None):
+    # The process pool stack is only loaded by backfills, not the menu
+    from transform import transformRange
+
+    gateways = building["gateways"]
+    with ThreadPoolExecutor(max_workers=len(gateways)) as pool:
+        frames = list(
+            pool.map(
+                lambda gw: transformRange(
+                    gw["host"], gw["user"], gw["password"], start, end, workers=workers
+                ),
+                gateways,
+            )
+        )
+    if any(frame is None or frame.empty for frame in frames):
+        logging.error("No data for " + start + " to " + end)
+        return None
+    dataval = CheckResData(*frames)
 
     if dataval is True:
         logging.info("Data checkes passed")
     elif dataval is False:
         logging.error("Data checks failed")
-        return
+        return None
     else:
-        df_server1, df_server2, df_server3 = dataval
+        frames = list(dataval)
         logging.warning("Data checks passed after correction")
 
-    master_df = processData(df_server1, df_server2, df_server3)
+    zones = load_zones(building["zones"]) if building["zones"] else load_zones()
+    nums = [gw["num"] for gw in gateways]
+    frames = missingFrames(dict(zip(nums, frames)), gateways, zones)
+    return processData(*frames, zones=zones)
+
+
+# Function: choose_building
+# ---------------------
+# This function asks which building to work on when the registry has more
+# than one.
+#
+# Parameters:
+#   None
+# Returns:
+#   a building from the registry
+# ---------------------
+def choose_building():
+    buildings = load_registry()
+    if len(buildings) == 1:
+        return buildings[0]
+    names = [building["name"] for building in buildings]
+    while True:
+        name = input("Enter the building (" + ", ".join(names) + "): ")
+        if name in names:
+            return buildings[names.index(name)]
+        print("Unknown building. Please try again.")
+
+
+# Function: backfill
+# ---------------------
+# This function is the non-interactive backfill command. It reads the date
+# range, building, table and worker count from the command line and runs
+# runBackfill.
+#
+# Parameters:
+#   argv - the command line arguments after the program name
+# Returns:
+#   0 if every chunk was loaded, 1 otherwise
+# ---------------------
+def backfill(argv):
+    parser = argparse.ArgumentParser(
+        prog="ed_db_updatetool.py backfill",
+        description="Reload a date range from the gateways into the database",
+    )
+    parser.add_argument("start", type=parseDay, help="first day, YYYY-MM-DD")
+    parser.add_argument("end", type=parseDay, help="last day, YYYY-MM-DD")
+    parser.add_argument(
+        "--building", help="building whose gateways are read (default: the only one)"
+    )
+    parser.add_argument(
+        "--registry", help="gateway registry file (default: BUILDINGS_FILE or buildings.json)"
+    )
+    parser.add_argument("--table", help="table to upload to (default: the building's table)")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="chunks processed at the same time (default: 1)"
+    )
+    parser.add_argument(
+        "--chunk-days",
+        type=int,
+        default=int(os.getenv("BACKFILL_CHUNK_DAYS", "7")),
+        help="days per chunk (default: BACKFILL_CHUNK_DAYS or 7)",
+    )
+    parser.add_argument("--checkpoint", help="progress file (default: state/backfill/<table>.json)")
+    parser.add_argument(
+        "--restart", action="store_true", help="ignore the checkpoint and reload every chunk"
+    )
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        help="also replace rows the table already has when their values changed",
+    )
+    parser.add_argument(
+        "--dry-run", metavar="CSV", help="write the rows to this CSV file instead of the database"
+    )
+    args = parser.parse_args(argv)
+    if args.end < args.start:
+        parser.error("the start date is after the end date")
+    if args.chunk_days < 1 or args.workers < 1:
+        parser.error("--chunk-days and --workers must be at least 1")
+
+    buildings = load_registry(args.registry)
+    if args.building is None:
+        if len(buildings) > 1:
+            parser.error("--building is required, the registry has " + str(len(buildings)))
+        building = buildings[0]
+    else:
+        names = [building["name"] for building in buildings]
+        if args.building not in names:
+            parser.error("unknown building " + args.building + ", choose from " + ", ".join(names))
+        building = buildings[names.index(args.building)]
+    if not (args.table or building["table"]) and not args.dry_run:
+        parser.error("no table, set --table or the building's table")
+
+    start = time.time()
+    written, failed = runBackfill(
+        building,
+        args.start,
+        args.end,
+        table=args.table,
+        workers=args.workers,
+        chunk_days=args.chunk_days,
+        checkpoint=args.checkpoint,
+        dry_run=args.dry_run,
+        restart=args.restart,
+        update=args.update,
+    )
+    print(
+        str(written)
+        + " rows written to "
+        + (args.dry_run or args.table or building["table"])
+        + " in "
+        + "%.1fs" % (time.time() - start)
+    )
+    if failed:
+        print("Failed chunks, run again to retry them: " + str(failed))
+        return 1
+    return 0
+
 
-    # print master_df to a csv for testing
+# Function: parseDay
+# ---------------------
+# This function checks a date argument.
+#
+# Parameters:
+#   value - the argument
+# Returns:
+#   the date in the format "YYYY-MM-DD"
+# ---------------------
+def parseDay(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError("not a YYYY-MM-DD date: " + value)
 
 
-main()
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["backfill"]:
+        load_dotenv()
+        sys.exit(backfill(sys.argv[2:]))
+    main()
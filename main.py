@@ -1,48 +1,142 @@
 from datapross import *
 from dotenv import load_dotenv
+import metrics
+import readapi
+from registry import load_registry
+from scheduler import Scheduler
+import argparse
+import signal
 
 
-def main():
+# Function: main
+# ---------------------
+# This function runs one collection cycle for every building in the registry.
+#
+# Parameters:
+#   scheduler - the Scheduler to run the buildings on (a new one is made and
+#               closed again when not given)
+# Returns:
+#   the number of rows written, or None if every building failed
+# ---------------------
+def main(scheduler=None):
     load_dotenv()
-    # Get the environment variables
-    table = os.getenv("TABLE_NAME")
-    df_server1 = pullData(
-        os.getenv("FTP_HOST_1"),
-        os.getenv("FTP_USER_1"),
-        os.getenv("FTP_PASS_1"),
-        1,
-    )
+    buildings = load_registry()
+    if scheduler is None:
+        with Scheduler() as scheduler:
+            results = scheduler.run(buildings)
+    else:
+        results = scheduler.run(buildings)
 
-    df_server2 = pullData(
-        os.getenv("FTP_HOST_2"),
-        os.getenv("FTP_USER_2"),
-        os.getenv("FTP_PASS_2"),
-        2,
-    )
-    df_server3 = pullData(
-        os.getenv("FTP_HOST_3"),
-        os.getenv("FTP_USER_3"),
-        os.getenv("FTP_PASS_3"),
-        3,
+    failed = sorted(
+        name
+        for name, result in results.items()
+        if result is None or isinstance(result, Exception)
     )
+    if failed:
+        logging.error("Buildings failed: " + str(failed))
+    if len(failed) == len(results):
+        return None
+    logging.info("Database pool: " + str(get_pool().stats()))
+    return sum(result for name, result in results.items() if name not in failed)
 
-    df_server1 = cleanData(df_server1)
-    df_server2 = cleanData(df_server2)
-    df_server3 = cleanData(df_server3)
-    dataval = CheckResData(df_server1, df_server2, df_server3)
 
-    if dataval is True:
-        logging.info("Data checkes passed")
-    elif dataval is False:
-        logging.error("Data checks failed")
-        return
-    else:
-        df_server1, df_server2, df_server3 = dataval
-        logging.warning("Data checks passed after correction")
+# Function: run_daemon
+# ---------------------
+# This function keeps the process running and calls main once per trend
+# interval. Each cycle starts offset seconds after a wall-clock boundary
+# (e.g. 12:05:00 + offset) so the gateways have written the new row. Cycles
+# never overlap, if one runs past the next start that boundary is skipped.
+# Imports, the zone config, the database pool, SFTP connections and the
+# incremental download state stay warm between cycles, including in the
+# scheduler's worker processes. Metrics are served on
+# METRICS_PORT while it runs. Rows go through the outbox, so a slow or down
+# database does not hold up or lose a cycle; the cycle latency metric is set by
+# the drainer once a cycle's rows are committed. SIGTERM or SIGINT stops the
+# loop after the current cycle.
+#
+# Parameters:
+#   interval - the cycle length in seconds
+#   offset - how many seconds after each boundary a cycle starts
+# Returns:
+#   None
+# ---------------------
+def run_daemon(interval=300, offset=30):
+    os.environ.setdefault("SFTP_KEEPALIVE", "1")
+    os.environ.setdefault("INCREMENTAL_FETCH", "1")
+    os.environ.setdefault("METRICS_ENABLED", "1")
+    os.environ.setdefault("OUTBOX_ENABLED", "1")
+    metrics.start_server()
+    drainer = startDrainer()
+
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        logging.info("Received signal " + str(signum) + ", stopping after this cycle")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
 
-    master_df = processData(df_server1, df_server2, df_server3)
+    scheduler = Scheduler()
+    print("Running every " + str(interval) + "s, " + str(offset) + "s after the boundary")
+    while not stop.is_set():
+        boundary = (time.time() - offset) // interval * interval + interval
+        if stop.wait(boundary + offset - time.time()):
+            break
 
-    uploadData(master_df, table)
+        try:
+            written = main(scheduler)
+        except Exception:
+            logging.exception("Cycle failed")
+            written = None
+        latency = time.time() - boundary
+        metrics.get_metrics().inc(
+            "emd_cycles_total", result="failed" if written is None else "ok"
+        )
+        if drainer is None:
+            metrics.get_metrics().set("emd_cycle_latency_seconds", latency)
+        else:
+            drainer.mark(boundary)
+        print(
+            "Cycle for "
+            + datetime.fromtimestamp(boundary).strftime("%H:%M:%S")
+            + (" uploaded " if drainer is None else " queued ")
+            + str(written)
+            + " rows "
+            + "%.1fs" % latency
+            + " after the boundary"
+        )
+        logging.info("Cycle latency: %.1fs, rows: %s" % (latency, written))
 
+    scheduler.close()
+    if drainer is not None:
+        drainer.stop()
+    close_sftp_sessions()
+    get_pool().close()
+    metrics.stop_server()
+    print("Stopped")
 
-main()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collect energy data from the gateways")
+    parser.add_argument(
+        "--daemon", action="store_true", help="keep running and collect every interval"
+    )
+    parser.add_argument(
+        "--interval",
+        type=int,
+        default=int(os.getenv("CYCLE_INTERVAL", "300")),
+        help="seconds between cycles in daemon mode",
+    )
+    parser.add_argument(
+        "--offset",
+        type=int,
+        default=int(os.getenv("CYCLE_OFFSET", "30")),
+        help="seconds after each interval boundary to start a cycle",
+    )
+    args = parser.parse_args()
+
+    if args.daemon:
+        run_daemon(args.interval, args.offset)
+    else:
+        main()
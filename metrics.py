@@ -0,0 +1,411 @@
+# This file contains the pipeline's built-in instrumentation: histograms of how
+# long each stage and each gateway download takes, byte and row counters, and
+# the upload lag gauge. They are served in the Prometheus text format by a
+# small HTTP server on port 8000. With METRICS_ENABLED unset every call is a
+# no-op, so the instrumented code costs next to nothing when nobody scrapes it.
+
+
+# Import the required libraries
+import functools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import parse_qs, urlsplit
+
+from dotenv import load_dotenv
+
+
+# Default histogram buckets in seconds, from a quick parse to a stuck download
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# The name, type and help text of every metric the pipeline reports
+DEFINITIONS = {
+    "emd_stage_seconds": ("histogram", "Time spent in each pipeline stage"),
+    "emd_gateway_download_seconds": ("histogram", "Time to download a gateway's trend file"),
+    "emd_gateway_bytes_total": ("counter", "Trend file bytes downloaded from each gateway"),
+    "emd_gateway_rows_total": ("counter", "Trend rows parsed from each gateway"),
+    "emd_gateway_errors_total": ("counter", "Failed downloads for each gateway"),
+    "emd_gateway_retries_total": ("counter", "Download retries for each gateway"),
+    "emd_gateway_breaker_open": ("gauge", "1 while a gateway is skipped by its circuit breaker"),
+    "emd_partial_zones": ("gauge", "Zones uploaded as NULL in the last cycle for lack of a gateway"),
+    "emd_rows_uploaded_total": ("counter", "Rows written to each database table"),
+    "emd_outbox_rows": ("gauge", "Rows waiting in the outbox for each table"),
+    "emd_outbox_oldest_seconds": ("gauge", "Seconds the oldest row in the outbox has waited"),
+    "emd_outbox_flush_errors_total": (
+        "counter",
+        "Failed attempts to write the outbox to the database or reconcile the checkpoints",
+    ),
+    "emd_upload_lag_seconds": (
+        "gauge",
+        "Newest gateway time minus the newest database time before the upload",
+    ),
+    "emd_cycles_total": ("counter", "Daemon cycles by result"),
+    "emd_cycle_latency_seconds": (
+        "gauge",
+        "Seconds after the interval boundary the last cycle's rows were committed to the database",
+    ),
+}
+
+
+# Class: Metrics
+# ---------------------
+# A thread-safe set of counters, gauges and histograms. Each metric is keyed by
+# its name and label values, and created the first time it is used.
+#
+# Parameters:
+#   buckets - the upper bounds of the histogram buckets
+# ---------------------
+class Metrics:
+    enabled = True
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    # Function: inc
+    # ---------------------
+    # Adds value to a counter.
+    # ---------------------
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    # Function: set
+    # ---------------------
+    # Sets a gauge to value.
+    # ---------------------
+    def set(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = value
+
+    # Function: observe
+    # ---------------------
+    # Records one value in a histogram.
+    # ---------------------
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    # Function: timer
+    # ---------------------
+    # Records how long a with block takes in a histogram.
+    # ---------------------
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    # Function: drain
+    # ---------------------
+    # Returns the raw values recorded so far and starts again from zero. Worker
+    # processes send these to the parent, which adds them with merge.
+    # ---------------------
+    def drain(self):
+        with self._lock:
+            values = self._values
+            self._values = {}
+        return values
+
+    # Function: merge
+    # ---------------------
+    # Adds values returned by another process's drain. Counters and histograms
+    # are added up, gauges take the other process's value.
+    # ---------------------
+    def merge(self, values):
+        with self._lock:
+            for key, value in values.items():
+                current = self._values.get(key)
+                if current is None:
+                    self._values[key] = value
+                elif isinstance(value, list):
+                    current[0] = [a + b for a, b in zip(current[0], value[0])]
+                    current[1] += value[1]
+                    current[2] += value[2]
+                elif DEFINITIONS.get(key[0], ("gauge",))[0] == "counter":
+                    self._values[key] = current + value
+                else:
+                    self._values[key] = value
+
+    # Function: render
+    # ---------------------
+    # Returns every metric in the Prometheus text exposition format.
+    # ---------------------
+    def render(self):
+        with self._lock:
+            # Histograms are copied so they can be rendered outside the lock
+            values = sorted(
+                (key, tuple(value[0]) + (value[1], value[2]) if isinstance(value, list) else value)
+                for key, value in self._values.items()
+            )
+
+        lines = []
+        described = set()
+        for (name, labels), value in values:
+            kind, help_text = DEFINITIONS.get(name, ("untyped", ""))
+            if name not in described:
+                lines.append("# HELP " + name + " " + help_text)
+                lines.append("# TYPE " + name + " " + kind)
+                described.add(name)
+            if not isinstance(value, tuple):
+                lines.append(name + formatLabels(labels) + " " + formatValue(value))
+                continue
+
+            counts, total, count = value[:-2], value[-2], value[-1]
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                lines.append(
+                    name
+                    + "_bucket"
+                    + formatLabels(labels + (("le", formatValue(bound)),))
+                    + " "
+                    + str(cumulative)
+                )
+            lines.append(name + "_bucket" + formatLabels(labels + (("le", "+Inf"),)) + " " + str(count))
+            lines.append(name + "_sum" + formatLabels(labels) + " " + formatValue(total))
+            lines.append(name + "_count" + formatLabels(labels) + " " + str(count))
+        return "\n".join(lines) + "\n"
+
+
+# Class: NullMetrics
+# ---------------------
+# Stands in for Metrics when METRICS_ENABLED is off. Every call returns
+# straight away and nothing is stored.
+# ---------------------
+class NullMetrics:
+    enabled = False
+
+    def inc(self, name, value=1, **labels):
+        pass
+
+    def set(self, name, value, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    @contextmanager
+    def timer(self, name, **labels):
+        yield
+
+    def drain(self):
+        return {}
+
+    def merge(self, values):
+        pass
+
+    def render(self):
+        return ""
+
+
+def formatLabels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(key + '="' + value + '"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def formatValue(value):
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+# Function: get_metrics
+# ---------------------
+# This function returns the process-wide metrics, or a NullMetrics when
+# METRICS_ENABLED is not 1.
+#
+# Parameters:
+#   None
+# Returns:
+#   The shared Metrics or NullMetrics
+# ---------------------
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                load_dotenv()
+                if os.getenv("METRICS_ENABLED", "0") == "1":
+                    _metrics = Metrics()
+                else:
+                    _metrics = NullMetrics()
+    return _metrics
+
+
+# Function: timed
+# ---------------------
+# This decorator records how long each call of a pipeline stage takes in
+# emd_stage_seconds.
+#
+# Parameters:
+#   stage - the stage label
+# Returns:
+#   the decorated function
+# ---------------------
+def timed(stage):
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            metrics = get_metrics()
+            if not metrics.enabled:
+                return fn(*args, **kwargs)
+            with metrics.timer("emd_stage_seconds", stage=stage):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+# *****************************************************************************
+# The following functions serve the metrics over HTTP
+# *****************************************************************************
+
+# Path -> function(query) returning (content type, body). Other modules can
+# add their own pages with add_route.
+_routes = {}
+
+
+# Function: add_route
+# ---------------------
+# This function serves handler at path on the metrics server.
+#
+# Parameters:
+#   path - the URL path, e.g. "/metrics"
+#   handler - a function that takes the query string as a dict of lists and
+#             returns (content type, body). It raises ValueError for a bad
+#             request (400) and LookupError when nothing matches (404)
+# Returns:
+#   None
+# ---------------------
+def add_route(path, handler):
+    _routes[path] = handler
+
+
+def renderMetrics(query):
+    return "text/plain; version=0.0.4; charset=utf-8", get_metrics().render()
+
+
+add_route("/metrics", renderMetrics)
+
+
+# Function: makeHandler
+# ---------------------
+# This function builds the request handler that serves _routes. http.server is
+# imported here rather than at the top, it is only needed once the server
+# starts and takes longer to import than the rest of this file.
+#
+# Parameters:
+#   None
+# Returns:
+#   a BaseHTTPRequestHandler subclass
+# ---------------------
+def makeHandler():
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            handler = _routes.get(url.path)
+            if handler is None:
+                self.send_error(404)
+                return
+            try:
+                content_type, body = handler(parse_qs(url.query))
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+            except LookupError as e:
+                self.send_error(404, str(e))
+                return
+            except Exception:
+                logging.exception("Metrics server error on " + url.path)
+                self.send_error(500)
+                return
+            if isinstance(body, str):
+                body = body.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug("Metrics server: " + format % args)
+
+    return MetricsHandler
+
+
+# Function: start_server
+# ---------------------
+# This function starts the HTTP server on a background thread. It does nothing
+# when metrics are disabled.
+#
+# Parameters:
+#   port - the port to listen on (defaults to METRICS_PORT or 8000)
+# Returns:
+#   the server, or None when metrics are disabled
+# ---------------------
+_server = None
+
+
+def start_server(port=None):
+    global _server
+    if not get_metrics().enabled or _server is not None:
+        return _server
+    if port is None:
+        port = int(os.getenv("METRICS_PORT", "8000"))
+    from http.server import ThreadingHTTPServer
+
+    _server = ThreadingHTTPServer(("", port), makeHandler())
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+    print("Serving metrics on port " + str(_server.server_address[1]))
+    logging.info("Serving metrics on port " + str(_server.server_address[1]))
+    return _server
+
+
+# Function: stop_server
+# ---------------------
+# This function stops the HTTP server if it is running.
+#
+# Parameters:
+#   None
+# Returns:
+#   None
+# ---------------------
+def stop_server():
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
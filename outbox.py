@@ -0,0 +1,295 @@
+# This file contains a durable local outbox for processed rows. With it the
+# collection cycle only appends its rows to a local SQLite file, and a
+# background drainer writes them to the database in large batches. A slow or
+# unreachable database then neither slows the cycle down nor loses rows: they
+# wait in the outbox, which survives restarts, and are flushed as soon as the
+# database answers again.
+
+
+# Import the required libraries
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from metrics import get_metrics
+from resilience import backoff
+
+
+# Class: Outbox
+# ---------------------
+# The rows waiting to be written, in the order they were added. Each row keeps
+# its table, its time, the database column names and its values, so rows for
+# several tables and column layouts can share one file. Every call opens its
+# own connection, so worker processes can add rows while the daemon drains.
+#
+# Parameters:
+#   path - the SQLite database file
+# ---------------------
+class Outbox:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        # A row is on disk before put returns
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS pending (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "tbl TEXT, time TEXT, columns TEXT, payload TEXT, queued REAL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS pending_tbl ON pending (tbl, id)")
+        return conn
+
+    def _run(self, fn):
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    return fn(conn)
+            finally:
+                conn.close()
+
+    # Function: put
+    # ---------------------
+    # Adds rows for table in one transaction.
+    #
+    # Parameters:
+    #   table - the table the rows are written to
+    #   rows - a dataframe with naive local times in its first column and one
+    #          column per database column, named like them
+    # Returns:
+    #   the number of rows added
+    # ---------------------
+    def put(self, table, rows):
+        if rows.empty:
+            return 0
+        columns = json.dumps(list(rows.columns))
+        times = rows.iloc[:, 0].dt.strftime("%Y-%m-%d %H:%M:%S").tolist()
+        values = rows.iloc[:, 1:].astype(object).where(rows.iloc[:, 1:].notna(), None)
+        now = time.time()
+        records = [
+            (table, when, columns, json.dumps(payload), now)
+            for when, payload in zip(times, values.values.tolist())
+        ]
+        self._run(
+            lambda conn: conn.executemany(
+                "INSERT INTO pending (tbl, time, columns, payload, queued) VALUES (?, ?, ?, ?, ?)",
+                records,
+            )
+        )
+        return len(records)
+
+    # Function: peek
+    # ---------------------
+    # Returns the oldest rows of table without removing them. The rows all have
+    # the same columns, a batch stops where the layout changes.
+    #
+    # Parameters:
+    #   table - the table
+    #   limit - the most rows returned
+    # Returns:
+    #   ids - the ids to pass to remove once the rows are written
+    #   rows - a dataframe like the one given to put, or None when empty
+    # ---------------------
+    def peek(self, table, limit):
+        import pandas as pd
+
+        found = self._run(
+            lambda conn: conn.execute(
+                "SELECT id, time, columns, payload FROM pending WHERE tbl = ? ORDER BY id LIMIT ?",
+                (table, limit),
+            ).fetchall()
+        )
+        if not found:
+            return [], None
+        layout = found[0][2]
+        for i, row in enumerate(found):
+            if row[2] != layout:
+                found = found[:i]
+                break
+        columns = json.loads(layout)
+        rows = pd.DataFrame([json.loads(row[3]) for row in found], columns=columns[1:], dtype="float64")
+        rows.insert(0, columns[0], pd.to_datetime([row[1] for row in found]))
+        return [row[0] for row in found], rows
+
+    # Function: remove
+    # ---------------------
+    # Removes rows that have been written.
+    # ---------------------
+    def remove(self, ids):
+        self._run(
+            lambda conn: conn.executemany("DELETE FROM pending WHERE id = ?", ((id,) for id in ids))
+        )
+
+    # Function: stats
+    # ---------------------
+    # Returns {table: (rows waiting, seconds the oldest has waited)}.
+    # ---------------------
+    def stats(self):
+        now = time.time()
+        found = self._run(
+            lambda conn: conn.execute(
+                "SELECT tbl, COUNT(*), MIN(queued) FROM pending GROUP BY tbl"
+            ).fetchall()
+        )
+        return {table: (count, now - oldest) for table, count, oldest in found}
+
+    # Function: last_time
+    # ---------------------
+    # Returns the newest time waiting for table as a naive datetime, or None.
+    # ---------------------
+    def last_time(self, table):
+        from datetime import datetime
+
+        found = self._run(
+            lambda conn: conn.execute("SELECT MAX(time) FROM pending WHERE tbl = ?", (table,)).fetchone()
+        )
+        return None if found[0] is None else datetime.fromisoformat(found[0])
+
+
+# Class: Drainer
+# ---------------------
+# A background thread that writes the outbox to the database. It flushes every
+# table's rows in batches of up to batch rows until the outbox is empty, then
+# checks again every interval seconds. When a flush fails the rows stay in the
+# outbox and the next attempt waits a random, doubling backoff up to cap
+# seconds. The outbox depth and the age of the oldest row are kept in the
+# emd_outbox_rows and emd_outbox_oldest_seconds gauges. A cycle that has queued
+# its rows calls mark, which wakes the thread; once those rows are written the
+# time since the cycle's interval boundary goes in emd_cycle_latency_seconds.
+# After each drain the thread also calls reconcile, so the work that needs the
+# database is done here and not in the collection cycle.
+#
+# Parameters:
+#   outbox - the Outbox
+#   flush - a function that takes (table, rows) from Outbox.peek and writes
+#           the rows, raising if it could not
+#   reconcile - a function called after each drain, raising if it could not
+#               reach the database (optional)
+#   interval - seconds between checks while the outbox is empty
+#   batch - the most rows written at once
+#   base, cap - the backoff settings (see resilience.backoff)
+# ---------------------
+class Drainer:
+    def __init__(self, outbox, flush, interval=5, batch=5000, base=1.0, cap=60.0, reconcile=None):
+        self.outbox = outbox
+        self.flush = flush
+        self.reconcile = reconcile
+        self.interval = interval
+        self.batch = batch
+        self.base = base
+        self.cap = cap
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+        self._reported = set()
+        self._marks = []
+        self._marks_lock = threading.Lock()
+        self._failing = False
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="outbox-drainer", daemon=True)
+            self._thread.start()
+        return self
+
+    # Function: stop
+    # ---------------------
+    # Stops the thread after the batch it is writing. Rows left in the outbox
+    # are written after the next start.
+    # ---------------------
+    def stop(self, timeout=30):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    # Function: mark
+    # ---------------------
+    # Records that a cycle has queued its rows and wakes the thread, unless it
+    # is backing off after a failed flush.
+    #
+    # Parameters:
+    #   boundary - the UNIX time of the cycle's interval boundary
+    # ---------------------
+    def mark(self, boundary):
+        with self._marks_lock:
+            self._marks.append(boundary)
+        if not self._failing:
+            self._wake.set()
+
+    def _run(self):
+        attempt = 0
+        delay = 0
+        while not self._stop.is_set():
+            self._wake.wait(delay)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            with self._marks_lock:
+                marks, self._marks = self._marks, []
+            try:
+                self.drain()
+                if self.reconcile is not None and not self._stop.is_set():
+                    self.reconcile()
+                attempt = 0
+                delay = self.interval
+                self._failing = False
+                # Every row queued before the marks is in the database now
+                if marks and not self._stop.is_set():
+                    get_metrics().set("emd_cycle_latency_seconds", time.time() - max(marks))
+            except Exception as e:
+                with self._marks_lock:
+                    self._marks = marks + self._marks
+                delay = backoff(attempt, self.base, self.cap)
+                attempt += 1
+                self._failing = True
+                get_metrics().inc("emd_outbox_flush_errors_total")
+                logging.error("Outbox flush failed (" + str(e) + "), retrying in " + "%.1fs" % delay)
+            self.report()
+
+    # Function: drain
+    # ---------------------
+    # Writes batches until the outbox is empty or stop is called.
+    #
+    # Parameters:
+    #   None
+    # Returns:
+    #   the number of rows written
+    # ---------------------
+    def drain(self):
+        written = 0
+        for table in sorted(self.outbox.stats()):
+            self._reported.add(table)
+            while not self._stop.is_set():
+                ids, rows = self.outbox.peek(table, self.batch)
+                if not ids:
+                    break
+                # Report first, a flush can block until the database times out
+                self.report()
+                self.flush(table, rows)
+                self.outbox.remove(ids)
+                written += len(ids)
+        return written
+
+    def report(self):
+        try:
+            stats = self.outbox.stats()
+        except Exception as e:
+            logging.error("Reading the outbox failed: " + str(e))
+            return
+        metrics = get_metrics()
+        for table in set(stats) | self._reported:
+            count, age = stats.get(table, (0, 0.0))
+            metrics.set("emd_outbox_rows", count, table=table)
+            metrics.set("emd_outbox_oldest_seconds", age, table=table)
+        self._reported |= set(stats)
@@ -0,0 +1,178 @@
+# This file contains the read API for dashboards. It serves the recent zone
+# readings held in the ring buffers (see datapross.get_ring) as JSON on the
+# same HTTP server as the metrics, so "latest building load" and recent charts
+# are answered from memory without a database query. Importing this file adds
+# the routes:
+#
+#   /readings                      the tables held and their time span
+#   /readings/latest               the newest interval
+#   /readings/range?start=&end=    every interval in a time range
+#   /readings/series?step=1h       a time range downsampled to one row per step
+#
+# Every route takes table= (optional with a single table) and columns=a,b.
+# start and end are ISO times, taken as US/Pacific without an offset, or UNIX
+# seconds. Times in the responses are UTC.
+
+
+# Import the required libraries
+import json
+import re
+from datetime import datetime
+
+import pytz
+
+import datapross
+from metrics import add_route
+
+
+STEP_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+# Function: parseTime
+# ---------------------
+# This function reads a start or end parameter.
+#
+# Parameters:
+#   value - an ISO time, e.g. one returned by the API, or UNIX seconds
+# Returns:
+#   the time in UTC nanoseconds
+# ---------------------
+def parseTime(value):
+    try:
+        return int(float(value) * 10**9)
+    except ValueError:
+        pass
+    # Python before 3.11 does not read the Z the responses use for UTC
+    if value[-1:] in ("Z", "z"):
+        value = value[:-1] + "+00:00"
+    try:
+        time = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError("Not a time: " + value)
+    if time.tzinfo is None:
+        time = pytz.timezone("US/Pacific").localize(time)
+    return int(time.timestamp()) * 10**9 + time.microsecond * 1000
+
+
+# Function: parseStep
+# ---------------------
+# This function reads a step parameter such as 300, 15m, 1h or 1d.
+#
+# Parameters:
+#   value - the step
+# Returns:
+#   the step in nanoseconds
+# ---------------------
+def parseStep(value):
+    match = re.fullmatch(r"(\d+)([smhd]?)", value.strip())
+    if match is None or int(match.group(1)) == 0:
+        raise ValueError("Not a step: " + value)
+    return int(match.group(1)) * STEP_UNITS[match.group(2) or "s"] * 10**9
+
+
+def formatTimes(times):
+    import numpy as np
+
+    return [time + "Z" for time in np.datetime_as_string(times.astype("datetime64[ns]"), unit="s")]
+
+
+def formatValues(values):
+    # JSON has no NaN, missing readings are null
+    return [None if value != value else round(value, 4) for value in values.tolist()]
+
+
+# Function: query
+# ---------------------
+# This function picks the ring buffer and columns a request asks for.
+#
+# Parameters:
+#   params - the query string as a dict of lists
+# Returns:
+#   table - the table name
+#   ring - its RingBuffer
+#   columns - the requested columns, or None for all
+# ---------------------
+def query(params):
+    rings = datapross.get_rings()
+    table = params.get("table", [None])[0]
+    if table is None:
+        if len(rings) != 1:
+            raise ValueError("Choose a table: " + ", ".join(sorted(rings)))
+        table = next(iter(rings))
+    if table not in rings:
+        raise LookupError("No readings for " + table)
+    columns = params.get("columns", [None])[0]
+    return table, rings[table], columns.split(",") if columns else None
+
+
+def bounds(params):
+    start, end = params.get("start", [None])[0], params.get("end", [None])[0]
+    return (
+        parseTime(start) if start is not None else None,
+        parseTime(end) if end is not None else None,
+    )
+
+
+def respond(data):
+    return "application/json", json.dumps(data, separators=(",", ":"))
+
+
+def series(table, columns, times, values):
+    return respond(
+        {
+            "table": table,
+            "time": formatTimes(times),
+            "values": {column: formatValues(values[:, i]) for i, column in enumerate(columns)},
+        }
+    )
+
+
+def tables(params):
+    result = {}
+    for table, ring in sorted(datapross.get_rings().items()):
+        times, _ = ring.window(columns=[])
+        result[table] = {
+            "columns": ring.columns,
+            "intervals": len(times),
+            "first": formatTimes(times[:1])[0] if len(times) else None,
+            "last": formatTimes(times[-1:])[0] if len(times) else None,
+        }
+    return respond({"tables": result})
+
+
+def latest(params):
+    table, ring, columns = query(params)
+    newest = ring.latest(columns)
+    if newest is None:
+        raise LookupError("No readings for " + table)
+    time, values = newest
+    columns = columns or ring.columns
+    import numpy as np
+
+    return respond(
+        {
+            "table": table,
+            "time": formatTimes(np.array([time]))[0],
+            "values": dict(zip(columns, formatValues(values))),
+        }
+    )
+
+
+def window(params):
+    table, ring, columns = query(params)
+    times, values = ring.window(*bounds(params), columns=columns)
+    return series(table, columns or ring.columns, times, values)
+
+
+def downsampled(params):
+    table, ring, columns = query(params)
+    step = parseStep(params.get("step", ["1h"])[0])
+    how = params.get("how", ["mean"])[0]
+    times, values = ring.downsample(step, *bounds(params), columns=columns, how=how)
+    return series(table, columns or ring.columns, times, values)
+
+
+add_route("/readings", tables)
+add_route("/readings/latest", latest)
+add_route("/readings/range", window)
+add_route("/readings/series", downsampled)
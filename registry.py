@@ -0,0 +1,112 @@
+# This file contains the gateway registry: which buildings are collected, the
+# gateways that meter each one, the zone config that turns the gateways'
+# meters into floors, and the database table each building is written to.
+# The registry is a JSON file (see buildings.example.json). Without one the
+# single building configured through FTP_HOST_1, FTP_HOST_2, ... is used.
+
+
+# Import the required libraries
+import json
+import os
+import re
+
+from dotenv import load_dotenv
+from datapross import load_gateways
+
+
+ENV_REFERENCE = re.compile(r"\$\{(\w+)\}")
+
+
+# Function: expandEnv
+# ---------------------
+# This function replaces every ${NAME} in a config value with the NAME
+# environment variable, so passwords can stay in .env instead of the registry.
+# Unset variables become empty strings.
+#
+# Parameters:
+#   value - a string, list or dict from the registry
+# Returns:
+#   the value with its references expanded
+# ---------------------
+def expandEnv(value):
+    if isinstance(value, str):
+        return ENV_REFERENCE.sub(lambda match: os.getenv(match.group(1), ""), value)
+    if isinstance(value, list):
+        return [expandEnv(item) for item in value]
+    if isinstance(value, dict):
+        return {key: expandEnv(item) for key, item in value.items()}
+    return value
+
+
+# Function: load_registry
+# ---------------------
+# This function loads the buildings from the registry file. Each building has
+# a name, a table, a zones file (relative to the registry), optional upload
+# columns and a list of gateways. Gateways are numbered from 1 in the order
+# they are listed unless they give their own num, the zones file refers to
+# them by that number.
+#
+# Parameters:
+#   path - the registry file (defaults to BUILDINGS_FILE or buildings.json)
+# Returns:
+#   buildings - a list of dicts with the keys name, table, zones, columns and
+#               gateways, sorted by name
+# ---------------------
+def load_registry(path=None):
+    load_dotenv()
+    if path is None:
+        path = os.getenv(
+            "BUILDINGS_FILE", os.path.join(os.path.dirname(__file__), "buildings.json")
+        )
+    if not os.path.exists(path):
+        return [environmentBuilding()]
+
+    with open(path) as f:
+        config = expandEnv(json.load(f))
+
+    buildings = []
+    folder = os.path.dirname(os.path.abspath(path))
+    for name, building in sorted(config["buildings"].items()):
+        gateways = []
+        for num, gateway in enumerate(building["gateways"], start=1):
+            gateways.append(
+                {
+                    "num": int(gateway.get("num", num)),
+                    "host": gateway["host"],
+                    "user": gateway["user"],
+                    "password": gateway["password"],
+                }
+            )
+        if not gateways:
+            raise ValueError("Building " + name + " has no gateways")
+        zones = building.get("zones")
+        buildings.append(
+            {
+                "name": name,
+                "table": building["table"],
+                "zones": os.path.join(folder, zones) if zones else None,
+                "columns": building.get("columns"),
+                "gateways": sorted(gateways, key=lambda gateway: gateway["num"]),
+            }
+        )
+    return buildings
+
+
+# Function: environmentBuilding
+# ---------------------
+# This function describes the single building set up through the environment,
+# for deployments without a registry file.
+#
+# Parameters:
+#   None
+# Returns:
+#   a building dict like the ones load_registry returns
+# ---------------------
+def environmentBuilding():
+    return {
+        "name": "default",
+        "table": os.getenv("SQL_TABLE") or os.getenv("TABLE_NAME"),
+        "zones": None,
+        "columns": None,
+        "gateways": load_gateways(),
+    }
@@ -0,0 +1,149 @@
+# This file contains the pieces that keep one unreachable gateway from
+# stalling or failing a whole cycle: retries with bounded exponential backoff
+# and jitter, and a per-gateway circuit breaker that skips a gateway for a
+# cool-down period after it has failed several cycles in a row.
+
+
+# Import the required libraries
+import logging
+import random
+import threading
+import time
+
+
+# Class: CircuitOpenError
+# ---------------------
+# Raised instead of contacting a gateway whose circuit breaker is open.
+# ---------------------
+class CircuitOpenError(Exception):
+    pass
+
+
+# Function: isTransient
+# ---------------------
+# This function decides whether a failed download is worth retrying. Network
+# and SSH errors are, a missing trend file or a refused login is not.
+#
+# Parameters:
+#   error - the exception raised
+# Returns:
+#   True if the same call might succeed when tried again
+# ---------------------
+def isTransient(error):
+    if isinstance(error, (FileNotFoundError, PermissionError, CircuitOpenError)):
+        return False
+    if any(cls.__name__ == "AuthenticationException" for cls in type(error).__mro__):
+        return False
+    if isinstance(error, (OSError, EOFError, TimeoutError)):
+        return True
+    return any(
+        cls.__name__ in ("SSHException", "ConnectionException") for cls in type(error).__mro__
+    )
+
+
+# Function: backoff
+# ---------------------
+# This function returns how long to wait before retry number attempt (from 0):
+# a random time between 0 and base * 2^attempt, capped at cap seconds. The
+# randomness keeps gateways that failed together from retrying together.
+#
+# Parameters:
+#   attempt - the retry number
+#   base - the first retry's longest wait
+#   cap - the longest wait of any retry
+# Returns:
+#   the number of seconds to wait
+# ---------------------
+def backoff(attempt, base=1.0, cap=30.0):
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+# Function: callWithRetry
+# ---------------------
+# This function calls fn until it succeeds, the error is not transient, it has
+# been retried retries times, or the next wait would pass the deadline.
+#
+# Parameters:
+#   fn - the function to call, without arguments
+#   retries - the most retries after the first call
+#   deadline - a time.monotonic() value no retry may start after, or None
+#   base, cap - the backoff settings (see backoff)
+#   name - what is being called, for the log
+#   on_retry - called with the exception before each retry (optional)
+# Returns:
+#   whatever fn returns
+# ---------------------
+def callWithRetry(
+    fn, retries=2, deadline=None, base=1.0, cap=30.0, name="call", on_retry=None
+):
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except Exception as e:
+            if attempt >= retries or not isTransient(e):
+                raise
+            delay = backoff(attempt, base, cap)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                raise
+            logging.warning(
+                name + " failed (" + str(e) + "), retrying in " + "%.1fs" % delay
+            )
+            if on_retry is not None:
+                on_retry(e)
+            time.sleep(delay)
+            attempt += 1
+
+
+# Class: CircuitBreaker
+# ---------------------
+# Tracks the consecutive failures of one gateway. After threshold failures in
+# a row the breaker opens and the gateway is skipped for cooldown seconds.
+# After that one attempt is let through: a success closes the breaker, a
+# failure opens it again for twice as long, up to max_cooldown.
+#
+# Parameters:
+#   threshold - consecutive failures before the breaker opens
+#   cooldown - seconds the breaker first stays open
+#   max_cooldown - the longest the breaker stays open
+# ---------------------
+class CircuitBreaker:
+    def __init__(self, threshold=3, cooldown=300, max_cooldown=3600):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failures = 0
+        self.opened_until = None
+        self._open_for = cooldown
+        self._lock = threading.Lock()
+
+    # Function: allow
+    # ---------------------
+    # Returns True if the gateway should be tried now.
+    # ---------------------
+    def allow(self):
+        with self._lock:
+            return self.opened_until is None or time.monotonic() >= self.opened_until
+
+    # Function: is_open
+    # ---------------------
+    # Returns True while the gateway is being skipped.
+    # ---------------------
+    def is_open(self):
+        return not self.allow()
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_until = None
+            self._open_for = self.cooldown
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.opened_until is not None:
+                # The trial attempt after a cool-down failed
+                self._open_for = min(self._open_for * 2, self.max_cooldown)
+            elif self.failures < self.threshold:
+                return
+            self.opened_until = time.monotonic() + self._open_for
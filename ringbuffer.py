@@ -0,0 +1,155 @@
+# This file contains a fixed-size ring buffer of the most recent processed
+# intervals of one table. The times and readings live in preallocated NumPy
+# arrays that are overwritten oldest first, so the memory used never grows and
+# the read API can answer latest, range and downsampled queries with a couple
+# of array operations instead of a database query.
+
+
+# Import the required libraries
+import threading
+
+
+# Class: RingBuffer
+# ---------------------
+# Holds up to capacity intervals. Times are kept as UTC nanoseconds since the
+# epoch and must be appended in order, rows at or before the newest time are
+# skipped. Every method takes the lock, so one thread can append while others
+# read.
+#
+# Parameters:
+#   columns - the names of the value columns
+#   capacity - the most intervals kept
+# ---------------------
+class RingBuffer:
+    def __init__(self, columns, capacity):
+        import numpy as np
+
+        self.columns = list(columns)
+        self.capacity = capacity
+        self._times = np.zeros(capacity, dtype="int64")
+        self._values = np.full((capacity, len(self.columns)), np.nan)
+        self._start = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    # Function: append
+    # ---------------------
+    # Adds the rows newer than the newest one held, dropping the oldest rows
+    # once the buffer is full.
+    #
+    # Parameters:
+    #   times - an int64 array of UTC nanoseconds, in order
+    #   values - a float array with one row per time and one column per column
+    # Returns:
+    #   the mask of the rows that were added
+    # ---------------------
+    def append(self, times, values):
+        import numpy as np
+
+        with self._lock:
+            keep = np.ones(len(times), dtype=bool)
+            if self._count:
+                keep = times > self._times[(self._start + self._count - 1) % self.capacity]
+            times, values = times[keep], values[keep]
+            if len(times) > self.capacity:
+                times, values = times[-self.capacity :], values[-self.capacity :]
+
+            # Write at the end, wrapping around to the front
+            end = (self._start + self._count) % self.capacity
+            first = min(len(times), self.capacity - end)
+            self._times[end : end + first] = times[:first]
+            self._values[end : end + first] = values[:first]
+            self._times[: len(times) - first] = times[first:]
+            self._values[: len(times) - first] = values[first:]
+
+            overflow = max(0, self._count + len(times) - self.capacity)
+            self._start = (self._start + overflow) % self.capacity
+            self._count = min(self.capacity, self._count + len(times))
+            return keep
+
+    # Function: _positions
+    # ---------------------
+    # Returns where the intervals with start <= time < end are in the arrays,
+    # oldest first. The arrays are a sorted run rotated by _start, so each of
+    # the two halves is searched on its own.
+    # ---------------------
+    def _positions(self, start, end):
+        import numpy as np
+
+        tail = min(self._count, self.capacity - self._start)
+        halves = [
+            (self._start, self._times[self._start : self._start + tail]),
+            (0, self._times[: self._count - tail]),
+        ]
+        positions = []
+        for offset, times in halves:
+            first = 0 if start is None else np.searchsorted(times, start, "left")
+            last = len(times) if end is None else np.searchsorted(times, end, "left")
+            positions.append(np.arange(offset + first, offset + last))
+        return np.concatenate(positions)
+
+    def _indexes(self, columns):
+        if columns is None:
+            return list(range(len(self.columns)))
+        missing = [column for column in columns if column not in self.columns]
+        if missing:
+            raise ValueError("Unknown columns: " + ", ".join(missing))
+        return [self.columns.index(column) for column in columns]
+
+    # Function: latest
+    # ---------------------
+    # Returns the newest interval as (time, values), or None when empty.
+    # ---------------------
+    def latest(self, columns=None):
+        indexes = self._indexes(columns)
+        with self._lock:
+            if not self._count:
+                return None
+            last = (self._start + self._count - 1) % self.capacity
+            return int(self._times[last]), self._values[last, indexes].copy()
+
+    # Function: window
+    # ---------------------
+    # Returns copies of the times and values with start <= time < end, either
+    # bound can be None.
+    # ---------------------
+    def window(self, start=None, end=None, columns=None):
+        indexes = self._indexes(columns)
+        with self._lock:
+            positions = self._positions(start, end)
+            return self._times[positions], self._values[positions][:, indexes]
+
+    # Function: downsample
+    # ---------------------
+    # Returns one row per step nanoseconds between start and end, aligned to
+    # multiples of step since the epoch (so hours and days start on the UTC
+    # hour and day). Empty steps are left out. how is "mean", "min", "max" or
+    # "last", and missing readings are ignored.
+    # ---------------------
+    def downsample(self, step, start=None, end=None, columns=None, how="mean"):
+        import numpy as np
+
+        if how not in ("mean", "min", "max", "last"):
+            raise ValueError("Unknown aggregate: " + str(how))
+        if step <= 0:
+            raise ValueError("The step must be positive")
+        times, values = self.window(start, end, columns)
+        if not len(times):
+            return times, values
+
+        buckets = times // step
+        first = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+        if how == "last":
+            return buckets[first] * step, values[np.r_[first[1:], len(times)] - 1]
+        if how == "min":
+            return buckets[first] * step, np.fmin.reduceat(values, first)
+        if how == "max":
+            return buckets[first] * step, np.fmax.reduceat(values, first)
+        present = ~np.isnan(values)
+        sums = np.add.reduceat(np.where(present, values, 0.0), first)
+        counts = np.add.reduceat(present, first)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return buckets[first] * step, np.where(counts > 0, sums / counts, np.nan)
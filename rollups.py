@@ -0,0 +1,216 @@
+# This file contains hourly, daily and monthly kWh rollups of the processed
+# data, kept in a local SQLite database per table. Each cycle only the
+# intervals that are new or changed are written, and only the hours, days and
+# months they fall in are summed again, so late data and backfills correct
+# exactly the buckets they touch. A year of data reads back as about 8760
+# hourly, 365 daily or 12 monthly rows instead of 105k 5 minute rows.
+
+
+# Import the required libraries
+import os
+import sqlite3
+import threading
+
+
+LEVELS = {"hour": "hourly", "day": "daily", "month": "monthly"}
+
+
+# Class: Rollups
+# ---------------------
+# The rollup database for one table. The intervals table keeps every
+# interval's kWh by UTC time, so repeated local times at the end of daylight
+# saving time stay distinct, together with the hour, local day and local month
+# it belongs to. hourly, daily and monthly hold the sums of each kWh column
+# and how many intervals went into them.
+#
+# Parameters:
+#   path - the SQLite database file
+#   tz - the time zone days and months are counted in
+# ---------------------
+class Rollups:
+    def __init__(self, path, tz="US/Pacific"):
+        self.path = path
+        self.tz = tz
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        return sqlite3.connect(self.path)
+
+    # Function: _columns
+    # ---------------------
+    # Creates the tables if needed, adds any kWh columns they do not have yet,
+    # and returns the kWh columns of the intervals table.
+    # ---------------------
+    def _columns(self, conn, columns):
+        keys = {
+            "intervals": "utc TEXT PRIMARY KEY, hour TEXT, day TEXT, month TEXT",
+            "hourly": "hour TEXT PRIMARY KEY, local TEXT, day TEXT",
+            "daily": "day TEXT PRIMARY KEY, month TEXT",
+            "monthly": "month TEXT PRIMARY KEY",
+        }
+        for table, key in keys.items():
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({key})")
+            existing = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+            for column in columns:
+                if column not in existing:
+                    conn.execute(f'ALTER TABLE {table} ADD COLUMN "{column}" REAL')
+            if table != "intervals" and "intervals" not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN intervals INTEGER")
+        conn.execute("CREATE INDEX IF NOT EXISTS intervals_hour ON intervals (hour)")
+        conn.execute("CREATE INDEX IF NOT EXISTS hourly_day ON hourly (day)")
+        conn.execute("CREATE INDEX IF NOT EXISTS daily_month ON daily (month)")
+        return [
+            row[1]
+            for row in conn.execute("PRAGMA table_info(intervals)")
+            if row[1].endswith("_Kwh")
+        ]
+
+    # Function: update
+    # ---------------------
+    # Writes the intervals of master_df that are new or differ from the stored
+    # ones and recomputes the buckets they fall in.
+    #
+    # Parameters:
+    #   master_df - a dataframe with a Time column and *_Kwh columns
+    # Returns:
+    #   the number of intervals written
+    # ---------------------
+    def update(self, master_df):
+        import numpy as np
+        import pandas as pd
+
+        kwh = [column for column in master_df.columns if column.endswith("_Kwh")]
+        df = master_df[["Time"] + kwh].dropna(subset=kwh, how="all")
+        if df.empty:
+            return 0
+        times = pd.DatetimeIndex(df["Time"])
+        if times.tz is None:
+            times = times.tz_localize(self.tz, ambiguous="infer")
+        utc = times.tz_convert("UTC")
+        local = times.tz_convert(self.tz)
+        rows = pd.DataFrame(
+            {
+                "utc": utc.strftime("%Y-%m-%d %H:%M:%S"),
+                "hour": utc.floor("h").strftime("%Y-%m-%d %H:%M:%S"),
+                "day": local.strftime("%Y-%m-%d"),
+                "month": local.strftime("%Y-%m"),
+            }
+        )
+        for column in kwh:
+            rows[column] = df[column].to_numpy(dtype="float64")
+
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    columns = self._columns(conn, kwh)
+                    quoted = ", ".join('"' + column + '"' for column in kwh)
+
+                    # Skip the intervals that are already stored with the same values
+                    stored = pd.read_sql_query(
+                        f"SELECT utc, {quoted} FROM intervals WHERE utc BETWEEN ? AND ?",
+                        conn,
+                        params=(rows["utc"].min(), rows["utc"].max()),
+                    )
+                    if not stored.empty:
+                        old = stored.set_index("utc").reindex(rows["utc"])[kwh].to_numpy()
+                        new = rows[kwh].to_numpy()
+                        same = np.isclose(new, old, rtol=0, atol=1e-9)
+                        same |= np.isnan(new) & np.isnan(old)
+                        rows = rows[~same.all(axis=1)]
+                    if rows.empty:
+                        return 0
+
+                    names = ["utc", "hour", "day", "month"] + kwh
+                    values = rows[names].astype(object).where(rows[names].notna(), None)
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO intervals ("
+                        + ", ".join('"' + name + '"' for name in names)
+                        + ") VALUES ("
+                        + ", ".join("?" * len(names))
+                        + ")",
+                        values.itertuples(index=False),
+                    )
+                    self._recompute(conn, columns, rows)
+            finally:
+                conn.close()
+        return len(rows)
+
+    # Function: _recompute
+    # ---------------------
+    # Sums the touched hours from the intervals, then the touched days from
+    # the hours and the touched months from the days.
+    # ---------------------
+    def _recompute(self, conn, columns, rows):
+        import pandas as pd
+
+        sums = ", ".join('SUM("' + column + '")' for column in columns)
+        quoted = ", ".join('"' + column + '"' for column in columns)
+
+        hours = pd.DatetimeIndex(sorted(rows["hour"].unique()), tz="UTC")
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS touched (hour TEXT PRIMARY KEY, local TEXT)")
+        conn.execute("DELETE FROM touched")
+        conn.executemany(
+            "INSERT INTO touched VALUES (?, ?)",
+            zip(
+                hours.strftime("%Y-%m-%d %H:%M:%S"),
+                hours.tz_convert(self.tz).strftime("%Y-%m-%d %H:%M"),
+            ),
+        )
+        conn.execute(
+            f"INSERT OR REPLACE INTO hourly (hour, local, day, {quoted}, intervals) "
+            f"SELECT i.hour, t.local, MIN(i.day), {sums}, COUNT(*) "
+            "FROM intervals i JOIN touched t ON i.hour = t.hour GROUP BY i.hour"
+        )
+        conn.executemany(
+            f"INSERT OR REPLACE INTO daily (day, month, {quoted}, intervals) "
+            f"SELECT day, substr(day, 1, 7), {sums}, SUM(intervals) FROM hourly "
+            "WHERE day = ? GROUP BY day",
+            ((day,) for day in sorted(rows["day"].unique())),
+        )
+        conn.executemany(
+            f"INSERT OR REPLACE INTO monthly (month, {quoted}, intervals) "
+            f"SELECT month, {sums}, SUM(intervals) FROM daily "
+            "WHERE month = ? GROUP BY month",
+            ((month,) for month in sorted(rows["month"].unique())),
+        )
+
+    # Function: read
+    # ---------------------
+    # Reads one rollup level.
+    #
+    # Parameters:
+    #   level - "hour", "day" or "month"
+    #   start - the first bucket to include, e.g. "2024-01-01" (optional)
+    #   end - the first bucket to exclude (optional)
+    # Returns:
+    #   a dataframe with one row per bucket, hours keyed by their UTC start
+    #   time with the local time in the local column
+    # ---------------------
+    def read(self, level, start=None, end=None):
+        import pandas as pd
+
+        if level not in LEVELS:
+            raise ValueError("Unknown rollup level: " + str(level))
+        if not os.path.exists(self.path):
+            return pd.DataFrame()
+        table = LEVELS[level]
+        conditions, params = [], []
+        if start is not None:
+            conditions.append(level + " >= ?")
+            params.append(str(start))
+        if end is not None:
+            conditions.append(level + " < ?")
+            params.append(str(end))
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        with self._lock:
+            conn = self._connect()
+            try:
+                return pd.read_sql_query(
+                    f"SELECT * FROM {table}{where} ORDER BY {level}", conn, params=params
+                )
+            finally:
+                conn.close()
@@ -0,0 +1,152 @@
+# This file contains the scheduler that runs the collection cycle for every
+# building in the registry. The buildings are split into shards and each shard
+# runs in its own worker process, so adding buildings spreads the parsing and
+# cleaning over more cores, and a building that fails or crashes its worker
+# does not hold up the others.
+
+
+# Import the required libraries
+import logging
+import os
+import signal
+
+import datapross
+from metrics import get_metrics
+
+
+# Function: shard
+# ---------------------
+# This function splits the buildings into count shards, round robin in
+# registry order, so a building lands in the same shard every cycle as long as
+# the registry does not change.
+#
+# Parameters:
+#   buildings - a list of buildings
+#   count - the number of shards
+# Returns:
+#   a list of count lists of buildings
+# ---------------------
+def shard(buildings, count):
+    return [buildings[i::count] for i in range(count)]
+
+
+# Function: runShard
+# ---------------------
+# This function runs each building of a shard one after the other. An
+# exception in one building is logged and recorded, and the rest still run.
+#
+# Parameters:
+#   buildings - the buildings in the shard
+# Returns:
+#   results - a dict of building name -> rows written, None if its data was
+#             rejected, or the exception it raised
+#   metrics - the metrics recorded in this process since the last shard
+#   readings - the intervals added to the ring buffers since the last shard
+# ---------------------
+def runShard(buildings):
+    results = {}
+    for building in buildings:
+        try:
+            results[building["name"]] = datapross.runBuilding(building)
+        except Exception as e:
+            logging.exception("Building " + building["name"] + " failed")
+            results[building["name"]] = e
+    return results, get_metrics().drain(), datapross.drainReadings()
+
+
+# Function: initWorker
+# ---------------------
+# This function runs once in each new worker process. Connections copied from
+# the parent cannot be shared, so the worker opens its own, and it starts with
+# empty ring buffers since the parent's are the ones served. Ctrl-C is left to
+# the parent, which stops the workers after the current cycle.
+# ---------------------
+def initWorker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    datapross._pool = None
+    datapross._sftp_sessions.clear()
+    get_metrics().drain()
+    datapross._outbox = None
+    datapross._rings.clear()
+    datapross._ring_pending.clear()
+
+
+# Class: Scheduler
+# ---------------------
+# Runs the buildings over a fixed set of worker processes. Each shard has its
+# own single-process pool, so the same buildings always go to the same worker
+# and its SFTP connections, database pool and incremental download state stay
+# warm between cycles. With one worker everything runs in this process.
+#
+# Parameters:
+#   workers - the most worker processes (defaults to SHARD_WORKERS or the
+#             number of CPUs)
+# ---------------------
+class Scheduler:
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = int(os.getenv("SHARD_WORKERS", "0")) or os.cpu_count() or 1
+        self.workers = max(1, workers)
+        self._pools = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Function: run
+    # ---------------------
+    # Runs one cycle for every building and waits for all of them.
+    #
+    # Parameters:
+    #   buildings - the buildings to run
+    # Returns:
+    #   a dict of building name -> rows written, None or an exception
+    # ---------------------
+    def run(self, buildings):
+        count = min(self.workers, len(buildings))
+        if count <= 1:
+            results, _, _ = runShard(buildings)
+            return results
+        # Only loaded for more than one worker, it adds to every start-up
+        from concurrent.futures import ProcessPoolExecutor
+        from concurrent.futures.process import BrokenProcessPool
+
+        futures = {}
+        for i, buildings_in_shard in enumerate(shard(buildings, count)):
+            pool = self._pools.get(i)
+            if pool is None:
+                pool = self._pools[i] = ProcessPoolExecutor(
+                    max_workers=1, initializer=initWorker
+                )
+            futures[i] = (pool.submit(runShard, buildings_in_shard), buildings_in_shard)
+
+        results = {}
+        for i, (future, buildings_in_shard) in futures.items():
+            try:
+                shard_results, values, readings = future.result()
+            except BrokenProcessPool as e:
+                # The worker died, start a new one for this shard next cycle
+                logging.error("Worker for shard " + str(i) + " died: " + str(e))
+                self._pools.pop(i).shutdown(wait=False)
+                shard_results = {building["name"]: e for building in buildings_in_shard}
+                values = readings = {}
+            except Exception as e:
+                # e.g. a result that could not be sent back from the worker
+                logging.error("Shard " + str(i) + " failed: " + str(e))
+                shard_results = {building["name"]: e for building in buildings_in_shard}
+                values = readings = {}
+            results.update(shard_results)
+            get_metrics().merge(values)
+            datapross.mergeReadings(readings)
+        return results
+
+    # Function: close
+    # ---------------------
+    # Stops the worker processes.
+    # ---------------------
+    def close(self):
+        for pool in self._pools.values():
+            pool.shutdown()
+        self._pools.clear()
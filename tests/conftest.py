@@ -0,0 +1,126 @@
+# Shared set-up for the tests. The top-level modules and the benchmark
+# stand-ins are put on the path, and every local cache and state directory is
+# switched off or pointed at a temporary directory so the tests never touch
+# the real gateways, database or state/.
+
+
+# Import the required libraries
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+os.environ["TREND_CACHE_DIR"] = ""
+os.environ["ARCHIVE_DIR"] = ""
+os.environ["ROLLUP_DIR"] = ""
+os.environ["READINGS_DAYS"] = "0"
+os.environ["SFTP_KEEPALIVE"] = "0"
+os.environ["INCREMENTAL_FETCH"] = "0"
+os.environ["OUTBOX_ENABLED"] = "0"
+os.environ["METRICS_ENABLED"] = "0"
+
+from datetime import datetime
+
+import pytest
+import pytz
+
+import datapross
+import standins
+
+
+def today():
+    now = datetime.now(pytz.timezone("US/Pacific"))
+    return datetime(now.year, now.month, now.day)
+
+
+# Fixture: state
+# ---------------------
+# Gives every test its own checkpoint directory, fresh circuit breakers and no
+# incremental download state.
+# ---------------------
+@pytest.fixture(autouse=True)
+def state(tmp_path, monkeypatch):
+    monkeypatch.setenv("CHECKPOINT_DIR", str(tmp_path / "state"))
+    monkeypatch.setattr(datapross, "_checkpoints", None)
+    datapross._breakers.clear()
+    datapross._tail_state.clear()
+    yield tmp_path / "state"
+    datapross._breakers.clear()
+    datapross._tail_state.clear()
+
+
+# Fixture: database
+# ---------------------
+# Points datapross's connection pool at an empty SQLite database with an
+# "energy" table laid out like the Azure SQL table.
+# ---------------------
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    path = str(tmp_path / "db.sqlite")
+    monkeypatch.setattr(datapross, "connect_db", datapross.connect_db)
+    monkeypatch.setattr(datapross, "_pool", None)
+    monkeypatch.setenv("SQL_DIALECT", "sqlite")
+    standins.install_database(path, "energy")
+    yield lambda: standins.sqlite_connect(path, "energy")
+    datapross._pool.close()
+
+
+# Function: master_frame
+# ---------------------
+# Builds a processed master dataframe with every UPLOAD_COLUMNS column.
+#
+# Parameters:
+#   start - the first time, US/Pacific
+#   periods - how many 5 minute intervals
+#   seed - the random seed
+# Returns:
+#   a dataframe with a tz-aware Time column
+# ---------------------
+def master_frame(start, periods, seed=0):
+    import numpy as np
+    import pandas as pd
+
+    columns = list(datapross.UPLOAD_COLUMNS)[1:]
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(rng.random((periods, len(columns))).round(6), columns=columns)
+    df.insert(0, "Time", pd.date_range(start, periods=periods, freq="5min", tz="US/Pacific"))
+    return df
+
+
+# Class: CountingConnection
+# ---------------------
+# Wraps a database connection and counts the commits that ended a transaction
+# and the executemany calls made through its cursors.
+# ---------------------
+class CountingConnection:
+    def __init__(self, conn):
+        self._conn = conn
+        self.commits = 0
+        self.executemany_calls = []
+
+    def commit(self):
+        if self._conn.in_transaction:
+            self.commits += 1
+        self._conn.commit()
+
+    def cursor(self):
+        return CountingCursor(self, self._conn.cursor())
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class CountingCursor:
+    def __init__(self, owner, cursor):
+        self._owner = owner
+        self._cursor = cursor
+
+    def executemany(self, sql, rows):
+        rows = list(rows)
+        self._owner.executemany_calls.append((sql, len(rows)))
+        return self._cursor.executemany(sql, rows)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
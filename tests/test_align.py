@@ -0,0 +1,46 @@
+# Tests for alignFrames filling short gaps in one server's readings.
+
+
+# Import the required libraries
+import numpy as np
+import pandas as pd
+
+import datapross
+
+
+def frames(missing):
+    index = pd.date_range("2025-06-01 00:00", periods=12, freq="5min", tz="US/Pacific", name="Time")
+    full = pd.DataFrame({"Meter_01_Watt(avg)": np.arange(12.0)}, index=index)
+    gappy = full.drop(index[missing]) + 100
+    return full, gappy
+
+
+def test_gap_within_the_limit_is_filled():
+    full, gappy = frames([4, 5])
+
+    aligned, gaps = datapross.alignFrames([full, gappy], fill_limit=2)
+
+    assert gaps == [0, 2]
+    assert len(aligned[1]) == 12
+    assert aligned[1]["Meter_01_Watt(avg)"].iloc[3:7].tolist() == [103.0, 103.0, 103.0, 106.0]
+    assert aligned[1]["Missing"].tolist() == [False] * 4 + [True] * 2 + [False] * 6
+
+
+def test_gap_longer_than_the_limit_is_not_filled():
+    full, gappy = frames([3, 4, 5, 6])
+
+    aligned, gaps = datapross.alignFrames([full, gappy], fill_limit=2)
+
+    assert gaps == [0, 4]
+    # None of the gap is filled, not even its first fill_limit intervals
+    assert aligned[0].index.equals(full.index.delete([3, 4, 5, 6]))
+    assert aligned[1]["Meter_01_Watt(avg)"].tolist() == [100.0, 101.0, 102.0, 107.0, 108.0, 109.0, 110.0, 111.0]
+    assert not aligned[1]["Missing"].any()
+
+
+def test_leading_gap_has_nothing_to_fill_from():
+    full, gappy = frames([0])
+
+    aligned, _ = datapross.alignFrames([full, gappy], fill_limit=2)
+
+    assert aligned[1].index[0] == full.index[1]
@@ -0,0 +1,165 @@
+# Tests for mergeData and mergeRows. The SQLite statements from
+# mergeStatements are executed against the stand-in; the SQL Server MERGE has
+# no stand-in here and is only checked as text and with a recording cursor.
+
+
+# Import the required libraries
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+import datapross
+from conftest import CountingConnection, master_frame
+
+
+def stored(connect):
+    rows = pd.read_sql_query("SELECT * FROM energy ORDER BY dateTime", connect())
+    return rows.set_index(pd.to_datetime(rows["dateTime"]))
+
+
+def local(df):
+    return df["Time"].dt.tz_localize(None)
+
+
+def test_counts_inserted_updated_and_unchanged(database):
+    df = master_frame("2025-06-01 00:00", 10)
+    datapross.uploadData(df.iloc[:6], "energy")
+
+    corrected = df.copy()
+    corrected.loc[[1, 4], "Utilities"] += 1.0
+    counts = datapross.mergeData(corrected, "energy")
+
+    assert counts == {"inserted": 4, "updated": 2, "unchanged": 4}
+    rows = stored(database)
+    assert len(rows) == 10
+    assert rows["Utilities"].tolist() == pytest.approx(corrected["Utilities"].tolist())
+    # Merging the same rows again changes nothing
+    assert datapross.mergeData(corrected, "energy") == {"inserted": 0, "updated": 0, "unchanged": 10}
+
+
+def test_nulls_compare_equal(database):
+    df = master_frame("2025-06-01 00:00", 3)
+    df.loc[0, "Utilities"] = float("nan")
+    datapross.uploadData(df, "energy")
+
+    corrected = df.copy()
+    # NaN against NULL is unchanged, a value becoming NULL and back is a change
+    corrected.loc[1, "Utilities"] = float("nan")
+    corrected.loc[2, "Total"] = float("nan")
+    assert datapross.mergeData(corrected, "energy") == {"inserted": 0, "updated": 2, "unchanged": 1}
+
+    assert datapross.mergeData(df, "energy") == {"inserted": 0, "updated": 2, "unchanged": 1}
+    rows = stored(database)
+    assert rows["Utilities"].isna().tolist() == [True, False, False]
+    assert rows["TOTAL"].notna().all()
+
+
+def test_duplicate_times_keep_the_last_row(database):
+    df = master_frame("2025-06-01 00:00", 3)
+    repeated = pd.concat([df, df.iloc[[1]].assign(Utilities=99.0)], ignore_index=True)
+
+    counts = datapross.mergeData(repeated, "energy")
+
+    assert counts == {"inserted": 3, "updated": 0, "unchanged": 0}
+    rows = stored(database)
+    assert len(rows) == 3
+    assert rows.loc[local(df).iloc[1], "Utilities"] == 99.0
+
+
+def test_empty_frame_writes_nothing(database):
+    assert datapross.mergeData(master_frame("2025-06-01 00:00", 0), "energy") == {
+        "inserted": 0,
+        "updated": 0,
+        "unchanged": 0,
+    }
+    assert stored(database).empty
+
+
+def test_rows_are_staged_in_one_batch_and_committed_once(database):
+    df = master_frame("2025-06-01 00:00", 8)
+    datapross.uploadData(df.iloc[:4], "energy")
+    conn = CountingConnection(database())
+
+    rows = df.assign(Time=datapross.localTimes(df["Time"]))
+    counts = datapross.mergeRows(conn, "energy", rows, dialect="sqlite")
+
+    assert counts == {"inserted": 4, "updated": 0, "unchanged": 4}
+    assert [(sql.split()[2], n) for sql, n in conn.executemany_calls] == [("temp.stage", 8)]
+    assert conn.commits == 1
+
+
+def test_unknown_dialect_is_refused(database):
+    rows = master_frame("2025-06-01 00:00", 1)
+    with pytest.raises(ValueError):
+        datapross.mergeRows(database(), "energy", rows, dialect="oracle")
+
+
+def test_sql_server_merge_text():
+    # Not executed, there is no SQL Server stand-in
+    names = list(datapross.UPLOAD_COLUMNS.values())
+    stage, prepare, apply, cleanup = datapross.mergeStatements("energy", names, "mssql")
+
+    assert stage == "#stage"
+    assert prepare[-1].startswith("SELECT TOP 0 " + ", ".join(names) + " INTO #stage FROM energy")
+    merge = apply[0]
+    assert "MERGE energy WITH (HOLDLOCK) AS t USING #stage AS s ON t.dateTime = s.dateTime" in merge
+    assert "WHEN MATCHED AND EXISTS (SELECT s." + names[1] in merge
+    assert " EXCEPT SELECT t." + names[1] in merge
+    assert "WHEN NOT MATCHED BY TARGET THEN INSERT (" + ", ".join(names) + ")" in merge
+    assert "OUTPUT $action INTO @actions" in merge
+    assert cleanup == ["DROP TABLE #stage"]
+
+
+# Class: RecordingConnection
+# ---------------------
+# Records the calls mergeRows makes and answers the MERGE with fixed counts.
+# ---------------------
+class RecordingConnection:
+    def __init__(self):
+        self.calls = []
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql):
+        self.calls.append(("execute", sql))
+
+    def setinputsizes(self, sizes):
+        self.calls.append(("setinputsizes", sizes))
+
+    def executemany(self, sql, rows):
+        self.calls.append(("executemany", sql))
+
+    def fetchone(self):
+        return 1, 0
+
+    def commit(self):
+        self.calls.append(("commit", None))
+
+
+def test_sql_server_staging_rows_have_explicit_types(monkeypatch):
+    # Stands in for pyodbc's ODBC type numbers, pyodbc is not needed here
+    monkeypatch.setattr(datapross, "pyodbc", SimpleNamespace(SQL_TYPE_TIMESTAMP=93, SQL_DOUBLE=8))
+    conn = RecordingConnection()
+    rows = master_frame("2025-06-01 00:00", 2)
+    rows["Time"] = datapross.localTimes(rows["Time"])
+
+    counts = datapross.mergeRows(conn, "energy", rows, dialect="mssql")
+
+    assert counts == {"inserted": 1, "updated": 0, "unchanged": 1}
+    kinds = [kind for kind, _ in conn.calls]
+    assert kinds.index("setinputsizes") == kinds.index("executemany") - 1
+    sizes = conn.calls[kinds.index("setinputsizes")][1]
+    assert sizes == [(93, 23, 3)] + [(8, 0, 0)] * (len(datapross.UPLOAD_COLUMNS) - 1)
+    assert conn.calls[kinds.index("executemany")][1].startswith("INSERT INTO #stage")
+
+
+def test_sqlite_staging_rows_keep_the_driver_types():
+    conn = RecordingConnection()
+    rows = master_frame("2025-06-01 00:00", 2)
+    rows["Time"] = datapross.localTimes(rows["Time"])
+
+    datapross.mergeRows(conn, "energy", rows, dialect="sqlite")
+
+    assert "setinputsizes" not in [kind for kind, _ in conn.calls]
@@ -0,0 +1,199 @@
+# Tests for uploadData with the outbox on: which rows are queued, when the
+# database is asked for its last time, and the drainer writing the queue to
+# the SQLite stand-in and reconciling the checkpoints.
+
+
+# Import the required libraries
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+import datapross
+import metrics
+from conftest import master_frame
+from outbox import Drainer, Outbox
+
+
+@pytest.fixture
+def outbox(tmp_path, monkeypatch, database):
+    monkeypatch.setenv("OUTBOX_ENABLED", "1")
+    monkeypatch.setattr(datapross, "_outbox", Outbox(str(tmp_path / "outbox.sqlite")))
+    return datapross._outbox
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    # Counts the queries for the table's last time
+    calls = []
+    get_last_time = datapross.get_last_time
+
+    def counted(table=None):
+        calls.append(table)
+        return get_last_time(table)
+
+    monkeypatch.setattr(datapross, "get_last_time", counted)
+    return calls
+
+
+def drain(outbox):
+    return Drainer(outbox, datapross.flushOutbox).drain()
+
+
+def stored(connect):
+    rows = pd.read_sql_query("SELECT dateTime FROM energy ORDER BY dateTime", connect())
+    return pd.to_datetime(rows["dateTime"]).tolist()
+
+
+def database_down(monkeypatch):
+    def refuse(table=None):
+        raise ConnectionError("database unreachable")
+
+    monkeypatch.setattr(datapross, "get_last_time", refuse)
+
+
+def test_rows_are_queued_then_drained_once(database, outbox):
+    df = master_frame("2025-06-01 00:00", 12)
+
+    assert datapross.uploadData(df.iloc[:8], "energy") == 8
+    assert stored(database) == []
+    assert datapross.uploadData(df, "energy") == 4
+    assert drain(outbox) == 12
+
+    assert stored(database) == df["Time"].dt.tz_localize(None).tolist()
+    assert outbox.stats() == {}
+    assert datapross.uploadData(df, "energy") == 0
+
+
+def test_fresh_checkpoint_is_trusted(database, outbox, lookups):
+    df = master_frame("2025-06-01 00:00", 12)
+    datapross.uploadData(df.iloc[:8], "energy")
+    drain(outbox)
+    lookups.clear()
+
+    assert datapross.uploadData(df, "energy") == 4
+    assert lookups == []
+
+
+def hang(seconds):
+    def connect():
+        time.sleep(seconds)
+        raise ConnectionError("login timed out")
+
+    return connect
+
+
+@pytest.mark.parametrize("reason", ["stale", "due"])
+def test_drainer_reconciles_the_checkpoint(database, outbox, lookups, reason):
+    df = master_frame("2025-06-01 00:00", 12)
+    datapross.uploadData(df.iloc[:8], "energy")
+    drain(outbox)
+    # Rows 4-7 were removed from the table behind the checkpoint's back
+    conn = database()
+    conn.execute("DELETE FROM energy WHERE dateTime >= ?", (str(df["Time"].iloc[4].tz_localize(None)),))
+    conn.commit()
+    if reason == "stale":
+        datapross.get_checkpoints().invalidate("energy")
+    else:
+        datapross.get_checkpoints().reconcile_seconds = -1
+    lookups.clear()
+
+    # The drainer, not the cycle, asks the database
+    assert datapross.reconcileCheckpoints() == ["energy"]
+    assert lookups == ["energy"]
+    lookups.clear()
+    assert datapross.uploadData(df, "energy") == 8
+    assert lookups == []
+    drain(outbox)
+    assert len(stored(database)) == 12
+
+
+def test_hanging_database_does_not_delay_the_cycle(database, outbox, monkeypatch):
+    df = master_frame("2025-06-01 00:00", 12)
+    datapross.uploadData(df.iloc[:8], "energy")
+    drain(outbox)
+    datapross.get_checkpoints().invalidate("energy")
+    datapross._pool.close()
+    monkeypatch.setattr(datapross, "connect_db", hang(3))
+    monkeypatch.setattr(datapross, "_pool", datapross.ConnectionPool(datapross.connect_db))
+
+    start = time.perf_counter()
+    assert datapross.uploadData(df, "energy") == 4
+    assert time.perf_counter() - start < 0.5
+    # The rows queued so far count as well
+    assert datapross.uploadData(df, "energy") == 0
+
+
+def test_failed_reconcile_backs_off(database, outbox, monkeypatch):
+    monkeypatch.setattr(metrics, "_metrics", metrics.Metrics())
+    datapross.uploadData(master_frame("2025-06-01 00:00", 4), "energy")
+    drain(outbox)
+    datapross.get_checkpoints().invalidate("energy")
+    database_down(monkeypatch)
+    calls = []
+
+    def reconcile():
+        calls.append(time.monotonic())
+        datapross.reconcileCheckpoints()
+
+    # The longest backoff instead of a random one
+    monkeypatch.setattr("outbox.backoff", lambda attempt, base, cap: cap)
+    drainer = Drainer(outbox, datapross.flushOutbox, interval=0.05, cap=30, reconcile=reconcile).start()
+    time.sleep(0.5)
+    drainer.stop()
+
+    # One attempt, then the drainer waits out its backoff
+    assert len(calls) == 1
+    assert metrics.get_metrics()._values[("emd_outbox_flush_errors_total", ())] == 1
+    assert datapross.get_checkpoints().needs_reconcile("energy")
+
+
+def test_unreachable_database_without_a_checkpoint_queues_everything(database, outbox, monkeypatch):
+    df = master_frame("2025-06-01 00:00", 12)
+    datapross.insertRows(database(), "energy", df.iloc[:8].assign(Time=datapross.localTimes(df["Time"].iloc[:8])))
+    database_down(monkeypatch)
+
+    assert datapross.uploadData(df, "energy") == 12
+    drain(outbox)
+    # The rows the table had are skipped
+    assert stored(database) == df["Time"].dt.tz_localize(None).tolist()
+
+
+def test_gauges_follow_the_outbox(database, outbox, monkeypatch):
+    monkeypatch.setattr(metrics, "_metrics", metrics.Metrics())
+    datapross.uploadData(master_frame("2025-06-01 00:00", 5), "energy")
+    drainer = Drainer(outbox, datapross.flushOutbox)
+
+    drainer.report()
+    assert metrics.get_metrics().drain()[("emd_outbox_rows", (("table", "energy"),))] == 5
+    drainer.drain()
+    drainer.report()
+    assert metrics.get_metrics().drain()[("emd_outbox_rows", (("table", "energy"),))] == 0
+
+
+def test_cycle_latency_is_set_once_the_rows_are_committed(database, outbox, monkeypatch):
+    monkeypatch.setattr(metrics, "_metrics", metrics.Metrics())
+    datapross.uploadData(master_frame("2025-06-01 00:00", 5), "energy")
+    release = threading.Event()
+
+    def flush(table, rows):
+        release.wait(5)
+        return datapross.flushOutbox(table, rows)
+
+    drainer = Drainer(outbox, flush, interval=60).start()
+    try:
+        drainer.mark(time.time() - 10)
+        time.sleep(0.2)
+        # Queued but not yet written
+        assert "emd_cycle_latency_seconds" not in [key[0] for key in metrics.get_metrics()._values]
+        release.set()
+        for _ in range(50):
+            latency = metrics.get_metrics()._values.get(("emd_cycle_latency_seconds", ()))
+            if latency is not None:
+                break
+            time.sleep(0.05)
+    finally:
+        drainer.stop()
+    assert 10 <= latency < 15
+    assert len(stored(database)) == 5
@@ -0,0 +1,101 @@
+# Tests for pullAll: gateways are downloaded at the same time, and one failing
+# gateway does not hold up or fail the others.
+
+
+# Import the required libraries
+import time
+
+import pytest
+
+import datapross
+import standins
+import synthetic
+from conftest import today
+
+CONNECT_DELAY = 0.3
+
+
+@pytest.fixture
+def gateways(tmp_path, monkeypatch):
+    monkeypatch.setattr(datapross, "connect_sftp", datapross.connect_sftp)
+    monkeypatch.setenv("FETCH_RETRIES", "0")
+    for num in range(1, 5):
+        synthetic.write_gateway(str(tmp_path / ("gw" + str(num))), [today()], partial_rows=12, seed=num)
+    return [
+        {"num": num, "host": "gw" + str(num), "user": "test", "password": "test"}
+        for num in range(1, 5)
+    ]
+
+
+def test_gateways_are_downloaded_concurrently(tmp_path, gateways):
+    standins.install_gateways(str(tmp_path), connect_delay=CONNECT_DELAY)
+
+    start = time.perf_counter()
+    serial, errors = datapross.pullAll(gateways, max_workers=1, fetch=datapross.pullData)
+    serial_seconds = time.perf_counter() - start
+    assert not errors
+
+    start = time.perf_counter()
+    results, errors = datapross.pullAll(gateways, fetch=datapross.pullData)
+    concurrent_seconds = time.perf_counter() - start
+
+    assert not errors
+    assert sorted(results) == [1, 2, 3, 4]
+    assert all(len(results[num]) == 12 for num in results)
+    assert serial_seconds >= 4 * CONNECT_DELAY
+    # About one gateway's delay, not four
+    assert concurrent_seconds < 2 * CONNECT_DELAY
+
+
+def test_failing_gateway_does_not_affect_the_others(tmp_path, gateways):
+    standins.install_gateways(str(tmp_path), connect_delay=CONNECT_DELAY, faults={"gw2": "refuse"})
+
+    start = time.perf_counter()
+    results, errors = datapross.pullAll(gateways, fetch=datapross.pullData)
+
+    assert sorted(results) == [1, 3, 4]
+    assert list(errors) == [2]
+    assert isinstance(errors[2], ConnectionRefusedError)
+    assert time.perf_counter() - start < 2 * CONNECT_DELAY
+
+
+def test_hung_gateway_is_cut_off_at_the_deadline(tmp_path, gateways):
+    standins.install_gateways(str(tmp_path), faults={"gw4": 3})
+
+    start = time.perf_counter()
+    results, errors = datapross.pullAll(gateways, fetch=datapross.pullData, deadline=1)
+
+    assert time.perf_counter() - start < 2
+    assert sorted(results) == [1, 2, 3]
+    assert list(errors) == [4]
+    assert isinstance(errors[4], TimeoutError)
+    assert datapross.get_breaker("gw4").failures == 1
+    assert datapross.get_breaker("gw1").failures == 0
+
+
+def test_abandoned_incremental_download_leaves_no_tail_state(tmp_path, gateways, monkeypatch):
+    standins.install_gateways(str(tmp_path))
+    results, errors = datapross.pullAll(gateways, fetch=datapross.pullDataIncremental)
+    assert not errors and "gw4" in datapross._tail_state
+
+    # The file changes and gw4's next download hangs past the deadline
+    path = str(tmp_path / "gw4")
+    synthetic.write_gateway(path, [today()], partial_rows=20, seed=4)
+    connect = datapross.connect_sftp
+    finished = []
+
+    def slow(host, user, password):
+        if host == "gw4":
+            time.sleep(1.5)
+            finished.append(host)
+        return connect(host, user, password)
+
+    monkeypatch.setattr(datapross, "connect_sftp", slow)
+    results, errors = datapross.pullAll(gateways, fetch=datapross.pullDataIncremental, deadline=0.5)
+    assert list(errors) == [4]
+    assert "gw4" not in datapross._tail_state
+
+    # The late download finishes but does not store its state
+    time.sleep(1.5)
+    assert finished == ["gw4"]
+    assert "gw4" not in datapross._tail_state
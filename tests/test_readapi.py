@@ -0,0 +1,57 @@
+# Tests for the read API's query handling, called without the HTTP server.
+
+
+# Import the required libraries
+import json
+
+import numpy as np
+import pytest
+
+import readapi
+from ringbuffer import RingBuffer
+
+
+@pytest.fixture
+def ring(monkeypatch):
+    ring = RingBuffer(["Total"], 288)
+    times = np.arange(1_750_000_200, 1_750_000_200 + 12 * 300, 300, dtype="int64") * 10**9
+    ring.append(times, np.arange(12.0).reshape(-1, 1))
+    monkeypatch.setattr(readapi.datapross, "get_rings", lambda: {"energy": ring})
+    return ring
+
+
+def test_times_from_a_response_can_be_sent_back():
+    times = np.array([1_750_000_200 * 10**9], dtype="int64")
+    text = readapi.formatTimes(times)[0]
+
+    assert text.endswith("Z")
+    assert readapi.parseTime(text) == times[0]
+    assert readapi.parseTime(text[:-1] + "+00:00") == times[0]
+    assert readapi.parseTime("1750000200") == times[0]
+
+
+def test_naive_times_are_pacific():
+    # 2025-06-15 08:10 PDT is 15:10 UTC
+    assert readapi.parseTime("2025-06-15T08:10:00") == readapi.parseTime("2025-06-15T15:10:00Z")
+
+
+def test_range_from_a_returned_time(ring):
+    _, body = readapi.latest({})
+    newest = json.loads(body)["time"]
+
+    _, body = readapi.window({"start": [newest]})
+
+    assert json.loads(body)["time"] == [newest]
+    assert json.loads(body)["values"]["Total"] == [11.0]
+
+
+def test_bad_requests():
+    with pytest.raises(ValueError):
+        readapi.parseTime("yesterday")
+    with pytest.raises(ValueError):
+        readapi.parseStep("0")
+
+
+def test_unknown_table(ring):
+    with pytest.raises(LookupError):
+        readapi.latest({"table": ["other"]})
@@ -0,0 +1,71 @@
+# Tests for runBuilding with gateways that are not numbered 1..n: the zone
+# config refers to servers by their registry number.
+
+
+# Import the required libraries
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import datapross
+import standins
+import synthetic
+from conftest import today
+
+ZONES = {
+    "1st_Floor": [[3, "Meter_01_Watt(avg)"]],
+    "2nd_Floor": [[1, "Meter_01_Watt(avg)"]],
+    "3rd_Floor": [[1, "Meter_02_Watt(avg)"], [3, "Meter_02_Watt(avg)"]],
+    "4th_Floor": [[3, "Meter_03_Watt(avg)"]],
+    "Utilities": [[1, "Meter_03_Watt(avg)"]],
+}
+
+
+@pytest.fixture
+def building(tmp_path, monkeypatch):
+    monkeypatch.setattr(datapross, "connect_sftp", datapross.connect_sftp)
+    monkeypatch.setenv("FETCH_RETRIES", "0")
+    for num in (1, 3):
+        synthetic.write_gateway(str(tmp_path / ("gw" + str(num))), [today()], partial_rows=12, seed=num, meters=3)
+    zones = tmp_path / "zones.json"
+    zones.write_text(json.dumps({"interval_minutes": 5, "total": "Total", "zones": ZONES}))
+    return {
+        "name": "sparse",
+        "table": "energy",
+        "zones": str(zones),
+        "columns": None,
+        "gateways": [
+            {"num": num, "host": "gw" + str(num), "user": "test", "password": "test"}
+            for num in (1, 3)
+        ],
+    }
+
+
+def watts(num, meter):
+    df = synthetic.trend_frame(today(), meters=3, rows=12, seed=num * 100000)
+    return df["Meter_%02d_Watt(avg)" % meter].abs().round(2).to_numpy()
+
+
+def test_zones_use_the_registry_numbers(tmp_path, database, building):
+    standins.install_gateways(str(tmp_path))
+
+    assert datapross.runBuilding(building) == 12
+
+    rows = pd.read_sql_query("SELECT * FROM energy ORDER BY dateTime", database())
+    assert np.allclose(rows["First_Floor"], watts(3, 1))
+    assert np.allclose(rows["Second_Floor"], watts(1, 1))
+    assert np.allclose(rows["Third_Floor"], watts(1, 2) + watts(3, 2))
+
+
+def test_partial_results_with_a_failed_high_numbered_gateway(tmp_path, database, building, monkeypatch):
+    monkeypatch.setenv("PARTIAL_RESULTS", "1")
+    standins.install_gateways(str(tmp_path), faults={"gw3": "refuse"})
+
+    assert datapross.runBuilding(building) == 12
+
+    rows = pd.read_sql_query("SELECT * FROM energy ORDER BY dateTime", database())
+    assert rows["First_Floor"].isna().all()
+    assert rows["Third_Floor"].isna().all()
+    assert np.allclose(rows["Second_Floor"], watts(1, 1))
@@ -0,0 +1,79 @@
+# Tests for parsing trend times around the end of daylight saving time, when
+# 01:00-01:55 appears twice in the trend file (first PDT, then PST).
+
+
+# Import the required libraries
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+import datapross
+
+HEADER = ["Date", "Time", "Meter_01_Watt(avg)"]
+FIRST_PASS = ["00:50:00", "00:55:00"] + ["01:%02d:00" % minute for minute in range(0, 60, 5)]
+SECOND_PASS = ["01:%02d:00" % minute for minute in range(0, 60, 5)] + ["02:00:00"]
+
+
+def trend(times, header=True):
+    rows = "".join("11/02/2025,%s,%d\n" % (time, i) for i, time in enumerate(times))
+    return BytesIO(((",".join(HEADER) + "\n" if header else "") + rows).encode())
+
+
+def offsets(index):
+    return [time.utcoffset().total_seconds() / 3600 for time in index]
+
+
+def test_whole_file_infers_the_repeated_hour():
+    df = datapross.readTrend(trend(FIRST_PASS + SECOND_PASS))
+
+    assert not df.index.hasnans
+    assert offsets(df.index) == [-7] * 14 + [-8] * 13
+    assert df.index.is_monotonic_increasing
+
+
+def test_tail_in_the_second_pass_uses_the_previous_row():
+    head = datapross.readTrend(trend(FIRST_PASS))
+    tail = datapross.readTrend(trend(SECOND_PASS[:3], header=False), header=HEADER, previous=head.index[-1])
+
+    assert offsets(tail.index) == [-8, -8, -8]
+    assert tail.index[0] > head.index[-1]
+
+
+def test_tail_in_the_first_pass_stays_daylight_time():
+    head = datapross.readTrend(trend(FIRST_PASS[:2]))
+    tail = datapross.readTrend(trend(FIRST_PASS[2:5], header=False), header=HEADER, previous=head.index[-1])
+
+    assert offsets(tail.index) == [-7, -7, -7]
+
+
+def test_repeated_hour_with_a_duplicate_row():
+    # A duplicated row keeps pandas from inferring, the order still decides
+    times = FIRST_PASS[:4] + FIRST_PASS[3:] + SECOND_PASS
+    df = datapross.readTrend(trend(times))
+
+    assert not df.index.hasnans
+    assert offsets(df.index) == [-7] * 15 + [-8] * 13
+
+
+def test_incremental_day_regularizes_across_the_change():
+    head = datapross.readTrend(trend(FIRST_PASS))
+    tail = datapross.readTrend(trend(SECOND_PASS, header=False), header=HEADER, previous=head.index[-1])
+
+    df = datapross.regularize(pd.concat([head, tail]))
+
+    assert len(df) == 27
+    assert not df["Missing"].any()
+
+
+def test_regularize_drops_rows_without_a_time():
+    index = pd.DatetimeIndex(
+        ["2025-06-01 00:00", "NaT", "2025-06-01 00:05", "NaT", "2025-06-01 00:15"]
+    ).tz_localize("US/Pacific")
+    df = pd.DataFrame({"Meter_01_Watt(avg)": np.arange(5.0)}, index=index)
+
+    df = datapross.regularize(df)
+
+    assert len(df) == 4
+    assert df["Missing"].tolist() == [False, False, True, False]
+    assert df["Meter_01_Watt(avg)"].tolist()[:2] == [0.0, 2.0]
@@ -0,0 +1,75 @@
+# Tests for uploadData and insertRows against the SQLite stand-in: the new
+# intervals of a cycle are written as one batch with one commit.
+
+
+# Import the required libraries
+import pandas as pd
+import pytest
+
+import datapross
+from conftest import CountingConnection, master_frame
+
+
+@pytest.fixture
+def counted(database):
+    # One connection for the whole test, so its counters see every call
+    conn = CountingConnection(database())
+    datapross._pool.close()
+    datapross._pool = datapross.ConnectionPool(lambda: conn, size=1)
+    return conn
+
+
+def stored(connect):
+    return pd.read_sql_query("SELECT * FROM energy ORDER BY dateTime", connect())
+
+
+def test_missed_intervals_are_caught_up_in_one_batch(database, counted):
+    df = master_frame("2025-06-01 00:00", 20)
+    assert datapross.uploadData(df.iloc[:10], "energy") == 10
+    counted.commits = 0
+    counted.executemany_calls.clear()
+
+    # The last 5 cycles were missed, the next one brings all their rows
+    assert datapross.uploadData(df.iloc[:15], "energy") == 5
+
+    assert [rows for _, rows in counted.executemany_calls] == [5]
+    assert counted.commits == 1
+    rows = stored(database)
+    assert len(rows) == 15
+    assert pd.to_datetime(rows["dateTime"]).tolist() == df["Time"].iloc[:15].dt.tz_localize(None).tolist()
+
+
+def test_missing_readings_are_written_as_null(database, counted):
+    df = master_frame("2025-06-01 00:00", 3)
+    df.loc[1, "Utilities"] = float("nan")
+
+    assert datapross.uploadData(df, "energy") == 3
+
+    nulls = database().execute(
+        "SELECT COUNT(*) FROM energy WHERE Utilities IS NULL"
+    ).fetchone()[0]
+    assert nulls == 1
+    assert stored(database)["TOTAL"].notna().all()
+
+
+def test_nothing_new_writes_nothing(database, counted):
+    df = master_frame("2025-06-01 00:00", 6)
+    assert datapross.uploadData(df, "energy") == 6
+    counted.commits = 0
+    counted.executemany_calls.clear()
+
+    assert datapross.uploadData(df, "energy") == 0
+
+    assert counted.executemany_calls == []
+    assert counted.commits == 0
+    assert len(stored(database)) == 6
+
+
+def test_insert_rows_returns_the_row_count(database):
+    df = master_frame("2025-06-01 00:00", 7)
+    df["Time"] = datapross.localTimes(df["Time"])
+    conn = database()
+
+    assert datapross.insertRows(conn, "energy", df) == 7
+    assert datapross.insertRows(conn, "energy", df.iloc[:0]) == 0
+    assert conn.execute("SELECT COUNT(*) FROM energy").fetchone()[0] == 7
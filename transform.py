@@ -0,0 +1,223 @@
+# This file contains the parallel parse and clean stage used when months or
+# years of trend files are reprocessed. Parsing with readTrend and running
+# cleanData only uses one core, so runs of days are sent to a pool of worker
+# processes instead. The workers send back the cleaned days as plain NumPy
+# arrays, which cross the process boundary as raw buffers, and the parent
+# builds a single dataframe from them at the end.
+
+
+# Import the required libraries
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from io import BytesIO
+
+from datapross import (
+    cleanData,
+    countDownload,
+    downloadDays,
+    get_trend_cache,
+    np,
+    pd,
+    readTrend,
+)
+
+
+# Function: transformChunk
+# ---------------------
+# This function parses and cleans a run of consecutive days for one gateway in
+# a worker process. Each day is either the raw trend file downloaded by the
+# parent, or read from the trend cache when its data is None. Downloaded days
+# are added to the cache. The days are cleaned together, cleaning a single
+# day at a time costs more in pandas overhead than the cleaning itself.
+#
+# Parameters:
+#   gateway - the gateway's FTP_HOST, the trend cache key
+#   days - the dates of the trend files
+#   datas - the raw trend file for each day, or None to read it from the cache
+#   rule - how duplicate readings are combined (see regularize)
+# Returns:
+#   the cleaned days packed by packFrame
+# ---------------------
+def transformChunk(gateway, days, datas, rule=None):
+    cache = get_trend_cache()
+    frames = []
+    for day, data in zip(days, datas):
+        if data is None:
+            df = cache.get(gateway, day) if cache is not None else None
+            if df is None:
+                raise LookupError(gateway + " " + day.strftime("%Y-%m-%d") + " is not in the cache")
+        else:
+            df = readTrend(BytesIO(data))
+            if cache is not None:
+                cache.put(gateway, day, df)
+        frames.append(df)
+    df = pd.concat(frames)
+    pack = packFrame(cleanData(df, rule=rule))
+    pack["rows"] = len(df)
+    return pack
+
+
+# Function: packFrame
+# ---------------------
+# This function turns a cleaned dataframe into NumPy arrays: the interval
+# times as UTC datetime64 values, the readings as one float64 matrix and the
+# Missing flags.
+#
+# Parameters:
+#   df - a dataframe returned by cleanData
+# Returns:
+#   a dict with the keys time, tz, columns, values and missing
+# ---------------------
+def packFrame(df):
+    readings = df.columns.drop("Missing")
+    index = df.index
+    if index.tz is not None:
+        index = index.tz_convert("UTC").tz_localize(None)
+    return {
+        "time": index.to_numpy(),
+        "tz": str(df.index.tz) if df.index.tz is not None else None,
+        "columns": list(readings),
+        "values": np.ascontiguousarray(df[readings].to_numpy(dtype="float64")),
+        "missing": df["Missing"].to_numpy(dtype=bool),
+    }
+
+
+# Function: unpackFrames
+# ---------------------
+# This function joins packed chunks, in date order, back into one cleaned
+# dataframe. Chunks that are missing a meter get NaN for it. Each chunk was put
+# on the interval grid by itself, so intervals missing at the edges of a chunk
+# are added here and flagged like any other missing interval.
+#
+# Parameters:
+#   packs - the packed chunks
+#   freq - the trend interval
+# Returns:
+#   df - a dataframe like cleanData returns for the whole range
+# ---------------------
+def unpackFrames(packs, freq="5min"):
+    packs = [pack for pack in packs if len(pack["time"])]
+    if not packs:
+        return pd.DataFrame()
+
+    columns = packs[0]["columns"]
+    if all(pack["columns"] == columns for pack in packs):
+        values = np.concatenate([pack["values"] for pack in packs])
+    else:
+        columns = list(dict.fromkeys(c for pack in packs for c in pack["columns"]))
+        position = {column: i for i, column in enumerate(columns)}
+        values = np.full((sum(len(pack["time"]) for pack in packs), len(columns)), np.nan)
+        row = 0
+        for pack in packs:
+            rows = len(pack["time"])
+            values[row : row + rows, [position[c] for c in pack["columns"]]] = pack["values"]
+            row += rows
+
+    index = pd.DatetimeIndex(np.concatenate([pack["time"] for pack in packs]))
+    df = pd.DataFrame(values, index=index, columns=columns)
+    df["Missing"] = np.concatenate([pack["missing"] for pack in packs])
+
+    # A file can end with the next day's first interval
+    if index.has_duplicates or not index.is_monotonic_increasing:
+        df = df.sort_index(kind="stable")
+        df = df[~df.index.duplicated(keep="last")]
+    grid = pd.date_range(df.index[0], df.index[-1], freq=freq)
+    if len(grid) == len(df):
+        df = df.set_axis(grid)
+    else:
+        df = df.reindex(grid)
+        df["Missing"] = df["Missing"].fillna(True).astype(bool)
+
+    if packs[0]["tz"] is not None:
+        df.index = df.index.tz_localize("UTC").tz_convert(packs[0]["tz"])
+    df.index.name = "Time"
+    return df
+
+
+# Function: transformRange
+# ---------------------
+# This function downloads, parses and cleans a gateway's trend files for a
+# date range using every core. The range is split into chunks of
+# TRANSFORM_CHUNK_DAYS days, and each chunk is sent to a worker process as
+# soon as all of its days are available: days in the trend cache straight
+# away, the others once the SFTP sessions from downloadDays have fetched
+# them, so downloading and parsing overlap.
+#
+# Parameters:
+#   FTP_HOST - the IP address of the server
+#   FTP_USER - the username
+#   FTP_PASS - the password
+#   start - the start date in the format "YYYY-MM-DD"
+#   end - the end date in the format "YYYY-MM-DD"
+#   workers - how many worker processes (defaults to TRANSFORM_WORKERS or the
+#             number of CPUs)
+#   sessions - how many SFTP sessions download days at the same time
+#   rule - how duplicate readings are combined (see regularize)
+# Returns:
+#   df - the cleaned data for the range, like cleanData(get_data_from_range(...))
+# ---------------------
+def transformRange(FTP_HOST, FTP_USER, FTP_PASS, start, end, workers=None, sessions=None, rule=None):
+    start_date = datetime.strptime(start, "%Y-%m-%d")
+    end_date = datetime.strptime(end, "%Y-%m-%d")
+    if end_date < start_date:
+        logging.error("Start date is after end date")
+        return None
+    days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+    size = int(os.getenv("TRANSFORM_CHUNK_DAYS", "7"))
+    chunks = [days[i : i + size] for i in range(0, len(days), size)]
+
+    if workers is None:
+        workers = int(os.getenv("TRANSFORM_WORKERS", "0")) or os.cpu_count() or 1
+    workers = max(1, min(workers, len(chunks)))
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    else:
+        executor = ThreadPoolExecutor(max_workers=1)
+
+    # Chunk number -> {day: raw file, or None for a cached day}
+    cache = get_trend_cache()
+    pending = {i: {} for i in range(len(chunks))}
+    chunk_of = {day: i for i, chunk in enumerate(chunks) for day in chunk}
+    futures = {}
+    lock = threading.Lock()
+
+    def add(day, data):
+        with lock:
+            i = chunk_of[day]
+            pending[i][day] = data
+            if len(pending[i]) < len(chunks[i]):
+                return
+            datas = pending.pop(i)
+        futures[i] = executor.submit(
+            transformChunk, FTP_HOST, chunks[i], [datas[d] for d in chunks[i]], rule
+        )
+
+    with executor:
+        downloaded = []
+        for day in days:
+            if cache is not None and cache.has(FTP_HOST, day):
+                add(day, None)
+            else:
+                downloaded.append(day)
+        print(str(len(days) - len(downloaded)) + " of " + str(len(days)) + " days found in the cache")
+
+        def receive(day, fh):
+            data = fh.read()
+            countDownload(FTP_HOST, len(data), 0)
+            add(day, data)
+
+        if downloaded:
+            print("Attempting to download data from range:" + start + " to " + end)
+            downloadDays(FTP_HOST, FTP_USER, FTP_PASS, downloaded, receive, sessions)
+        packs = [futures[i].result() for i in range(len(chunks))]
+
+    countDownload(FTP_HOST, 0, sum(pack["rows"] for pack in packs))
+    if cache is not None:
+        cache.evict()
+
+    df = unpackFrames(packs)
+    print("Processed " + str(len(days)) + " days, there are:" + str(len(df)) + " rows")
+    return df
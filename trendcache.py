@@ -0,0 +1,142 @@
+# This file contains an on-disk cache of parsed daily trend files.
+# A gateway's file for a past day never changes, so once it has been downloaded
+# and parsed it is stored as Parquet and reused by later backfills and
+# reprocessing runs instead of being fetched over SFTP again.
+
+
+# Import the required libraries
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from io import BytesIO
+
+import pytz
+
+
+# Class: TrendCache
+# ---------------------
+# Stores one Parquet file per gateway and day under directory, with a .sha256
+# file next to it holding its checksum. A file that fails its checksum is
+# deleted and treated as a miss. The current day, and the previous day until
+# grace_hours past midnight, are never cached because the gateway may still be
+# writing to them. Files not read for max_age_days are evicted, and the least
+# recently used files are evicted when the cache grows past max_bytes.
+#
+# Parameters:
+#   directory - where the cache files are kept
+#   max_bytes - the most disk space the cache may use
+#   max_age_days - how long an unused cached day is kept
+#   grace_hours - how long after midnight a day becomes final
+# ---------------------
+class TrendCache:
+    def __init__(self, directory, max_bytes=500 * 2**20, max_age_days=365, grace_hours=1):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.grace_hours = grace_hours
+        self._lock = threading.Lock()
+
+    def _path(self, gateway, day):
+        safe = re.sub(r"[^A-Za-z0-9_.-]", "_", str(gateway))
+        return os.path.join(self.directory, safe, day.strftime("%Y%m%d") + ".parquet")
+
+    # Function: is_final
+    # ---------------------
+    # Returns True if the trend file for day can no longer change.
+    # ---------------------
+    def is_final(self, day):
+        tz = pytz.timezone("US/Pacific")
+        final_at = tz.localize(
+            datetime(day.year, day.month, day.day) + timedelta(days=1, hours=self.grace_hours)
+        )
+        return datetime.now(tz) >= final_at
+
+    # Function: has
+    # ---------------------
+    # Returns True if gateway and day are in the cache, without reading them.
+    # The checksum is only verified by get.
+    # ---------------------
+    def has(self, gateway, day):
+        path = self._path(gateway, day)
+        return os.path.exists(path) and os.path.exists(path + ".sha256")
+
+    # Function: get
+    # ---------------------
+    # Returns the cached dataframe for gateway and day, or None on a miss.
+    # ---------------------
+    def get(self, gateway, day):
+        path = self._path(gateway, day)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            with open(path + ".sha256") as f:
+                checksum = f.read().strip()
+        except OSError:
+            return None
+
+        if hashlib.sha256(data).hexdigest() != checksum:
+            logging.warning("Cached trend file " + path + " failed its checksum, removing")
+            self._remove(path)
+            return None
+        os.utime(path)
+        # pandas is only loaded on a hit, a miss should not slow start-up
+        import pandas as pd
+
+        return pd.read_parquet(BytesIO(data))
+
+    # Function: put
+    # ---------------------
+    # Stores the dataframe for gateway and day if the day is final.
+    # ---------------------
+    def put(self, gateway, day, df):
+        if not self.is_final(day):
+            return False
+        path = self._path(gateway, day)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + "." + str(threading.get_ident()) + ".tmp"
+        df.to_parquet(tmp_path, compression="zstd")
+        with open(tmp_path, "rb") as f:
+            checksum = hashlib.sha256(f.read()).hexdigest()
+        with open(path + ".sha256", "w") as f:
+            f.write(checksum)
+        os.replace(tmp_path, path)
+        return True
+
+    # Function: evict
+    # ---------------------
+    # Removes cached days unused for max_age_days, then the least recently used days
+    # until the cache fits in max_bytes.
+    # ---------------------
+    def evict(self):
+        with self._lock:
+            entries = []
+            for folder, _, files in os.walk(self.directory):
+                for name in files:
+                    if name.endswith(".parquet"):
+                        path = os.path.join(folder, name)
+                        stat = os.stat(path)
+                        entries.append((stat.st_mtime, stat.st_size, path))
+
+            oldest = time.time() - self.max_age_days * 86400
+            total = 0
+            removed = 0
+            for mtime, size, path in sorted(entries, reverse=True):
+                if mtime < oldest or total + size > self.max_bytes:
+                    self._remove(path)
+                    removed += 1
+                else:
+                    total += size
+            if removed:
+                logging.info("Evicted " + str(removed) + " days from the trend cache")
+            return removed
+
+    def _remove(self, path):
+        for name in (path, path + ".sha256"):
+            try:
+                os.remove(name)
+            except OSError:
+                pass